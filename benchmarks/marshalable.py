@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+""" marshalable() on shuffle batches, against the recursive walk it replaced.
+
+    python benchmarks/marshalable.py
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import timeit
+import itertools
+
+import six
+from six.moves import range
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dpark.serialize import marshalable
+
+
+def walk_marshalable(o):
+    if o is None:
+        return True
+    t = type(o)
+    if t in (six.binary_type, six.text_type, bool, int, int, float, complex):
+        return True
+    if t in (tuple, list, set):
+        for i in itertools.islice(o, 100):
+            if not walk_marshalable(i):
+                return False
+        return True
+    if t == dict:
+        for k, v in itertools.islice(six.iteritems(o), 100):
+            if not walk_marshalable(k) or not walk_marshalable(v):
+                return False
+        return True
+    return False
+
+
+class Point(object):
+    pass
+
+
+N = 1024  # BYPASS_BATCH_SIZE
+BATCHES = [
+    ('(int, str)', [(i, str(i)) for i in range(N)]),
+    ('((int, int), float)', [((i, i * 7), i * 0.5) for i in range(N)]),
+    ('(str, [int] * 10)', [(str(i), list(range(10))) for i in range(N)]),
+    ('(int, (str, [float] * 3))', [(i, ('k', [1.0, 2.0, 3.0])) for i in range(N)]),
+    ('(int, object)', [(i, Point()) for i in range(N)]),
+    ('dict of str -> int', dict((str(i), i) for i in range(N))),
+]
+
+
+def main(number=2000):
+    print('%-28s %12s %12s %8s' % ('batch', 'walk (us)', 'levels (us)', 'speedup'))
+    for name, batch in BATCHES:
+        assert marshalable(batch) == walk_marshalable(batch)
+        old = timeit.timeit(lambda: walk_marshalable(batch), number=number) / number * 1e6
+        new = timeit.timeit(lambda: marshalable(batch), number=number) / number * 1e6
+        print('%-28s %12.1f %12.1f %7.1fx' % (name, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
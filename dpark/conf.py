@@ -44,8 +44,110 @@ MAX_OPEN_FILE = 900
 LOG_ROTATE = True
 MULTI_SEGMENT_DUMP = True
 
+# each map task writes one data file plus an index of per-reduce offsets,
+# instead of one file per (map, reduce) pair
+SHUFFLE_CONSOLIDATE = True
+
+# serve shuffle blocks from a keep-alive tcp server in each executor,
+# reducers fetch all blocks of one host in a single request
+SHUFFLE_BLOCK_SERVER = True
+
+# max decompressed bytes fetched but not merged yet in a reduce task,
+# fetch threads wait when it is used up. 0 to limit by number of batches.
+SHUFFLE_FETCH_BUDGET = 256 << 20
+
+# crc32c of each shuffle frame, checked by reducers. frames with it can not be read
+# by versions before it, turn it on once all executors are running this version.
+SHUFFLE_CHECKSUM = False
+
+# run adjacent tiny reduce partitions in one task, by sizes of map outputs
+COALESCE_REDUCE_PARTITIONS = True
+COALESCE_TARGET_SIZE = 64 << 20  # shuffle input bytes per task
+COALESCE_MAX_PARTITIONS = 32  # per task
+
+# map tasks stop combining values if the first MAP_COMBINE_CHECK records have more than
+# MAP_COMBINE_BYPASS_RATIO distinct keys per record, the reducers do all the combining.
+# 0 to always combine.
+MAP_COMBINE_CHECK = 100000
+MAP_COMBINE_BYPASS_RATIO = 0.8
+
+# map tasks sample one in SKEW_SAMPLE_INTERVAL keys, a key with more than
+# SKEW_HOT_KEY_SHARE of the samples is a hot key, reported to the driver.
+SKEW_SAMPLE_INTERVAL = 16
+SKEW_HOT_KEY_SHARE = 0.05
+# in join/leftOuterJoin, hot keys of the left side are spread over this many
+# reduce partitions, and the right side is replicated to them. 0 to disable.
+# a salted join is not partitioned by key, so joins on it shuffle again.
+SKEW_JOIN_SALT = 0
+
+# join/leftOuterJoin/rightOuterJoin broadcast the side whose estimated input is smaller
+# than this many bytes and join map side, without shuffle. 0 to disable.
+# Joins given numSplits, taskMemory or rddconf always shuffle.
+BROADCAST_JOIN_THRESHOLD = 32 << 20
+
+# join(..., bloomFilter=True) drops records of one side whose keys are not in a bloom
+# filter of the other side's keys, before the shuffle. keys must be marshalable.
+# the filter is sized for this false positive rate, but no larger than BLOOM_JOIN_MAX_BYTES.
+BLOOM_JOIN_FPP = 0.01
+BLOOM_JOIN_MAX_BYTES = 64 << 20
+
+# codec of shuffle output: None for the default one (lz4, snappy or zlib, whichever
+# imports), 'none', 'zlib', 'lz4', 'snappy' or 'zstd', with an optional level like 'zlib:9'.
+# e.g. 'none' when shuffle data stays on tmpfs of a single host.
+# rddconf(codec=...) overrides it per shuffle.
+SHUFFLE_CODEC = None
+# codec of local spill files when merging, favor ratio over speed for disk
+SPILL_CODEC = 'zlib:6'
+
+# pickled buffers (bytes, bytearray, numpy arrays) of at least this many bytes are
+# written as frames of their own after the batch (pickle protocol 5, python >= 3.8),
+# so they are not copied into the pickle stream. 0 to disable.
+SHUFFLE_OOB_BUFFER_SIZE = 1 << 20
+
+# rdd and function of a stage are pickled once for all its tasks,
+# and sent by broadcast instead of in each task if larger than this.
+TASK_BINARY_BROADCAST_SIZE = 100 << 10
+
 TIME_TO_SUPPRESS = 60  # sec
 
+# executors fork task processes from a warm fork server, which has started the env
+# and imported dpark, instead of from the executor itself.
+EXECUTOR_FORK_SERVER = True
+# the fork server also imports the modules each task needs before forking it, so they
+# stay loaded for later tasks. Only imports, tasks themselves are never loaded in it.
+EXECUTOR_FORK_SERVER_PRELOAD = False
+
+# speculative execution: after SPECULATION_FINISHED_FRACTION of the tasks of a taskset
+# finished, a task running longer than SPECULATION_MULTIPLIER times the SPECULATION_QUANTILE
+# of finished task durations (and at least SPECULATION_MIN_TIME seconds) gets a backup try
+# on another host. the first finished try wins, the other is killed.
+# Off by default: tries of a task may run at the same time, so user code with side
+# effects (foreach, writes to external systems) has to be idempotent to turn it on.
+SPECULATION = False
+SPECULATION_FINISHED_FRACTION = 0.75
+SPECULATION_QUANTILE = 0.75
+SPECULATION_MULTIPLIER = 1.5
+SPECULATION_MIN_TIME = 10
+
+# delay scheduling: a taskset waits for offers of the preferred hosts of its tasks up to
+# LOCALITY_WAIT seconds, or LOCALITY_WAIT_RATIO of its average task time if shorter,
+# then as long again for hosts on the same rack, before it launches them anywhere.
+# 0 to launch anywhere at once, as before delay scheduling. a few seconds helps jobs
+# reading from disks of the cluster, but delays short interactive ones.
+LOCALITY_WAIT = 0
+LOCALITY_WAIT_RATIO = 0.5
+# rack of each host for the rack level, e.g. {'host1': 'rack1', 'host2': 'rack1'}
+RACKS = {}
+
+# memory and time percentiles of finished tasksets by api callsite, kept in this file
+# across runs, e.g. '~/.dpark/task_profile.json'. tasks of a callsite seen before request
+# TASK_PROFILE_MEM_HEADROOM more than the max rss of it, once it had TASK_PROFILE_MIN_TASKS
+# tasks. That shrinks the default memory, but not rdd.mem set by user, and after OOM it is
+# at least twice the limit they got OOM with and never less than requested. None to disable.
+TASK_PROFILE_PATH = None
+TASK_PROFILE_MEM_HEADROOM = 0.2
+TASK_PROFILE_MIN_TASKS = 5
+
 
 OP_UDF = "udf"
 OP_GROUPBY = "groupby"
@@ -65,10 +167,11 @@ class RDDConf(object):
         "ordered_group": False,
         "dump_mem_ratio": 0.9,
         "op": OP_UDF,
+        "codec": None,
         "_dummy": _named_only_start,
     }
 
-    def __init__(self, _dummy, disk_merge, sort_merge, iter_group, ordered_group, dump_mem_ratio, op):
+    def __init__(self, _dummy, disk_merge, sort_merge, iter_group, ordered_group, dump_mem_ratio, op, codec):
         if _dummy != _named_only_start:
             raise TypeError("DO NOT use RDDConf directly; use dpark.conf.rddconf() instead. ")
 
@@ -78,6 +181,7 @@ class RDDConf(object):
         self.ordered_group = ordered_group
         self.dump_mem_ratio = dump_mem_ratio
         self.op = op
+        self.codec = codec
 
     def __setattr__(self, name, value):
         if name not in self.ATTRS:
@@ -115,7 +219,7 @@ def rddconf(_dummy=_named_only_start,
             disk_merge=None, sort_merge=None,
             iter_group=False, ordered_group=None,
             dump_mem_ratio=None,
-            op=OP_UDF):
+            op=OP_UDF, codec=None):
     """ Return new RDDConfig object based on default values.
         Only takes named arguments.
         e.g. groupByKey(.., rddconf=dpark.conf.rddconf(...))
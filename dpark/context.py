@@ -4,14 +4,16 @@ import optparse
 import signal
 import logging
 import gc
+import threading
 
 from dpark.rdd import *
 from dpark.utils.beansdb import restore_value
 from dpark.accumulator import Accumulator
 from dpark.schedule import (
-    LocalScheduler, MultiProcessScheduler, MesosScheduler
+    LocalScheduler, MultiProcessScheduler, MesosScheduler, walk_dependencies
 )
 from dpark.env import env
+from dpark.serialize import closure_cache_info
 from dpark.file_manager import walk
 from dpark.tabular import TabularRDD
 from dpark.utils import memory_str_to_mb
@@ -112,6 +114,7 @@ class DparkContext(object):
         self.master = master
         self.initialized = False
         self.started = False
+        self.start_lock = threading.Lock()  # jobs may run in many threads
         self.web_port = None
         self.webui_url = None
         self.data_limit = None
@@ -378,24 +381,31 @@ class DparkContext(object):
             except ImportError:
                 pass
 
-        if self.started:
-            return
+        with self.start_lock:
+            if self.started:
+                return
 
-        self.init()
+            self.init()
 
-        env.start_master()
-        if not isinstance(self.scheduler, MesosScheduler):
-            env.start_slave()
+            env.start_master()
+            if not isinstance(self.scheduler, MesosScheduler):
+                env.start_slave()
 
-        self.scheduler.start()
-        self.started = True
-        _shutdown_handlers.append(shutdown)
+            self.scheduler.start()
+            self.started = True
+            _shutdown_handlers.append(shutdown)
 
         spawn_rconsole(locals())
 
     def runJob(self, rdd, func, partitions=None, allowLocal=False):
         self.start()
 
+        def prepare(r):
+            r._prepare()
+            return True
+
+        walk_dependencies(rdd, node_func=prepare)
+
         success = False
         if partitions is None:
             partitions = list(range(len(rdd)))
@@ -425,6 +435,12 @@ class DparkContext(object):
         self.scheduler.stop()
         self.started = False
 
+        stats = closure_cache_info()
+        if stats['hits']:
+            logger.info('dumped closures: %d hits (%.0f%%), %d misses, %d uncacheable, %.1fs saved',
+                        stats['hits'], stats['hit_rate'] * 100, stats['misses'],
+                        stats['uncacheable'], stats['secs_saved'])
+
     def __getstate__(self):
         raise ValueError("should not pickle ctx")
 
@@ -73,6 +73,7 @@ class ShuffleDependency(Dependency):
         self.aggregator = aggregator
         self.partitioner = partitioner
         self.rddconf = rddconf
+        self.salt = 0  # spread hot keys over this many partitions from their own
 
 
 class AggregatorBase(object):
@@ -214,6 +215,9 @@ class Partitioner:
     def getPartition(self, key):
         raise NotImplementedError
 
+    def __ne__(self, other):
+        return not self == other
+
 
 class HashPartitioner(Partitioner):
     def __init__(self, partitions, thresholds=None):
@@ -747,7 +747,7 @@ class MapPartitionedDStream(DerivedDStream):
     def compute(self, t):
         rdd = self.parent.getOrCompute(t)
         if rdd:
-            return rdd.mapPartitions(self.func)  # TODO preserve
+            return rdd.mapPartitions(self.func, self.preserve)
 
 
 class TransformedDStream(DerivedDStream):
@@ -791,15 +791,15 @@ class StateDStream(DerivedDStream):
                 cogroupedRDD = parentRDD.cogroup(prevRDD)
                 return cogroupedRDD.mapValue(
                     lambda vs_rs: (vs_rs[0], vs_rs[1] and vs_rs[1][0] or None)) \
-                    .mapPartitions(updateFuncLocal)  # preserve TODO
+                    .mapPartitions(updateFuncLocal, self.preservePartitioning)
             else:
                 return prevRDD.mapValue(
-                    lambda rs: ([], rs)).mapPartitions(updateFuncLocal)
+                    lambda rs: ([], rs)).mapPartitions(updateFuncLocal, self.preservePartitioning)
         else:
             if parentRDD:
                 groupedRDD = parentRDD.groupByKey(self.partitioner)
                 return groupedRDD.mapValue(
-                    lambda v: (v, None)).mapPartitions(updateFuncLocal)
+                    lambda v: (v, None)).mapPartitions(updateFuncLocal, self.preservePartitioning)
 
 
 class UnionDStream(DStream):
@@ -28,14 +28,21 @@ class TaskStats(object):
 
         # shuffle: fetch and merge -> run and merge ->  dump
         self.bytes_fetch = 0
+        self.bytes_fetch_raw = 0  # decompressed
         self.bytes_dump = 0
+        self.bytes_dump_raw = 0  # before compression
         self.secs_fetch = 0  # 0 for sort merge if not use disk
+        self.secs_fetch_wait = 0  # waiting for fetch threads
+        self.secs_fetch_merge = 0
         self.secs_dump = 0
 
         # rotate
         self.num_fetch_rotate = 0  # 0 if all in memory
         self.num_dump_rotate = 0  # 1 if all in memory
 
+        # join
+        self.num_bloom_dropped = 0  # records without match, dropped before shuffle
+
 
 def prepare_file_open(base, subpath):
     path = os.path.join(base, subpath)
@@ -183,6 +190,7 @@ class WorkDir(object):
 class DparkEnv(object):
 
     SERVER_URI = "SERVER_URI"
+    SHUFFLE_URI = "SHUFFLE_URI"
     COMPRESS = "COMPRESS"
     TRACKER_ADDR = "TRACKER_ADDR"
     DPARK_ID = "DPARK_ID"
@@ -217,6 +225,11 @@ class DparkEnv(object):
     def server_uri(self):
         return self.environ[self.SERVER_URI]
 
+    @property
+    def shuffle_uri(self):
+        # shuffle block server, or the web server if not started
+        return self.environ.get(self.SHUFFLE_URI) or self.server_uri
+
     def start_master(self):
         if self.master_started:
             return
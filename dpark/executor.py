@@ -21,6 +21,7 @@ from addict import Dict
 from pymesos import Executor, MesosExecutorDriver, encode_data, decode_data
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import dpark.conf
 from dpark.utils import (
     compress, decompress, spawn, mkdir_p, DparkUserFatalError
 )
@@ -30,10 +31,10 @@ from dpark.serialize import marshalable
 from dpark.accumulator import Accumulator
 from dpark.env import env
 from dpark.mutable_dict import MutableDict
-from dpark.serialize import loads
+from dpark.serialize import loads, find_modules
 from dpark.task import TTID, TaskState, TaskEndReason, FetchFailed
 from dpark.utils.debug import spawn_rconsole
-from dpark.shuffle import ShuffleWorkDir
+from dpark.shuffle import ShuffleWorkDir, RangeFile, start_shuffle_server
 
 logger = get_logger('dpark.executor')
 
@@ -43,6 +44,7 @@ MAX_EXECUTOR_IDLE_TIME = 60 * 60 * 24  # 1 day
 KILL_TIMEOUT = 0.1  # 0.1 sec, to reply to mesos fast
 TASK_LOST_JOIN_TIMEOUT = 3
 TASK_LOST_DISCARD_TIMEOUT = 60
+FORK_TIMEOUT = 10
 Script = ''
 
 
@@ -117,6 +119,159 @@ def run_task(task_data):
         gc.enable()
 
 
+def run_worker(procname, q, task_id_value, task_data):
+    task_id_str = "task %s" % (task_id_value,)
+    threading.current_thread().name = task_id_str
+    setproctitle(procname)
+    set_oom_score(100)
+    env.start_slave()
+    q.put((task_id_value, run_task(task_data)))
+
+
+def run_forked_worker(conn, procname, q, task_id_value, task_data):
+    conn.close()  # so executor sees EOF once the fork server exits, even if tasks not
+    run_worker(procname, q, task_id_value, task_data)
+
+
+def serve_forks(conn, parent_conn, result_queue, preload):
+    """ main of the fork server: fork a process for each task sent by executor,
+        report its pid and exitcode back
+    """
+    parent_conn.close()
+    setproctitle('[ForkServer]' + Script)
+    env.start_slave()
+
+    workers = {}  # task_id.value -> process
+    while True:
+        try:
+            msg = conn.recv() if conn.poll(0.1) else ()
+        except EOFError:  # executor exited
+            msg = None
+        if msg is None:
+            break
+
+        if msg:
+            name, task_id_value, task_data = msg
+            if preload:
+                # only import modules used by the task, no task object stays in fork server
+                for mod in find_modules(decompress(task_data)):
+                    try:
+                        __import__(mod)
+                    except Exception as e:
+                        logger.debug('preload %s for task %s failed: %s', mod, task_id_value, e)
+
+            proc = multiprocessing.Process(target=run_forked_worker,
+                                           args=(conn, name, result_queue, task_id_value, task_data))
+            proc.name = name
+            proc.daemon = True
+            proc.start()
+            workers[task_id_value] = proc
+            conn.send(('started', task_id_value, proc.pid))
+
+        for tid, proc in list(workers.items()):
+            if proc.exitcode is not None:
+                del workers[tid]
+                conn.send(('exited', tid, proc.exitcode))
+
+
+class ForkedWorker(object):
+    """ a task process forked by ForkServer, with pid, exitcode and join()
+        like multiprocessing.Process, though not a child of the executor.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.pid = None
+        self.exitcode = None
+        self.error = None  # why it is lost, if the fork server died before it exited
+        self.started = threading.Event()
+        self.exited = threading.Event()
+
+    def join(self, timeout=None):
+        """ exitcode, None if it has not exited in timeout
+        """
+        self.exited.wait(timeout)
+        return self.exitcode
+
+
+class ForkServer(object):
+    """ a process started once in executor, with the env started and modules imported,
+        which forks processes of tasks, so they do not start cold.
+    """
+
+    def __init__(self, result_queue, preload):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.workers = {}  # task_id.value -> ForkedWorker
+        self.stopping = False
+        self.proc = multiprocessing.Process(target=serve_forks,
+                                            args=(child_conn, self.conn, result_queue, preload))
+        self.proc.name = '[ForkServer]' + Script
+        self.proc.start()
+        child_conn.close()
+        self.thread = spawn(self._receive)
+
+    @property
+    def alive(self):
+        return self.thread.is_alive()
+
+    def _receive(self):
+        while True:
+            try:
+                event, tid, value = self.conn.recv()
+            except (EOFError, OSError):
+                if not self.stopping:
+                    logger.warning('fork server exited unexpectedly')
+                    self._lose_workers('fork server exited')
+                return
+
+            w = self.workers.get(tid)
+            if w is None:
+                continue
+            if event == 'started':
+                w.pid = value
+                w.started.set()
+            else:
+                w.exitcode = value
+                self.workers.pop(tid, None)
+                w.exited.set()
+
+    def _lose_workers(self, error):
+        """ tasks forked by a dead fork server will not be reported, kill and fail them
+        """
+        for tid, w in list(self.workers.items()):
+            if w.pid is not None:
+                try:
+                    os.kill(w.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            w.error = error
+            w.exitcode = -signal.SIGKILL
+            self.workers.pop(tid, None)
+            w.started.set()
+            w.exited.set()
+
+    def fork(self, name, task_id_value, task_data):
+        w = self.workers[task_id_value] = ForkedWorker(name)
+        self.conn.send((name, task_id_value, task_data))
+        if not w.started.wait(FORK_TIMEOUT):
+            self.workers.pop(task_id_value, None)
+            raise RuntimeError('fork server did not start %s in %d secs' % (task_id_value, FORK_TIMEOUT))
+        if w.pid is None:
+            raise RuntimeError(w.error)
+        return w
+
+    def stop(self):
+        self.stopping = True
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.proc.join(KILL_TIMEOUT)
+        if self.proc.is_alive():
+            self.proc.terminate()
+        self._lose_workers('fork server stopped')
+
+
 class LocalizedHTTP(SimpleHTTPServer.SimpleHTTPRequestHandler):
     basedir = None
 
@@ -125,6 +280,41 @@ class LocalizedHTTP(SimpleHTTPServer.SimpleHTTPRequestHandler):
             self, path)
         return self.basedir + '/' + os.path.relpath(out)
 
+    def send_head(self):
+        # support single 'bytes=start-end' range, used by consolidated shuffle output
+        rng = self.headers.get('Range')
+        if not rng or not rng.startswith('bytes='):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+        path = self.translate_path(self.path)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404, "File not found")
+            return None
+
+        size = os.fstat(f.fileno()).st_size
+        try:
+            start, end = rng[len('bytes='):].split('-')
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        except ValueError:
+            f.close()
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+        if start > end:
+            f.close()
+            self.send_error(416, "Requested Range Not Satisfiable")
+            return None
+
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-type", "application/octet-stream")
+        self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        return RangeFile(f, end - start + 1)
+
     def log_message(self, format, *args):
         pass
 
@@ -167,6 +357,20 @@ def terminate(tid, proc):
                     logger.exception('%s terminate fail', name)
 
 
+def exit_reason(tid, ec):
+    """ reason and message to reply for a task process exited with non-zero ec
+    """
+    msg = 'exitcode: {}'.format(ec)
+    if ec == -signal.SIGTERM:
+        return TaskEndReason.recv_sig, msg
+    elif ec == -signal.SIGKILL:
+        return TaskEndReason.recv_sig_kill, msg
+    elif ec == ERROR_TASK_OOM:
+        return TaskEndReason.task_oom, msg
+    logger.warning('%s lost with exit code: %s', tid, ec)
+    return TaskEndReason.other_ecs, msg
+
+
 def get_task_memory(task):
     for r in task.resources:
         if r.name == 'mem':
@@ -290,6 +494,8 @@ class MyExecutor(Executor):
         self._fd_for_locks = []
         self.stdout_redirect = None
         self.stderr_redirect = None
+        self.fork_server = None
+        self.fork_server_failed = False
 
     def check_alive(self, driver):
         try:
@@ -300,11 +506,9 @@ class MyExecutor(Executor):
 
         idle_since = time.time()
 
-        kill_ecs = [-signal.SIGTERM]
-
         while True:
             with self.lock:
-                tasks = self.tasks.items()
+                tasks = list(self.tasks.items())
 
             tids_to_pop = []
             for tid, (task, proc) in tasks:
@@ -314,40 +518,43 @@ class MyExecutor(Executor):
                 reason = None
                 msg = None
 
-                try:
-                    p = psutil.Process(proc.pid)
-                except Exception:
+                if isinstance(proc, ForkedWorker):
+                    # not a child of executor, so no waitpid, the fork server reports its exit
+                    if not proc.exited.is_set() or proc.exitcode == 0:
+                        continue  # running, or handled in replier
                     proc_end = True
+                    if proc.error:
+                        reason, msg = TaskEndReason.other_failure, proc.error
+                    else:
+                        reason, msg = exit_reason(tid, proc.exitcode)
 
-                if proc_end or p.status() == psutil.STATUS_ZOMBIE or (not p.is_running()):
-                    proc.join(TASK_LOST_JOIN_TIMEOUT)  # join in py2 not return exitcode
-                    ec = proc.exitcode
-                    if ec == 0:  # p.status() == psutil.STATUS_ZOMBIE
-                        continue  # handled in replier
-
-                    if ec is not None:
+                else:
+                    try:
+                        p = psutil.Process(proc.pid)
+                    except Exception:
                         proc_end = True
-                        msg = 'exitcode: {}'.format(ec)
-                        if ec in kill_ecs:
-                            reason = TaskEndReason.recv_sig
-                        elif ec == -signal.SIGKILL:
-                            reason = TaskEndReason.recv_sig_kill
-                        elif ec == ERROR_TASK_OOM:
-                            reason = TaskEndReason.task_oom
-                        else:
-                            reason = TaskEndReason.other_ecs
-                            logger.warning('%s lost with exit code: %s', tid, ec)
-                    else:
-                        try:
-                            os.waitpid(proc.pid, os.WNOHANG)
-                        except OSError as e:
+
+                    if proc_end or p.status() == psutil.STATUS_ZOMBIE or (not p.is_running()):
+                        proc.join(TASK_LOST_JOIN_TIMEOUT)  # join in py2 not return exitcode
+                        ec = proc.exitcode
+                        if ec == 0:  # p.status() == psutil.STATUS_ZOMBIE
+                            continue  # handled in replier
+
+                        if ec is not None:
                             proc_end = True
-                            if e.errno != errno.ECHILD:
-                                logger.exception('%s lost, raise exception when waitpid', tid)
+                            reason, msg = exit_reason(tid, ec)
                         else:
-                            t = self.finished_tasks.get(tid)
-                            if t is not None and time.time() - t > TASK_LOST_DISCARD_TIMEOUT:
-                                logger.warning('%s is zombie for %d secs, discard it!', name, TASK_LOST_DISCARD_TIMEOUT)
+                            try:
+                                os.waitpid(proc.pid, os.WNOHANG)
+                            except OSError as e:
+                                proc_end = True
+                                if e.errno != errno.ECHILD:
+                                    logger.exception('%s lost, raise exception when waitpid', tid)
+                            else:
+                                t = self.finished_tasks.get(tid)
+                                if t is not None and time.time() - t > TASK_LOST_DISCARD_TIMEOUT:
+                                    logger.warning('%s is zombie for %d secs, discard it!',
+                                                   name, TASK_LOST_DISCARD_TIMEOUT)
 
                 if proc_end:
                     tids_to_pop.append(tid)
@@ -424,6 +631,11 @@ class MyExecutor(Executor):
             env.workdir.init(dpark_env.get(env.DPARK_ID))
             self._try_flock(env.workdir.main)
             dpark_env['SERVER_URI'] = startWebServer(env.workdir.main)
+            if dpark.conf.SHUFFLE_BLOCK_SERVER:
+                try:
+                    dpark_env[env.SHUFFLE_URI] = start_shuffle_server(env.workdir.main)
+                except Exception as e:
+                    logger.warning('start shuffle server failed, use web server: %s', e)
             if 'MESOS_SLAVE_PID' in os.environ:  # make unit test happy
                 env.workdir.setup_cleaner_process()
 
@@ -473,24 +685,35 @@ class MyExecutor(Executor):
         reply_status(driver, task_id, TaskState.running)
         logger.debug('launch task %s', task.task_id.value)
 
-        def worker(procname, q, task_id_value, task_data):
-            task_id_str = "task %s" % (task_id_value,)
-            threading.current_thread().name = task_id_str
-            setproctitle(procname)
-            set_oom_score(100)
-            env.start_slave()
-            q.put((task_id_value, run_task(task_data)))
-
         try:
             name = '[Task-%s]%s' % (task.task_id.value, Script)
-            proc = multiprocessing.Process(target=worker,
-                                           args=(name,
-                                                 self.result_queue,
-                                                 task.task_id.value,
-                                                 decode_data(task.data),))
-            proc.name = name
-            proc.daemon = True
-            proc.start()
+            task_data = decode_data(task.data)
+            proc = None
+            if dpark.conf.EXECUTOR_FORK_SERVER and not self.fork_server_failed:
+                try:
+                    if self.fork_server is None:
+                        self.fork_server = ForkServer(self.result_queue,
+                                                      dpark.conf.EXECUTOR_FORK_SERVER_PRELOAD)
+                    elif not self.fork_server.alive:
+                        raise RuntimeError('fork server exited')
+                    proc = self.fork_server.fork(name, task.task_id.value, task_data)
+                except Exception as e:
+                    # tasks are forked by executor itself from now on
+                    logger.warning('fork %s from fork server failed: %s', task.task_id.value, e)
+                    self.fork_server_failed = True
+                    if self.fork_server is not None:
+                        self.fork_server.stop()
+                        self.fork_server = None
+
+            if proc is None:
+                proc = multiprocessing.Process(target=run_worker,
+                                               args=(name,
+                                                     self.result_queue,
+                                                     task.task_id.value,
+                                                     task_data,))
+                proc.name = name
+                proc.daemon = True
+                proc.start()
             self.tasks[task.task_id.value] = (task, proc)
 
         except Exception as e:
@@ -510,6 +733,9 @@ class MyExecutor(Executor):
         for tid, (_, proc) in six.iteritems(self.tasks):
             terminate(tid, proc)
         self.tasks = {}
+        if self.fork_server is not None:
+            self.fork_server.stop()
+            self.fork_server = None
         self.result_queue.put(None)
         for fd in self._fd_for_locks:
             os.close(fd)
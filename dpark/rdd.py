@@ -18,6 +18,7 @@ from copy import copy
 import shutil
 import heapq
 import struct
+import array
 import tempfile
 
 try:
@@ -42,10 +43,11 @@ from dpark.utils import (
 from dpark.utils import DparkUserFatalError
 from dpark.utils.log import get_logger
 from dpark.utils.frame import Scope, func_info
-from dpark.shuffle import SortShuffleFetcher, Merger
+from dpark.shuffle import SortShuffleFetcher, Merger, MapOutputTracker
 from dpark.env import env
 from dpark.file_manager import open_file, CHUNKSIZE
 from dpark.utils.beansdb import BeansdbReader, BeansdbWriter
+from dpark.utils.bitindex import Bloomfilter, or_bytes
 from contextlib import closing
 from functools import reduce
 
@@ -170,6 +172,15 @@ class RDD(object):
     def partitioner(self):
         return self._partitioner
 
+    def estimate_size(self):
+        """ bytes of input to compute this rdd, None if not known without running it
+        """
+        return None
+
+    def _prepare(self):
+        """ called on the driver before every job which computes this rdd,
+            to run the jobs it needs besides its dependencies
+        """
 
     @property
     def ui_label(self):
@@ -308,8 +319,11 @@ class RDD(object):
     def fromCsv(self, dialect='excel'):
         return CSVReaderRDD(self, dialect)
 
-    def mapPartitions(self, f):
-        return MapPartitionsRDD(self, f)
+    def mapPartitions(self, f, preservesPartitioning=False):
+        """ preservesPartitioning: f keeps keys of (key, value) items in place,
+            so the result is partitioned as self is.
+        """
+        return MapPartitionsRDD(self, f, preservesPartitioning)
 
     mapPartition = mapPartitions
 
@@ -647,19 +661,42 @@ class RDD(object):
         r.mem += (o_b.bytes * 10) >> 20  # memory used by broadcast obj
         return r
 
-    def join(self, other, numSplits=None, taskMemory=None, fixSkew=-1, rddconf=None):
-        return self._join(other, (), numSplits, taskMemory, fixSkew=fixSkew, rddconf=rddconf)
+    def join(self, other, numSplits=None, taskMemory=None, fixSkew=-1, rddconf=None,
+             bloomFilter=False):
+        return self._join(other, (), numSplits, taskMemory, fixSkew=fixSkew, rddconf=rddconf,
+                          bloomFilter=bloomFilter)
 
-    def leftOuterJoin(self, other, numSplits=None, taskMemory=None, fixSkew=-1, rddconf=None):
-        return self._join(other, (1,), numSplits, taskMemory, fixSkew=fixSkew, rddconf=rddconf)
+    def leftOuterJoin(self, other, numSplits=None, taskMemory=None, fixSkew=-1, rddconf=None,
+                      bloomFilter=False):
+        return self._join(other, (1,), numSplits, taskMemory, fixSkew=fixSkew, rddconf=rddconf,
+                          bloomFilter=bloomFilter)
 
-    def rightOuterJoin(self, other, numSplits=None, taskMemory=None, fixSkew=-1, rddconf=None):
-        return self._join(other, (2,), numSplits, taskMemory, fixSkew=fixSkew, rddconf=rddconf)
+    def rightOuterJoin(self, other, numSplits=None, taskMemory=None, fixSkew=-1, rddconf=None,
+                       bloomFilter=False):
+        return self._join(other, (2,), numSplits, taskMemory, fixSkew=fixSkew, rddconf=rddconf,
+                          bloomFilter=bloomFilter)
 
     def outerJoin(self, other, numSplits=None, taskMemory=None, fixSkew=-1, rddconf=None):
         return self._join(other, (1, 2), numSplits, taskMemory, fixSkew=fixSkew, rddconf=rddconf)
 
-    def _join(self, other, keeps, numSplits=None, taskMemory=None, fixSkew=-1, rddconf=None):
+    def _join(self, other, keeps, numSplits=None, taskMemory=None, fixSkew=-1, rddconf=None,
+              bloomFilter=False):
+        if numSplits is None and taskMemory is None and rddconf is None:
+            r = self._broadcast_join(other, keeps)
+            if r is not None:
+                return r
+
+        left, right = self, other
+        if bloomFilter and 1 in keeps:
+            right = right._semi_join(left)
+        elif bloomFilter and 2 in keeps:
+            left = left._semi_join(right)
+        elif bloomFilter and not keeps:
+            size, other_size = self.estimate_size(), other.estimate_size()
+            if size is not None and other_size is not None and size < other_size:
+                right = right._semi_join(left)
+            else:
+                left = left._semi_join(right)
 
         def dispatch(k_seq):
             (k, seq) = k_seq
@@ -674,8 +711,39 @@ class RDD(object):
                 for ww in wbuf:
                     yield (k, (vv, ww))
 
-        return self.cogroup(other, numSplits, taskMemory, fixSkew=fixSkew, rddconf=rddconf) \
-            .flatMap(dispatch)
+        rdd = left.cogroup(right, numSplits, taskMemory, fixSkew=fixSkew, rddconf=rddconf)
+        if 2 not in keeps and dpark.conf.SKEW_JOIN_SALT > 1:
+            rdd.enable_salt(dpark.conf.SKEW_JOIN_SALT)
+        return rdd.mapPartitions(lambda it: itertools.chain.from_iterable(map(dispatch, it)),
+                                 preservesPartitioning=True)
+
+    def _semi_join(self, other):
+        """ drop records whose keys are not in other, by a bloom filter of its keys
+            built when this rdd is computed first.
+        """
+        return BloomFilteredRDD(self, other)
+
+    def _broadcast_join(self, other, keeps):
+        """ join map side by broadcasting the small side as a hash table collected
+            when the join is computed first, None if neither side is known to be small enough.
+        """
+        limit = dpark.conf.BROADCAST_JOIN_THRESHOLD
+        if limit <= 0 or (1 in keeps and 2 in keeps):
+            return None
+
+        candidates = []
+        if 2 not in keeps:
+            candidates.append((other.estimate_size(), True))
+        if 1 not in keeps:
+            candidates.append((self.estimate_size(), False))
+        candidates = [(size, is_right) for size, is_right in candidates
+                      if size is not None and size <= limit]
+        if not candidates:
+            return None
+
+        size, is_right = min(candidates)
+        small, big = (other, self) if is_right else (self, other)
+        return BroadcastJoinedRDD(big, small, is_right, bool(keeps))
 
     def collectAsMap(self):
         d = {}
@@ -695,8 +763,13 @@ class RDD(object):
 
         _numSplits = numSplits
         if _numSplits is None:
-            if self.partitioner is not None:
-                _numSplits = self.partitioner.numPartitions
+            parts = [rdd.partitioner for rdd in [self] + others if rdd.partitioner is not None]
+            if parts and fixSkew <= 0:
+                # the largest partitioned one is not shuffled again
+                part = max(parts, key=lambda p: p.numPartitions)
+                return CoGroupedRDD([self] + others, part, taskMemory, rddconf=rddconf)
+            elif parts:
+                _numSplits = max(p.numPartitions for p in parts)
             else:
                 _numSplits = self.ctx.defaultParallelism
 
@@ -875,9 +948,13 @@ class RDD(object):
 
 
 class DerivedRDD(RDD):
+    preservesPartitioning = False  # keys of (key, value) items stay in their partitions
+
     def __init__(self, rdd):
         RDD.__init__(self, rdd.ctx)
         self.prev = rdd
+        if self.preservesPartitioning:
+            self._partitioner = rdd.partitioner
         self.mem = max(self.mem, rdd.mem)
         self.cpus = rdd.cpus
         self.gpus = rdd.gpus
@@ -894,6 +971,9 @@ class DerivedRDD(RDD):
     def num_stream(self):
         return self.prev.num_stream()
 
+    def estimate_size(self):
+        return self.prev.estimate_size()
+
     @property
     def splits(self):
         if self._checkpoint_rdd:
@@ -943,6 +1023,9 @@ class MappedRDD(DerivedRDD):
 
 
 class FlatMappedRDD(MappedRDD):
+    def estimate_size(self):
+        return None  # the output may be much larger than the input
+
     def compute(self, split):
         if not self.allow_err:
             return chain(self.func(v) for v in self.prev.iterator(split))
@@ -963,6 +1046,8 @@ class FlatMappedRDD(MappedRDD):
 
 
 class FilteredRDD(MappedRDD):
+    preservesPartitioning = True
+
     def compute(self, split):
         if not self.allow_err:
             return (v for v in self.prev.iterator(split) if self.func(v))
@@ -982,17 +1067,176 @@ class FilteredRDD(MappedRDD):
         self.check_err_rate(total, err, True)
 
 
+class BloomFilteredRDD(DerivedRDD):
+    preservesPartitioning = True
+    CHUNK_BYTES = 1 << 20  # the filter is merged by chunks of this size on executors
+
+    def __init__(self, prev, other):
+        DerivedRDD.__init__(self, prev)
+        self.other = other
+        self.bloomfilter = None  # broadcast, built by _prepare()
+
+    def __getstate__(self):
+        d = dict(RDD.__getstate__(self))
+        d.pop('other', None)
+        return d
+
+    def _prepare(self):
+        if self.bloomfilter is not None:
+            return
+
+        bf = self._build_filter()
+        self.bloomfilter = self.ctx.broadcast(bf)
+        self.mem += self.bloomfilter.bytes >> 20
+        self.other = None
+        self._pickle_cache = None
+
+    def _build_filter(self):
+        """ two jobs over other: count its keys, then set bits of the filter by partitions
+            and merge them by chunks in a shuffle, so the driver only gets one filter.
+        """
+        other = self.other
+        n = max(other.count(), 1)
+        m, k = Bloomfilter.calculate_parameters(n, dpark.conf.BLOOM_JOIN_FPP)
+        max_bits = dpark.conf.BLOOM_JOIN_MAX_BYTES * 8
+        if m > max_bits:
+            m = max_bits
+            k = max(1, int(round(math.log(2) * m / n)))
+            logger.warning('bloom filter of %d keys is limited to %d bytes, '
+                           'false positive rate will be higher than %s',
+                           n, dpark.conf.BLOOM_JOIN_MAX_BYTES, dpark.conf.BLOOM_JOIN_FPP)
+
+        nbytes = (m + 7) >> 3
+        chunk = self.CHUNK_BYTES
+        num_chunks = (nbytes + chunk - 1) // chunk
+
+        def dense(bits):
+            # bits of chunk i are (i, True, bytes) or (i, False, packed offsets in it)
+            i, is_dense, data = bits
+            if is_dense:
+                return data if isinstance(data, bytearray) else bytearray(data)
+            buf = bytearray(min(chunk, nbytes - i * chunk))
+            for off in struct.unpack('<%dI' % (len(data) // 4), data):
+                buf[off >> 3] |= 1 << (off & 7)
+            return buf
+
+        def build(it):
+            # offsets are kept while they are much smaller than the chunk,
+            # so partitions with few keys write few bytes to the shuffle
+            bf = Bloomfilter(m, k)
+            max_offsets = chunk // 16
+            chunks = {}
+            for kv in it:
+                for off in bf._get_offsets(kv[0]):
+                    i = off // (chunk * 8)
+                    off -= i * chunk * 8
+                    bits = chunks.get(i)
+                    if bits is None:
+                        bits = chunks[i] = array.array('I')
+                    elif isinstance(bits, bytearray):
+                        bits[off >> 3] |= 1 << (off & 7)
+                        continue
+                    bits.append(off)
+                    if len(bits) >= max_offsets:
+                        chunks[i] = dense((i, False, struct.pack('<%dI' % len(bits), *bits)))
+            for i, bits in six.iteritems(chunks):
+                if isinstance(bits, bytearray):
+                    yield i, (i, True, bits)
+                else:
+                    yield i, (i, False, struct.pack('<%dI' % len(bits), *bits))
+
+        def merge(a, b):
+            return a[0], True, or_bytes(dense(a), dense(b))
+
+        chunks = other.mapPartitions(build).reduceByKey(merge, num_chunks).collectAsMap()
+        bf = Bloomfilter(m, k)
+        bf.bitindex.array = bytearray().join(
+            dense(chunks.get(i, (i, False, b''))) for i in range(num_chunks))
+        bf.bitindex.size = m
+        logger.info('bloom filter of %s: %d keys in %d bytes, %d hashes', other, n, nbytes, k)
+        return bf
+
+    def compute(self, split):
+        bf = self.bloomfilter.value
+        dropped = 0
+        for kv in self.prev.iterator(split):
+            if kv[0] in bf:
+                yield kv
+            else:
+                dropped += 1
+        env.task_stats.num_bloom_dropped += dropped
+
+
+class BroadcastJoinedRDD(DerivedRDD):
+    """ join prev with a small rdd map side, by a hash table of it collected
+        and broadcast before the first job over this rdd.
+    """
+    preservesPartitioning = True
+
+    def __init__(self, prev, small, is_right, keep):
+        DerivedRDD.__init__(self, prev)
+        self.small = small
+        self.is_right = is_right  # small is the right side of the join
+        self.keep = keep  # keep records of prev without match
+        self.table = None  # broadcast, built by _prepare()
+
+    def __getstate__(self):
+        d = dict(RDD.__getstate__(self))
+        d.pop('small', None)
+        return d
+
+    def estimate_size(self):
+        return None
+
+    def _prepare(self):
+        if self.table is not None:
+            return
+
+        table = {}
+        for k, v in self.small:
+            table.setdefault(k, []).append(v)
+        logger.info('broadcast join: %s with %d keys', self.small, len(table))
+        self.table = self.ctx.broadcast(table)
+        self.mem += (self.table.bytes * 10) >> 20  # memory used by broadcast obj
+        self.small = None
+        self._pickle_cache = None
+
+    def compute(self, split):
+        table = self.table.value
+        for k, v in self.prev.iterator(split):
+            ws = table.get(k)
+            if ws is None:
+                if self.keep:
+                    yield (k, (v, None)) if self.is_right else (k, (None, v))
+            elif self.is_right:
+                for w in ws:
+                    yield (k, (v, w))
+            else:
+                for w in ws:
+                    yield (k, (w, v))
+
+
 class GlommedRDD(DerivedRDD):
     def compute(self, split):
         yield list(self.prev.iterator(split))
 
 
 class MapPartitionsRDD(MappedRDD):
+    def __init__(self, prev, func, preservesPartitioning=False):
+        self.preservesPartitioning = preservesPartitioning
+        MappedRDD.__init__(self, prev, func)
+
+    def estimate_size(self):
+        return None  # the output may be much larger than the input
+
     def compute(self, split):
         return self.func(self.prev.iterator(split))
 
 
 class EnumeratePartitionsRDD(MappedRDD):
+    def estimate_size(self):
+        return None  # the output may be much larger than the input
+
     def compute(self, split):
         return self.func(split.index, self.prev.iterator(split))
 
@@ -1005,6 +1249,9 @@ class PipedRDD(DerivedRDD):
         self.shell = shell
         self.repr_name = '<PipedRDD %s %s>' % (' '.join(command), prev)
 
+    def estimate_size(self):
+        return None
+
     def compute(self, split):
         import subprocess
         devnull = open(os.devnull, 'w')
@@ -1052,9 +1299,7 @@ class PipedRDD(DerivedRDD):
 
 
 class MappedValuesRDD(MappedRDD):
-    @property
-    def partitioner(self):
-        return self.prev.partitioner
+    preservesPartitioning = True
 
     def compute(self, split):
         func = self.func
@@ -1272,6 +1517,7 @@ class CoGroupedRDD(RDD):
         self._partitioner = partitioner
         self.repr_name = ('<CoGrouped of %s>' % (','.join(str(rdd) for rdd in rdds)))[:80]
         self._preferred_locs = {}
+        self.salt = 0
         self.set_rddconf(rddconf)
         self.rddconf.op = dpark.conf.OP_COGROUP
         for rdd in rdds:
@@ -1297,7 +1543,41 @@ class CoGroupedRDD(RDD):
             self._preferred_locs[split] = sum([dep.rdd.preferredLocations(dep.split) for dep in split.deps
                                                if isinstance(dep, NarrowCoGroupSplitDep)], [])
 
+    @property
+    def partitioner(self):
+        # hot keys are salted away from their home partitions
+        return None if self.salt else self._partitioner
+
+    def enable_salt(self, salt):
+        """ spread hot keys of the first rdd over `salt` partitions, and
+            replicate the second rdd's values of them, for inner and left outer join.
+        """
+        n = self._partitioner.numPartitions
+        deps = self._dependencies
+        # tasks have no splits of a narrow dep other than their own to replicate
+        if len(deps) != 2 or not all(isinstance(d, ShuffleDependency) for d in deps) or n < 2:
+            return
+        self.salt = deps[0].salt = min(salt, n)
+
+    def _replicas(self, split):
+        """ {home partition: set(hot keys)} that may be salted into split
+        """
+        if self.salt < 2:
+            return {}
+        n = self._partitioner.numPartitions
+        replicas = {}
+        for k in MapOutputTracker.get_hot_keys(split.deps[0].shuffleId):
+            home = self._partitioner.getPartition(k)
+            if 0 < (split.index - home) % n < self.salt:
+                replicas.setdefault(home, set()).add(k)
+        return replicas
+
+    @staticmethod
+    def _filter_keys(items, keys):
+        return ((k, v) for k, v in items if k in keys)
+
     def _compute_hash_merge(self, split, merger):
+        replicas = self._replicas(split)
         for i, dep in enumerate(split.deps):
             if isinstance(dep, NarrowCoGroupSplitDep):
                 merger.merge(dep.rdd.iterator(dep.split), -1, i)
@@ -1307,6 +1587,28 @@ class CoGroupedRDD(RDD):
                     merger.merge(items, map_id, i)
 
                 env.shuffleFetcher.fetch(dep.shuffleId, split.index, merge)
+                if i == 1:
+                    for home, keys in replicas.items():
+
+                        def merge_replica(items, map_id):
+                            merger.merge(self._filter_keys(items, keys), map_id, i)
+
+                        env.shuffleFetcher.fetch(dep.shuffleId, home, merge_replica)
+
+    def _get_sorted_iters(self, dep, i, split, fetcher, replicas):
+        """ sorted iters of dep in split, with the replicated keys if i == 1,
+            values of narrow dep are grouped.
+        """
+        if isinstance(dep, NarrowCoGroupSplitDep):
+            it = sorted(dep.rdd.iterator(dep.split), key=lambda x: x[0])
+            return [self.aggregator.aggregate_sorted(it)]
+
+        its = fetcher.get_iters(dep.shuffleId, split.index)
+        if i == 1:
+            for home, keys in replicas.items():
+                its.extend(self._filter_keys(it, keys)
+                           for it in fetcher.get_iters(dep.shuffleId, home))
+        return its
 
     def _compute_sort_merge(self, split, merger):
 
@@ -1316,27 +1618,21 @@ class CoGroupedRDD(RDD):
 
         iters = []
         fetcher = SortShuffleFetcher()
+        replicas = self._replicas(split)
         for i, dep in enumerate(split.deps):
-            if isinstance(dep, NarrowCoGroupSplitDep):
-                it = sorted(dep.rdd.iterator(dep.split), key=lambda x: x[0])
-                it = self.aggregator.aggregate_sorted(it)
-                it = _enum_value(it, i)
-                iters.append(it)
-            elif isinstance(dep, ShuffleCoGroupSplitDep):
-                its = fetcher.get_iters(dep.shuffleId, split.index)
-                iters.extend([_enum_value(it, i) for it in its])
+            its = self._get_sorted_iters(dep, i, split, fetcher, replicas)
+            iters.extend([_enum_value(it, i) for it in its])
         merger.merge(iters)
 
     def _compute_sort_merge_iter(self, split, merger):
         iters = []
         fetcher = SortShuffleFetcher()
+        replicas = self._replicas(split)
         for i, dep in enumerate(split.deps):
+            its = self._get_sorted_iters(dep, i, split, fetcher, replicas)
             if isinstance(dep, NarrowCoGroupSplitDep):
-                it = sorted(dep.rdd.iterator(dep.split), key=lambda x: x[0])
-                it = self.aggregator.aggregate_sorted(it)
-                iters.append(it)
+                iters.extend(its)
             elif isinstance(dep, ShuffleCoGroupSplitDep):
-                its = fetcher.get_iters(dep.shuffleId, split.index)
                 rddconf = self.rddconf.dup(op=dpark.conf.OP_GROUPBY)
                 m = Merger.get(rddconf, size=self.size, api_callsite=self.scope.api_callsite)
                 m.merge(its)
@@ -1377,6 +1673,8 @@ class CoGroupedRDD(RDD):
 
 
 class SampleRDD(DerivedRDD):
+    preservesPartitioning = True
+
     def __init__(self, prev, frac, withReplacement, seed):
         DerivedRDD.__init__(self, prev)
         self.frac = frac
@@ -1384,6 +1682,12 @@ class SampleRDD(DerivedRDD):
         self.seed = seed
         self.repr_name = '<SampleRDD(%s) of %s>' % (frac, prev)
 
+    def estimate_size(self):
+        size = self.prev.estimate_size()
+        if size is not None and not self.withReplacement:
+            size = int(size * self.frac)
+        return size
+
     def compute(self, split):
         rd = random.Random(self.seed + split.index)
         if self.withReplacement:
@@ -1426,6 +1730,12 @@ class UnionRDD(RDD):
     def compute(self, split):
         return split.rdd.iterator(split.split)
 
+    def estimate_size(self):
+        sizes = [dep.rdd.estimate_size() for dep in self._dependencies]
+        if None in sizes:
+            return None
+        return sum(sizes)
+
     @property
     def ui_label(self):
         return "{}[{}]({})".format(self.__class__.__name__, len(self), len(self._dependencies))
@@ -1573,6 +1883,10 @@ class ParallelCollection(RDD):
 
         return cPickle.loads(_values)
 
+    def estimate_size(self):
+        return sum(sp.values.bytes if sp.is_broadcast else len(sp.values)
+                   for sp in self._splits)
+
     @classmethod
     def slice(cls, data, numSlices):
         if numSlices <= 0:
@@ -1632,6 +1946,7 @@ class PartialSplit(Split):
 
 class TextFileRDD(RDD):
     DEFAULT_SPLIT_SIZE = 64 * 1024 * 1024
+    EXPAND_RATIO = 1  # of input bytes to bytes read, for compressed files
 
     def __init__(self, ctx, path, numSplits=None, splitSize=None):
         RDD.__init__(self, ctx)
@@ -1675,6 +1990,9 @@ class TextFileRDD(RDD):
     def params(self):
         return self.path
 
+    def estimate_size(self):
+        return self.size * self.EXPAND_RATIO
+
     def open_file(self):
         return open_file(self.path)
 
@@ -1808,6 +2126,7 @@ class PartialTextFileRDD(TextFileRDD):
 class GZipFileRDD(TextFileRDD):
     "the gziped file must be seekable, compressed by pigz -i"
     BLOCK_SIZE = 64 << 10
+    EXPAND_RATIO = 4
     DEFAULT_SPLIT_SIZE = 32 << 20
 
     def __init__(self, ctx, path, splitSize=None):
@@ -1936,6 +2255,7 @@ class GZipFileRDD(TextFileRDD):
 
 class TableFileRDD(TextFileRDD):
     DEFAULT_SPLIT_SIZE = 32 << 20
+    EXPAND_RATIO = 4
 
     def __init__(self, ctx, path, splitSize=None):
         TextFileRDD.__init__(self, ctx, path, None, splitSize)
@@ -1984,6 +2304,7 @@ class BZip2FileRDD(TextFileRDD):
 
     DEFAULT_SPLIT_SIZE = 32 * 1024 * 1024
     BLOCK_SIZE = 9000
+    EXPAND_RATIO = 4
 
     def __init__(self, ctx, path, numSplits=None, splitSize=None):
         TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
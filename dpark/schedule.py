@@ -20,11 +20,12 @@ import dpark.conf as conf
 from dpark.accumulator import Accumulator
 from dpark.dependency import ShuffleDependency
 from dpark.env import env
-from dpark.taskset import TaskSet, TaskCounter
+from dpark.taskset import TaskSet, TaskCounter, MAX_TASK_MEMORY
+from dpark.taskprofile import TaskProfiles
 from dpark.mutable_dict import MutableDict
-from dpark.task import ResultTask, ShuffleMapTask, TTID, TaskState, TaskEndReason
+from dpark.task import ResultTask, ShuffleMapTask, TaskBinary, TTID, TaskState, TaskEndReason
 from dpark.hostatus import TaskHostManager
-from dpark.shuffle import MapOutputTracker
+from dpark.shuffle import MapOutputTracker, compress_size, decompress_sizes
 from dpark.utils import (
     compress, decompress, spawn, getuser,
     sec2nanosec)
@@ -39,6 +40,7 @@ EXECUTOR_CPUS = 0.01
 EXECUTOR_MEMORY = 128  # cache
 POLL_TIMEOUT = 0.1
 RESUBMIT_TIMEOUT = 60
+EVENT_WAIT = 1  # max seconds runJob blocks for an event, so it stays interruptible
 MAX_IDLE_TIME = 60 * 30
 
 
@@ -59,8 +61,19 @@ class Stage(object):
         self.numPartitions = len(rdd)
         self.num_finished = 0  # for final stage
         self.outputLocs = [[] for _ in range(self.numPartitions)]
+        # [bytearray of compress_size() of each partition] of each reduce, shared by
+        # MapOutputTracker and mapOutputs of scheduler once the stage finished
+        self.outputSizes = None
+        if shuffleDep is not None:
+            self.outputSizes = [bytearray(self.numPartitions)
+                                for _ in range(shuffleDep.partitioner.numPartitions)]
+        self.hotKeys = [()] * self.numPartitions  # [(key, share), ...] sampled in each partition
         self.task_stats = [[] for _ in range(self.numPartitions)]
         self.taskcounters = []  # a TaskCounter object for each run/retry
+        # latency added by the scheduler: from a task ended to its event handled
+        self.num_events = 0
+        self.event_delay = 0
+        self.max_event_delay = 0
         self.submit_time = 0
         self.finish_time = 0
         self.pipelines = pipelines  # each pipeline is a list of rdds
@@ -110,6 +123,10 @@ class Stage(object):
     def addOutputLoc(self, partition, host):
         self.outputLocs[partition].append(host)
 
+    def addOutputSizes(self, partition, sizes):
+        for col, size in zip(self.outputSizes, sizes):
+            col[partition] = compress_size(size)
+
     #    def removeOutput(self, partition, host):
     #        prev = self.outputLocs[partition]
     #        self.outputLocs[partition] = [h for h in prev if h != host]
@@ -126,10 +143,20 @@ class Stage(object):
                    "to wait for futher fetch failure")
             logger.info(msg, self, host, RESUBMIT_TIMEOUT)
 
+    def reuseOutputs(self, locs, sizes, hot_keys):
+        self.outputLocs = [list(l) for l in locs]
+        self.outputSizes = sizes
+        self.hotKeys = list(hot_keys)
+
     def finish(self):
         if not self.finish_time:
             self.finish_time = time.time()
 
+    def addEventDelay(self, delay):
+        self.num_events += 1
+        self.event_delay += delay
+        self.max_event_delay = max(self.max_event_delay, delay)
+
     def _summary_stats(self):
         stats = [x[-1] for x in self.task_stats if x]
 
@@ -213,6 +240,9 @@ class Stage(object):
                     unit_s = " MB "
                 msg += (fmt % vs)
                 msg += unit_s
+        if self.num_events:
+            msg += "sched_delay = %.1f/%.1f ms " % (
+                self.event_delay * 1000 / self.num_events, self.max_event_delay * 1000)
         return msg
 
     def _summary_counters(self):
@@ -226,7 +256,12 @@ class Stage(object):
                 "running": self.num_task_running,
                 "finished": self.num_task_finished,
             },
-            "fail": dict([(attr[5:], _sum(attr)) for attr in TaskCounter(0).get_fail_types()])
+            "fail": dict([(attr[5:], _sum(attr)) for attr in TaskCounter(0).get_fail_types()]),
+            "sched": {
+                "events": self.num_events,
+                "delay": self.event_delay,
+                "max_delay": self.max_event_delay,
+            },
         }
         return counters
 
@@ -287,6 +322,29 @@ class Scheduler:
         return 2
 
 
+class Job(object):
+    """ a running job of DAGScheduler.runJob
+    """
+
+    def __init__(self, id, final_rdd, final_stage, scope):
+        self.id = id
+        self.final_rdd = final_rdd
+        self.final_stage = final_stage
+        self.scope = scope
+        self.events = queue.Queue()  # CompletionEvent, StageEvent or None to abort
+        self.stages = set()  # map stages submitted by this job, not finished yet
+        # ids of map stages with outputs of earlier jobs when this job started
+        self.skipped = set(s.id for s in final_stage.get_tree_stages() if s.shuffleDep and s.isAvailable)
+
+
+class StageEvent(object):
+    """ a map stage run by another job finished or was given up by it
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+
 class CompletionEvent:
 
     def __init__(self, task, reason, result, accumUpdates, stats):
@@ -295,6 +353,7 @@ class CompletionEvent:
         self.result = result
         self.accumUpdates = accumUpdates
         self.stats = stats
+        self.time = time.time()
 
 
 def walk_dependencies(rdd, edge_func=lambda r, d: True, node_func=lambda r: True):
@@ -315,9 +374,11 @@ class DAGScheduler(Scheduler):
 
     def __init__(self):
         self.id = self.new_id()
-        self.completionEvents = queue.Queue()
         self.idToStage = weakref.WeakValueDictionary()
-        self.shuffleToMapStage = {}
+        self.shuffleToMapStage = weakref.WeakValueDictionary()
+        # shuffle id -> (locs, sizes, hot keys) of finished map stages, reused by later jobs
+        # until the ShuffleDependency is garbage collected or the scheduler is cleared
+        self.mapOutputs = {}
         self.cacheLocs = {}
         self.idToRunJob = {}
         self.runJobTimes = 0
@@ -327,9 +388,10 @@ class DAGScheduler(Scheduler):
         self.is_dstream = False
         self.current_scope = None
 
-        self.final_lock = threading.RLock()
-        self.final_stage = None
-        self.final_rdd = None
+        # jobs run in threads concurrently, stages and tasks are submitted under dag_lock
+        self.dag_lock = threading.RLock()
+        self.jobs = {}  # job id -> Job
+        self.stageOwners = {}  # map stage -> the job running it
 
     nextId = 0
 
@@ -341,13 +403,18 @@ class DAGScheduler(Scheduler):
     def clear(self):
         self.idToStage.clear()
         self.shuffleToMapStage.clear()
+        self.mapOutputs.clear()
         self.cacheLocs.clear()
 
     def submitTasks(self, tasks):
         raise NotImplementedError
 
     def taskEnded(self, task, reason, result, accumUpdates, stats=None):
-        self.completionEvents.put(
+        job = self.jobs.get(task.job_id)
+        if job is None:
+            logger.debug('drop event of %s from a finished job', task)
+            return
+        job.events.put(
             CompletionEvent(
                 task,
                 reason,
@@ -355,8 +422,16 @@ class DAGScheduler(Scheduler):
                 accumUpdates,
                 stats))
 
-    def abort(self):
-        self.completionEvents.put(None)
+    def abort(self, taskset=None):
+        """ abort the job of taskset, or all jobs
+        """
+        if taskset is not None:
+            jobs = [self.jobs.get(taskset.tasks[0].job_id)]
+        else:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            if job is not None:
+                job.events.put(None)
 
     def getCacheLocs(self, rdd):
         return self.cacheLocs.get(rdd.id, [[] for _ in range(len(rdd))])
@@ -448,9 +523,19 @@ class DAGScheduler(Scheduler):
         stage = self.shuffleToMapStage.get(dep.shuffleId, None)
         if stage is None:
             stage = self.newStage(dep.rdd, dep)
+            outputs = self.mapOutputs.get(dep.shuffleId)
+            if outputs is not None:
+                stage.reuseOutputs(*outputs)
             self.shuffleToMapStage[dep.shuffleId] = stage
         return stage
 
+    def registerMapOutputs(self, stage):
+        dep = stage.shuffleDep
+        if dep.shuffleId not in self.mapOutputs:
+            weakref.finalize(dep, self.mapOutputs.pop, dep.shuffleId, None)
+        self.mapOutputs[dep.shuffleId] = (
+            [list(l) for l in stage.outputLocs], stage.outputSizes, list(stage.hotKeys))
+
     def getMissingParentStages(self, stage):
         missing = set()
 
@@ -469,7 +554,7 @@ class DAGScheduler(Scheduler):
         walk_dependencies(stage.rdd, _)
         return list(missing)
 
-    def get_call_graph(self, final_rdd):
+    def get_call_graph(self, final_rdd, run_scope=None):
         edges = Counter()  # <parent, child > : count
         visited = set()
         to_visit = [final_rdd]
@@ -484,7 +569,7 @@ class DAGScheduler(Scheduler):
                 if dep.rdd.scope.api_callsite_id != r.scope.api_callsite_id:
                     edges[(dep.rdd.scope.api_callsite_id, r.scope.api_callsite_id)] += 1
         nodes = set()
-        run_scope = self.current_scope
+        run_scope = run_scope or self.current_scope
         edges[(final_rdd.scope.api_callsite_id, run_scope.api_callsite_id)] = 1
         for s, d in edges.keys():
             nodes.add(s)
@@ -508,25 +593,29 @@ class DAGScheduler(Scheduler):
 
     def get_profs(self):
         res = [marshal.loads(j) for j in self.jobstats]
-        running = self.get_running_prof()
-        if running:
+        for running in self.get_running_profs():
             res.append(marshal.loads(marshal.dumps(running)))
         return res
 
+    def get_running_profs(self):
+        with self.dag_lock:
+            return [self._get_stats(job) for _, job in sorted(self.jobs.items())]
+
     def get_running_prof(self):
-        if self.final_stage:
-            with self.final_lock:
-                return self._get_stats(self.final_rdd, self.final_stage)
+        profs = self.get_running_profs()
+        return profs[-1] if profs else None
 
     def runJob(self, finalRdd, func, partitions, allowLocal):
-        self.runJobTimes += 1
-        self.current_scope = Scope.get("Job %d:{api}" % (self.runJobTimes, ))
+        with self.dag_lock:
+            self.runJobTimes += 1
+            self.current_scope = Scope.get("Job %d:{api}" % (self.runJobTimes, ))
+            finalStage = self.newStage(finalRdd, None)
+            job = Job(self.runJobTimes, finalRdd, finalStage, self.current_scope)
+            if job.skipped:
+                logger.info('skip stages %s, reuse their map outputs',
+                            ', '.join(map(str, sorted(job.skipped))))
         outputParts = list(partitions)
         numOutputParts = len(partitions)
-        finalStage = self.newStage(finalRdd, None)
-        with self.final_lock:
-            self.final_rdd = finalRdd
-            self.final_stage = finalStage
         try:
             from dpark.web.ui.views.rddopgraph import StageInfo
             stage_info = StageInfo()
@@ -552,17 +641,11 @@ class DAGScheduler(Scheduler):
         waiting = set()
         running = set()
         failed = set()
+        external = set()  # map stages this job waits for, run by other jobs
         pendingTasks = {}  # stage -> set([task_id..])
+        binaries = []  # of stages submitted in this job
         lastFetchFailureTime = 0
 
-        self.updateCacheLocs()
-
-        logger.debug('Final stage: %s, %d', finalStage, numOutputParts)
-        logger.debug('Parents of final stage: %s', finalStage.parents)
-        logger.debug(
-            'Missing parents: %s',
-            self.getMissingParentStages(finalStage))
-
         def onStageFinished(stage):
             def _(r, dep):
                 return r._do_checkpoint()
@@ -571,11 +654,22 @@ class DAGScheduler(Scheduler):
             walk_dependencies(stage.rdd, _)
             logger.info("stage %d finish %s", stage.id, stage.fmt_stats())
 
-        if (allowLocal and
-                (
-                        not finalStage.parents or
-                        not self.getMissingParentStages(finalStage)
-                ) and numOutputParts == 1):
+        with self.dag_lock:
+            self.updateCacheLocs()
+
+            logger.debug('Final stage: %s, %d', finalStage, numOutputParts)
+            logger.debug('Parents of final stage: %s', finalStage.parents)
+            logger.debug(
+                'Missing parents: %s',
+                self.getMissingParentStages(finalStage))
+
+            runLocal = (allowLocal and
+                        (
+                                not finalStage.parents or
+                                not self.getMissingParentStages(finalStage)
+                        ) and numOutputParts == 1)
+
+        if runLocal:
             split = finalRdd.splits[outputParts[0]]
             yield func(finalRdd.iterator(split))
             onStageFinished(finalStage)
@@ -585,7 +679,12 @@ class DAGScheduler(Scheduler):
             if not stage.submit_time:
                 stage.submit_time = time.time()
             logger.debug('submit stage %s', stage)
-            if stage not in waiting and stage not in running:
+            if stage not in waiting and stage not in running and stage not in external:
+                owner = self.stageOwners.get(stage)
+                if owner is not None and owner is not job:
+                    logger.debug('%s is running in job %d', stage, owner.id)
+                    external.add(stage)
+                    return
                 missing = self.getMissingParentStages(stage)
                 if not missing:
                     submitMissingTasks(stage)
@@ -595,173 +694,295 @@ class DAGScheduler(Scheduler):
                         submitStage(parent)
                     waiting.add(stage)
 
+        def submitNewlyRunnable():
+            newlyRunnable = set(
+                stage for stage in waiting
+                if not self.getMissingParentStages(stage)
+            )
+            waiting.difference_update(newlyRunnable)
+            running.update(newlyRunnable)
+            logger.debug(
+                'newly runnable: %s, %s', waiting, newlyRunnable)
+            for stage in newlyRunnable:
+                submitMissingTasks(stage)
+
         def submitMissingTasks(stage):
             myPending = pendingTasks.setdefault(stage, set())
             tasks = []
             have_prefer = True
             if stage == finalStage:
-                for i in range(numOutputParts):
-                    if not finished[i]:
-                        part = outputParts[i]
-                        if have_prefer:
-                            locs = self.getPreferredLocs(finalRdd, part)
-                            if not locs:
-                                have_prefer = False
-                        else:
-                            locs = []
-                        tasks.append(ResultTask(finalStage.id, finalStage.try_id, part, finalRdd,
-                                                func, locs, i))
+                missing = [i for i in range(numOutputParts) if not finished[i]]
+                binary = TaskBinary(finalRdd, func)
+                for group in self.coalescePartitions(stage, missing, [outputParts[i] for i in missing]):
+                    i = group[0]
+                    part = outputParts[i]
+                    if have_prefer:
+                        locs = self.getPreferredLocs(finalRdd, part)
+                        if not locs:
+                            have_prefer = False
+                    else:
+                        locs = []
+                    tasks.append(ResultTask(finalStage.id, finalStage.try_id, part, binary,
+                                            locs, i, [(outputParts[j], j) for j in group[1:]]))
             else:
-                for part in range(stage.numPartitions):
-                    if not stage.outputLocs[part]:
-                        if have_prefer:
-                            locs = self.getPreferredLocs(stage.rdd, part)
-                            if not locs:
-                                have_prefer = False
-                        else:
-                            locs = []
-                        tasks.append(ShuffleMapTask(stage.id, stage.try_id, part, stage.rdd,
-                                                    stage.shuffleDep, locs))
+                missing = [part for part in range(stage.numPartitions) if not stage.outputLocs[part]]
+                binary = TaskBinary(stage.rdd, aggregator=stage.shuffleDep.aggregator)
+                for group in self.coalescePartitions(stage, missing, missing):
+                    part = group[0]
+                    if have_prefer:
+                        locs = self.getPreferredLocs(stage.rdd, part)
+                        if not locs:
+                            have_prefer = False
+                    else:
+                        locs = []
+                    tasks.append(ShuffleMapTask(stage.id, stage.try_id, part, binary,
+                                                stage.shuffleDep, locs, group[1:]))
+                self.stageOwners[stage] = job
+                job.stages.add(stage)
+            for t in tasks:
+                t.job_id = job.id
+            binaries.append(binary)
             logger.debug('add to pending %s tasks', len(tasks))
             myPending |= set(t.id for t in tasks)
             self.submitTasks(tasks)
 
-        submitStage(finalStage)
+        with self.dag_lock:
+            self.jobs[job.id] = job
+            submitStage(finalStage)
 
-        while finalStage.num_finished != numOutputParts:
-            try:
-                evt = self.completionEvents.get(False)
-            except queue.Empty:
-                if (failed and
-                        time.time() > lastFetchFailureTime + RESUBMIT_TIMEOUT):
-                    self.updateCacheLocs()
-                    for stage in failed:
-                        logger.info('Resubmitting failed stages: %s', stage)
-                        submitStage(stage)
-                    failed.clear()
-                else:
-                    time.sleep(0.1)
-                continue
+        try:
+            while finalStage.num_finished != numOutputParts:
+                timeout = EVENT_WAIT
+                if failed:
+                    timeout = lastFetchFailureTime + RESUBMIT_TIMEOUT - time.time()
+                    if timeout <= 0:
+                        with self.dag_lock:
+                            self.updateCacheLocs()
+                            for stage in failed:
+                                logger.info('Resubmitting failed stages: %s', stage)
+                                submitStage(stage)
+                        failed.clear()
+                        continue
+                    timeout = min(timeout, EVENT_WAIT)
+                try:
+                    evt = job.events.get(True, timeout)
+                except queue.Empty:
+                    continue
 
-            if evt is None:  # aborted
-                for taskset in self.active_tasksets.values():
-                    self.tasksetFinished(taskset)
+                if evt is None:  # aborted
+                    for taskset in list(self.active_tasksets.values()):
+                        if taskset.tasks[0].job_id == job.id:
+                            self.tasksetFinished(taskset)
+
+                    if not self.is_dstream:
+                        self._keep_stats(job)
+
+                    raise RuntimeError('TaskSet aborted!')
+
+                ready = []
+                with self.dag_lock:
+                    if isinstance(evt, StageEvent):
+                        stage = evt.stage
+                        if stage in external:
+                            external.remove(stage)
+                            if stage.isAvailable:
+                                submitNewlyRunnable()
+                            else:  # given up by its job
+                                submitStage(stage)
+                        continue
 
-                if not self.is_dstream:
-                    self._keep_stats(finalRdd, finalStage)
+                    task, reason = evt.task, evt.reason
+                    stage = self.idToStage[task.stage_id]
+                    if stage not in pendingTasks:  # stage from other taskset
+                        continue
+                    stage.addEventDelay(time.time() - evt.time)
+                    logger.debug('remove from pending %s from %s', task, stage)
+                    pendingTasks[stage].remove(task.id)
+                    if reason == TaskEndReason.success:
+                        Accumulator.merge(evt.accumUpdates)
+                        stage.task_stats[task.partition].append(evt.stats)
+                        if isinstance(task, ResultTask):
+                            for outputId, result in task.outputs(evt.result):
+                                finished[outputId] = True
+                                finalStage.num_finished += 1
+                                results[outputId] = result
+
+                            while last_finished < numOutputParts and finished[last_finished]:
+                                ready.append(results[last_finished])
+                                results[last_finished] = None
+                                last_finished += 1
+
+                            stage.finish()
+
+                        elif isinstance(task, ShuffleMapTask):
+                            stage = self.idToStage[task.stage_id]
+                            for part, (uri, sizes, hot_keys) in task.outputs(evt.result):
+                                stage.addOutputLoc(part, uri)
+                                stage.addOutputSizes(part, sizes)
+                                stage.hotKeys[part] = hot_keys
+                            if all(stage.outputLocs):
+                                stage.finish()
+                                logger.debug(
+                                    '%s finished; looking for newly runnable stages',
+                                    stage
+                                )
+                                if pendingTasks[stage]:
+                                    logger.warn('dirty stage %d with %d tasks'
+                                                '(select at most 10 tasks:%s) not clean',
+                                                stage.id, len(pendingTasks[stage]),
+                                                str(list(pendingTasks[stage])[:10]))
+                                    del pendingTasks[stage]
+                                onStageFinished(stage)
+                                running.remove(stage)
+                                if stage.shuffleDep is not None:
+                                    MapOutputTracker.set_locs(
+                                        stage.shuffleDep.shuffleId,
+                                        [l[-1] for l in stage.outputLocs])
+                                    MapOutputTracker.set_sizes(
+                                        stage.shuffleDep.shuffleId,
+                                        stage.outputSizes)
+                                    self.reportHotKeys(stage)
+                                    self.registerMapOutputs(stage)
+                                self._releaseStage(job, stage)
+                                self.updateCacheLocs()
+                                submitNewlyRunnable()
+                    elif reason == TaskEndReason.fetch_failed:
+                        exception = evt.result
+                        logger.warning("%s of %s", exception, task)
+                        if stage in running:
+                            waiting.add(stage)
+                            running.remove(stage)
+                        mapStage = self.shuffleToMapStage[exception.shuffleId]
+                        mapStage.removeHost(exception.serverUri)
+                        self.mapOutputs.pop(exception.shuffleId, None)
+                        failed.add(mapStage)
+                        lastFetchFailureTime = time.time()
+                    else:
+                        logger.error(
+                            'task %s failed: %s %s %s',
+                            task,
+                            reason,
+                            type(reason),
+                            reason.message)
+                        raise Exception(reason.message)
 
-                raise RuntimeError('TaskSet aborted!')
+                for result in ready:
+                    yield result
 
-            task, reason = evt.task, evt.reason
-            stage = self.idToStage[task.stage_id]
-            if stage not in pendingTasks:  # stage from other taskset
-                continue
-            logger.debug('remove from pending %s from %s', task, stage)
-            pendingTasks[stage].remove(task.id)
-            if reason == TaskEndReason.success:
-                Accumulator.merge(evt.accumUpdates)
-                stage.task_stats[task.partition].append(evt.stats)
-                if isinstance(task, ResultTask):
-                    finished[task.outputId] = True
-                    finalStage.num_finished += 1
-                    results[task.outputId] = evt.result
-
-                    while last_finished < numOutputParts and finished[last_finished]:
-                        yield results[last_finished]
-                        results[last_finished] = None
-                        last_finished += 1
-
-                    stage.finish()
-
-                elif isinstance(task, ShuffleMapTask):
-                    stage = self.idToStage[task.stage_id]
-                    stage.addOutputLoc(task.partition, evt.result)
-                    if all(stage.outputLocs):
-                        stage.finish()
-                        logger.debug(
-                            '%s finished; looking for newly runnable stages',
-                            stage
-                        )
-                        if pendingTasks[stage]:
-                            logger.warn('dirty stage %d with %d tasks'
-                                        '(select at most 10 tasks:%s) not clean',
-                                        stage.id, len(pendingTasks[stage]),
-                                        str(list(pendingTasks[stage])[:10]))
-                            del pendingTasks[stage]
-                        onStageFinished(stage)
-                        running.remove(stage)
-                        if stage.shuffleDep is not None:
-                            MapOutputTracker.set_locs(
-                                stage.shuffleDep.shuffleId,
-                                [l[-1] for l in stage.outputLocs])
-                        self.updateCacheLocs()
-                        newlyRunnable = set(
-                            stage for stage in waiting
-                            if not self.getMissingParentStages(stage)
-                        )
-                        waiting -= newlyRunnable
-                        running |= newlyRunnable
-                        logger.debug(
-                            'newly runnable: %s, %s', waiting, newlyRunnable)
-                        for stage in newlyRunnable:
-                            submitMissingTasks(stage)
-            elif reason == TaskEndReason.fetch_failed:
-                exception = evt.result
-                if stage in running:
-                    waiting.add(stage)
-                    running.remove(stage)
-                mapStage = self.shuffleToMapStage[exception.shuffleId]
-                mapStage.removeHost(exception.serverUri)
-                failed.add(mapStage)
-                lastFetchFailureTime = time.time()
-            else:
-                logger.error(
-                    'task %s failed: %s %s %s',
-                    task,
-                    reason,
-                    type(reason),
-                    reason.message)
-                raise Exception(reason.message)
-
-        onStageFinished(finalStage)
-
-        if not self.is_dstream:
-            self._keep_stats(finalRdd, finalStage)
-        assert all(finished)
-        with self.final_lock:
-            self.final_stage = None
-            self.final_rdd = None
-        return
+            onStageFinished(finalStage)
+
+            if not self.is_dstream:
+                self._keep_stats(job)
+            assert all(finished)
+        finally:
+            with self.dag_lock:
+                for stage in list(job.stages):
+                    self._releaseStage(job, stage)
+                del self.jobs[job.id]
+            for binary in binaries:
+                binary.clear()
+
+    def _releaseStage(self, job, stage):
+        """ the job no longer runs the map stage, wake up the jobs waiting for it
+        """
+        job.stages.discard(stage)
+        if self.stageOwners.get(stage) is job:
+            del self.stageOwners[stage]
+            for other in self.jobs.values():
+                if other is not job:
+                    other.events.put(StageEvent(stage))
 
     def getPreferredLocs(self, rdd, partition):
         return rdd.preferredLocations(rdd.splits[partition])
 
-    def _keep_stats(self, final_rdd, final_stage):
+    def getInputSizes(self, stage):
+        """ shuffle input bytes of each partition of the stage, None if unknown
+        """
+        if not stage.parents:
+            return None
+        sizes = [0] * stage.numPartitions
+        for parent in stage.parents:
+            if parent.shuffleDep.partitioner.numPartitions != stage.numPartitions:
+                return None
+            if not all(parent.outputLocs):
+                return None
+            for i, col in enumerate(parent.outputSizes):
+                sizes[i] += sum(decompress_sizes(col))
+        return sizes
+
+    def reportHotKeys(self, stage):
+        """ publish keys sampled hot (or salted) in any map task of the stage
+        """
+        shares = {}
+        for hot_keys in stage.hotKeys:
+            for k, share in hot_keys:
+                shares[k] = max(share, shares.get(k, 0))
+        MapOutputTracker.set_hot_keys(stage.shuffleDep.shuffleId, list(shares))
+        if shares:
+            top = sorted(shares.items(), key=lambda x: x[1], reverse=True)[:10]
+            logger.warning("stage %d has %d hot keys, top: %s", stage.id, len(shares),
+                           ', '.join('%r(%.0f%%)' % (k, share * 100) for k, share in top))
+
+    def coalescePartitions(self, stage, ids, parts):
+        """ group adjacent ids whose partitions are tiny, each group runs in one task
+
+        :param ids: outputId (for final stage) or partition of the tasks to submit
+        :param parts: partition of each id
+        """
+        sizes = self.getInputSizes(stage) if conf.COALESCE_REDUCE_PARTITIONS else None
+        if sizes is None:
+            return [[i] for i in ids]
+
+        target = conf.COALESCE_TARGET_SIZE
+        groups = []
+        group, group_size = [], 0
+        for i, part in zip(ids, parts):
+            size = sizes[part]
+            if size > target * 4:
+                logger.warning("partition %d of stage %d has %d MB shuffle input, "
+                               "consider more splits", part, stage.id, size >> 20)
+            if group and (group_size + size > target or len(group) >= conf.COALESCE_MAX_PARTITIONS):
+                groups.append(group)
+                group, group_size = [], 0
+            group.append(i)
+            group_size += size
+        if group:
+            groups.append(group)
+
+        if len(groups) < len(ids):
+            logger.info("coalesce %d partitions of stage %d into %d tasks",
+                        len(ids), stage.id, len(groups))
+        return groups
+
+    def _keep_stats(self, job):
         try:
-            stats = self._get_stats(final_rdd, final_stage)
+            stats = self._get_stats(job)
             self.jobstats.append(marshal.dumps(stats))
             if self.loghub_dir:
-                self._dump_stats(stats)
+                self._dump_stats(stats, job)
         except Exception as e:
             logger.exception("Fail to dump job stats: %s.", e)
 
-    def _dump_stats(self, stats):
-        name = "_".join(map(str, ['sched', self.id, "job", self.runJobTimes])) + ".json"
+    def _dump_stats(self, stats, job):
+        name = "_".join(map(str, ['sched', self.id, "job", job.id])) + ".json"
         path = os.path.join(self.loghub_dir, name)
         logger.info("writing profile to %s", path)
         with open(path, 'w') as f:
             json.dump(stats, f, indent=4)
 
-    def _get_stats(self, final_rdd, final_stage):
-        call_graph = self.fmt_call_graph(self.get_call_graph(final_rdd))
+    def _get_stats(self, job):
+        final_rdd, final_stage = job.final_rdd, job.final_stage
+        call_graph = self.fmt_call_graph(self.get_call_graph(final_rdd, job.scope))
         cmd = '[dpark] ' + \
               os.path.abspath(sys.argv[0]) + ' ' + ' '.join(sys.argv[1:])
 
         stages = sorted([s.get_prof() for s in final_stage.get_tree_stages()],
                         key=lambda x: x['info']['start_time'])
+        for s in stages:
+            s['info']['skipped'] = s['info']['id'] in job.skipped
 
-        sink_scope = self.current_scope
-        sink_id = "SINK_{}_{}".format(self.id, self.runJobTimes)
+        sink_scope = job.scope
+        sink_id = "SINK_{}_{}".format(self.id, job.id)
         sink_node = {
             dag.KW_TYPE: "sink",
             dag.KW_ID: sink_id,
@@ -775,7 +996,7 @@ class DAGScheduler(Scheduler):
         }
         run = {'framework': self.frameworkId,
                'scheduler': self.id,
-               "run": self.runJobTimes,
+               "run": job.id,
                'sink': {
                    "call_site": sink_scope.api_callsite,
                    "node": sink_node,
@@ -835,7 +1056,7 @@ def run_task_in_process(task, tid, environ):
     except KeyboardInterrupt:
         sys.exit(0)
     except Exception as e:
-        return TaskEndReason.other_failure, e
+        return TaskEndReason.other_failure, (task.id, e)
 
 
 class MultiProcessScheduler(LocalScheduler):
@@ -852,7 +1073,8 @@ class MultiProcessScheduler(LocalScheduler):
 
         logger.info('Got a taskset with %d tasks: %s', len(tasks), tasks[0].rdd)
 
-        total, self.finished, start = len(tasks), 0, time.time()
+        # per taskset, tasksets of concurrent jobs share the pool
+        total, finished, start = len(tasks), [0], time.time()
 
         def initializer():
             # when called on subprocess of multiprocessing's Pool,
@@ -872,16 +1094,18 @@ class MultiProcessScheduler(LocalScheduler):
             logger.debug('task end: %s', state)
 
             if state == TaskEndReason.other_failure:
-                logger.warning('task failed: %s', data)
-                self.taskEnded(data.task_id, TaskEndReason.other_failure, result=None, accumUpdates=None)
+                task_id, e = data
+                logger.warning('task %s failed: %s', task_id, e)
+                task = self.tasks.pop(task_id)
+                self.taskEnded(task, TaskEndReason.other_failure, result=None, accumUpdates=None)
                 return
 
             tid, result, update = data
             task = self.tasks.pop(tid)
-            self.finished += 1
+            finished[0] += 1
             logger.info('Task %s finished (%d/%d)        \x1b[1A',
-                        tid, self.finished, total)
-            if self.finished == total:
+                        tid, finished[0], total)
+            if finished[0] == total:
                 logger.info(
                     'TaskSet finished in %.1f seconds' + ' ' * 20,
                     time.time() - start)
@@ -976,6 +1200,8 @@ class MesosScheduler(DAGScheduler):
         self.err_logger = LogReceiver(sys.stderr)
         self.lock = threading.RLock()
         self.task_host_manager = TaskHostManager()
+        self.task_profiles = TaskProfiles(conf.TASK_PROFILE_PATH, conf.TASK_PROFILE_MEM_HEADROOM,
+                                          conf.TASK_PROFILE_MIN_TASKS)
         self.init_tasksets()
 
     def init_tasksets(self):
@@ -1176,7 +1402,14 @@ class MesosScheduler(DAGScheduler):
         rdd = tasks[0].rdd
         assert all(t.rdd is rdd for t in tasks)
 
-        taskset = TaskSet(self, tasks, rdd.cpus or self.cpus, rdd.mem or self.mem,
+        mem = rdd.mem or self.mem
+        # never shrink memory set on the rdd by user, only the default
+        sized = self.task_profiles.suggest_mem(rdd.scope.api_callsite, mem, MAX_TASK_MEMORY,
+                                               keep_mem=bool(rdd.mem))
+        if sized != mem:
+            logger.info('memory of tasks at %s: %d MB from profile, instead of %d MB',
+                        rdd.scope.api_callsite, sized, mem)
+        taskset = TaskSet(self, tasks, rdd.cpus or self.cpus, sized,
                           rdd.gpus, self.task_host_manager)
         self.active_tasksets[taskset.id] = taskset
         stage_scope = ''
@@ -1274,8 +1507,12 @@ class MesosScheduler(DAGScheduler):
         mesos_tasks = {}
         tasks = {}
         max_create_time = 0
-        for taskset in self.active_tasksets.values():
-            while True:
+        # tasksets of concurrent jobs take turns, one taskOffer each round,
+        # the one with fewest running tasks first
+        pending = list(self.active_tasksets.values())
+        while pending:
+            pending.sort(key=lambda ts: ts.counter.running)
+            for taskset in list(pending):
                 host_offers = {}
                 for i, o in enumerate(offers):
                     if self.agent_id_to_ttids.get(o.agent_id.value, 0) >= self.task_per_node:
@@ -1288,7 +1525,8 @@ class MesosScheduler(DAGScheduler):
                     host_offers[o.hostname] = (i, o)
                 assigned_list = taskset.taskOffer(host_offers, cpus, mems, gpus)
                 if not assigned_list:
-                    break
+                    pending.remove(taskset)
+                    continue
 
                 for i, o, t in assigned_list:
                     t0 = time.time()
@@ -1491,6 +1729,8 @@ class MesosScheduler(DAGScheduler):
             del self.active_tasksets[taskset.id]
             if not self.active_tasksets:
                 self.agent_id_to_ttids.clear()
+            if taskset.counter.finished == taskset.counter.n:
+                self.task_profiles.update(taskset.tasks[0].rdd.scope.api_callsite, taskset)
 
     @safe
     def error(self, driver, message):
@@ -1510,6 +1750,7 @@ class MesosScheduler(DAGScheduler):
 
         self.out_logger.stop()
         self.err_logger.stop()
+        self.task_profiles.save()
 
     def defaultParallelism(self):
         return 16
@@ -1,11 +1,14 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys
+import time
 import types
 import marshal
 import types
+import weakref
 import six
 import itertools
+import pickletools
 from collections import deque
 from functools import partial
 from six.moves import range, cPickle
@@ -165,6 +168,82 @@ dump_func = dumps
 load_func = loads
 
 
+_STRING_OPS = ('STRING', 'BINSTRING', 'SHORT_BINSTRING',
+               'UNICODE', 'BINUNICODE', 'SHORT_BINUNICODE', 'BINUNICODE8')
+_BYTES_OPS = ('BINBYTES', 'SHORT_BINBYTES', 'BINBYTES8')
+
+
+def _nested_pickles(data):
+    """ data itself if it is a pickle, or pickles in it if marshaled, as closures are
+    """
+    if data[:1] == PROTO:
+        return [data]
+    try:
+        objs = [marshal.loads(data)]
+    except Exception:
+        return []
+    found = []
+    while objs:
+        o = objs.pop()
+        if isinstance(o, bytes) and o[:1] == PROTO:
+            found.append(o)
+        elif isinstance(o, (tuple, list)):
+            objs.extend(o)
+        elif isinstance(o, dict):
+            objs.extend(o.values())
+    return found
+
+
+def find_modules(s):
+    """ names of modules a pickle imports when loaded, without loading it,
+        including the ones of pickles nested in it as bytes, like TaskBinary.
+    """
+    modules = set()
+    pickles = [s]
+    while pickles:
+        memo = {}
+        strings = []  # values of the last string pushes, for STACK_GLOBAL
+        last = None  # value pushed by the last op, for memoize
+        module_arg = False  # next string is the argument of load_module
+        try:
+            for op, arg, _ in pickletools.genops(pickles.pop()):
+                name = op.name
+                value = None
+                if name in _STRING_OPS:
+                    value = arg
+                elif name in _BYTES_OPS:
+                    pickles.extend(_nested_pickles(arg))
+                elif name in ('GET', 'BINGET', 'LONG_BINGET'):
+                    value = memo.get(arg)
+                elif name in ('PUT', 'BINPUT', 'LONG_BINPUT'):
+                    memo[arg] = last
+                elif name == 'MEMOIZE':
+                    memo[len(memo)] = last
+                elif name in ('GLOBAL', 'STACK_GLOBAL'):
+                    if name == 'GLOBAL':
+                        mod, attr = arg.split(' ', 1)
+                    elif len(strings) == 2:
+                        mod, attr = strings
+                    else:
+                        mod = attr = None
+                    if mod:
+                        modules.add(mod)
+                        module_arg = (mod, attr) == (__name__, 'load_module')
+                        value = None
+
+                if name in ('PUT', 'BINPUT', 'LONG_BINPUT', 'MEMOIZE'):
+                    continue
+                is_string = isinstance(value, six.string_types)
+                if module_arg and is_string:
+                    modules.add(value)
+                    module_arg = False
+                last = value
+                strings = (strings + [value])[-2:] if is_string else []
+        except Exception as e:
+            logger.debug('fail to find modules in pickle: %s', e)
+    return modules
+
+
 def reduce_module(mod):
     return load_module, (mod.__name__,)
 
@@ -190,23 +269,34 @@ class RecursiveFunctionPlaceholder(object):
 RECURSIVE_FUNCTION_PLACEHOLDER = RecursiveFunctionPlaceholder()
 
 
+MARSHAL_SAMPLE_SIZE = 100  # items checked of each object, marshal.dumps fails on the rest
+_MARSHAL_SCALARS = frozenset((type(None), six.binary_type, six.text_type, bool, float, complex)
+                             + six.integer_types)
+_MARSHAL_CONTAINERS = frozenset((tuple, list, set, dict))
+_MARSHAL_TYPES = _MARSHAL_SCALARS | _MARSHAL_CONTAINERS
+
+
+def _flatten(o):
+    return itertools.chain.from_iterable(six.iteritems(o)) if type(o) is dict else o
+
+
 def marshalable(o):
-    if o is None:
-        return True
-    t = type(o)
-    if t in (six.binary_type, six.text_type, bool, int, int, float, complex):
-        return True
-    if t in (tuple, list, set):
-        for i in itertools.islice(o, 100):
-            if not marshalable(i):
-                return False
-        return True
-    if t == dict:
-        for k, v in itertools.islice(six.iteritems(o), 100):
-            if not marshalable(k) or not marshalable(v):
-                return False
-        return True
-    return False
+    """ whether o is probably marshalable, checked level by level on a prefix of each level.
+        callers fall back to pickle when marshal.dumps raises on the rest.
+    """
+    level = [o]
+    limit = MARSHAL_SAMPLE_SIZE
+    for _ in range(32):
+        types_ = set(map(type, level))
+        if types_ <= _MARSHAL_SCALARS:
+            return True
+        if not types_ <= _MARSHAL_TYPES:
+            return False
+        if len(types_) > 1 or dict in types_:
+            level = [_flatten(x) for x in level if type(x) in _MARSHAL_CONTAINERS]
+        level = list(itertools.islice(itertools.chain.from_iterable(level), limit))
+        limit = MARSHAL_SAMPLE_SIZE * 4  # items of all containers in the level
+    return False  # too deep, or recursive
 
 
 OBJECT_SIZE_LIMIT = 100 << 10
@@ -247,7 +337,111 @@ def get_co_names(code):
     return co_names
 
 
+# bytes of dumped closures, reused while all values captured by them are the same objects
+_closure_cache = weakref.WeakKeyDictionary()  # func -> (captured, bytes, secs)
+closure_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'uncacheable': 0,  # capture mutable objects, which may change in place
+    'secs_saved': 0.0,
+}
+
+_IMMUTABLE_TYPES = (type(None), bool, float, complex, six.binary_type, six.text_type,
+                    types.ModuleType) + six.integer_types
+
+
+def _by_name(v):
+    """ whether v is pickled as a reference to a module global
+    """
+    module = getattr(v, '__module__', None)
+    if module is None or module == '__main__':
+        return False
+    mod = sys.modules.get(module)
+    return mod is not None and getattr(mod, getattr(v, '__name__', ''), None) is v
+
+
+def _captured(f, out, seen):
+    """ append all objects captured by f (in globals, cells and defaults, and in
+        functions captured by it) to out. False if any of them is mutable.
+
+        functions are recorded by their code and captured values, never the
+        function objects themselves, or a recursive closure would keep its own
+        cache entry alive.
+    """
+    if f in seen:
+        out.append(seen[f])  # small ints are shared, so `is` still matches
+        return True
+    seen[f] = len(seen)
+    code = f.__code__
+    out.append(code)
+    values = [f.__globals__.get(n) for n in get_co_names(code)]
+    values.extend(f.__defaults__ or ())
+    for c in f.__closure__ or ():
+        try:
+            values.append(c.cell_contents)
+        except ValueError:
+            values.append(None)
+    return all(_capture(v, out, seen) for v in values)
+
+
+_END = object()  # closes the items of a tuple or frozenset
+
+
+def _capture(v, out, seen):
+    from dpark.broadcast import Broadcast
+    if type(v) in (tuple, frozenset):
+        # compared by items, as the container may hold functions
+        out.append(type(v))
+        ok = all(_capture(x, out, seen) for x in v)
+        out.append(_END)
+        return ok
+    if type(v) is types.FunctionType and not _by_name(v):
+        return _captured(v, out, seen)
+    out.append(v)
+    if isinstance(v, _IMMUTABLE_TYPES) or isinstance(v, Broadcast):
+        return True
+    if isinstance(v, types.BuiltinFunctionType):
+        return v.__self__ is None or isinstance(v.__self__, types.ModuleType)
+    if isinstance(v, (type, types.FunctionType)) and _by_name(v):
+        return True
+    return False
+
+
+def closure_cache_info():
+    stats = dict(closure_cache_stats)
+    total = stats['hits'] + stats['misses'] + stats['uncacheable']
+    stats['hit_rate'] = float(stats['hits']) / total if total else 0.0
+    return stats
+
+
 def dump_closure(f, skip=set()):
+    """ memoized _dump_closure(f), unless f captures mutable objects
+    """
+    if skip:
+        return _dump_closure(f, skip)
+
+    captured = []
+    if not _captured(f, captured, {}):
+        closure_cache_stats['uncacheable'] += 1
+        return _dump_closure(f)
+
+    cached = _closure_cache.get(f)
+    if cached is not None:
+        old, data, secs = cached
+        if len(old) == len(captured) and all(a is b for a, b in zip(old, captured)):
+            closure_cache_stats['hits'] += 1
+            closure_cache_stats['secs_saved'] += secs
+            return data
+
+    t = time.time()
+    data = _dump_closure(f)
+    secs = time.time() - t
+    closure_cache_stats['misses'] += 1
+    _closure_cache[f] = (captured, data, secs)
+    return data
+
+
+def _dump_closure(f, skip=set()):
     def _do_dump(f):
         for i, c in enumerate(f.__closure__):
             try:
@@ -3,12 +3,17 @@ from __future__ import print_function
 import os
 import os.path
 import random
+import shutil
+import socket
+import threading
 import six
-from six.moves import urllib, queue, range, zip, reduce, cPickle as pickle
+from six.moves import urllib, queue, range, zip, reduce, socketserver, cPickle as pickle
 import marshal
+import mmap
 import struct
 import time
 import heapq
+import math
 import itertools
 from operator import itemgetter
 from itertools import islice
@@ -20,7 +25,9 @@ except ImportError:
     from six import BytesIO as StringIO
 
 import dpark.conf
-from dpark.utils import compress, decompress, spawn, atomic_file
+from dpark.utils import spawn, atomic_file
+from dpark.utils.crc32c import crc32c
+from dpark.utils.codec import default_codec, get_codec, get_codec_by_id, CODEC_NONE
 from dpark.utils.memory import ERROR_TASK_OOM
 from dpark.utils.log import get_logger
 from dpark.env import env
@@ -41,28 +48,336 @@ F_MAPPING = {
 
 F_MAPPING_R = dict([(v, k) for k, v in F_MAPPING.items()])
 
+# frames with a checksum or of other codecs than the default one use the flag byte
+#   0x80 | has crc << 6 | codec id << 2 | is_marshal << 1 | is_sorted
+# and the crc32c of data follows the length.
+# frames of the default codec without checksum keep the readable flags for older readers.
+F_CODEC = 0x80
+F_CRC = 0x40
+HEAD_SIZE = 5
+CRC = struct.Struct("I")
 
-def pack_header(length, is_marshal, is_sorted):
-    flag = F_MAPPING[(is_marshal, is_sorted)]
-    return flag + struct.pack("I", length)
+# a pickled frame starting with OOB_MAGIC is followed by OOB_COUNT frames of
+# its out-of-band buffers (pickle protocol 5), each compressed on its own.
+OOB_MAGIC = b'\x00'
+OOB_COUNT = struct.Struct("<I")
+PickleBuffer = getattr(pickle, 'PickleBuffer', None)  # python >= 3.8
+
+
+class ChecksumError(IOError):
+    pass
+
+
+def pack_header(length, is_marshal, is_sorted, codec=default_codec, crc=None):
+    if crc is None and codec.id == default_codec.id:
+        flag = F_MAPPING[(is_marshal, is_sorted)]
+    else:
+        flag = six.int2byte(F_CODEC | (F_CRC if crc is not None else 0)
+                            | codec.id << 2 | is_marshal << 1 | is_sorted)
+    head = flag + struct.pack("I", length)
+    if crc is not None:
+        head += CRC.pack(crc)
+    return head
 
 
 def unpack_header(head):
+    """ (length, is_marshal, is_sorted, codec, has_crc) from the first HEAD_SIZE bytes,
+        CRC follows them if has_crc.
+    """
     l = len(head)
-    if l != 5:
+    if l != HEAD_SIZE:
         raise IOError("fetch bad head length %d" % (l,))
-    flag = head[:1]
-    is_marshal, is_sorted = F_MAPPING_R[flag]
+    flag = bytes(head[:1])
+    if flag in F_MAPPING_R:
+        is_marshal, is_sorted = F_MAPPING_R[flag]
+        codec = default_codec
+        has_crc = False
+    else:
+        b = six.byte2int(flag)
+        if not b & F_CODEC:
+            raise IOError("fetch bad head flag %r" % (flag,))
+        is_marshal, is_sorted, has_crc = bool(b & 2), bool(b & 1), bool(b & F_CRC)
+        codec = get_codec_by_id((b & 0x3c) >> 2)
     length, = struct.unpack("I", head[1:5])
-    return length, is_marshal, is_sorted
+    return length, is_marshal, is_sorted, codec, has_crc
+
+
+def write_frame(stream, data, is_marshal, is_sorted, codec=default_codec):
+    """ write compressed data as a frame, return the size of data
+    """
+    crc = crc32c(data) if dpark.conf.SHUFFLE_CHECKSUM else None
+    stream.write(pack_header(len(data), is_marshal, is_sorted, codec, crc))
+    stream.write(data)
+    return len(data)
+
+
+def _read_frame(f, is_buffer=False):
+    head = f.read(HEAD_SIZE)
+    if len(head) == 0:
+        return None
+    length, is_marshal, is_sorted, codec, has_crc = unpack_header(head)
+    frame_size = HEAD_SIZE + length
+    crc = None
+    if has_crc:
+        buf = f.read(CRC.size)
+        if len(buf) < CRC.size:
+            raise IOError("fetch bad crc length %d" % (len(buf),))
+        crc, = CRC.unpack(buf)
+        frame_size += CRC.size
+    if is_buffer and codec.id == CODEC_NONE and hasattr(f, 'readinto'):
+        data = _read_into(f, length)
+    else:
+        data = f.read(length)
+    if len(data) < length:
+        raise IOError("length not match: expected %d, but got %d" % (length, len(data)))
+    if crc is not None and crc32c(data) != crc:
+        raise ChecksumError("crc32c mismatch of %d bytes frame" % (length,))
+    data = codec.decompress(data)
+    if is_buffer and not isinstance(data, bytearray):
+        data = bytearray(data)  # loaded objects own writable memory
+    return is_marshal, is_sorted, data, frame_size
+
+
+def _read_into(f, length):
+    buf = bytearray(length)
+    view = memoryview(buf)
+    n = 0
+    while n < length:
+        r = f.readinto(view[n:])
+        if not r:
+            return buf[:n]
+        n += r
+    return buf
+
+
+def read_frame(f):
+    """ (is_marshal, is_sorted, decompressed data, size of the frame) of the next frame,
+        None at the end of f. Out-of-band buffers following a frame are read with it.
+    """
+    frame = _read_frame(f)
+    if frame is None:
+        return None
+    is_marshal, is_sorted, data, frame_size = frame
+    if is_marshal or data[:1] != OOB_MAGIC:
+        return frame
+
+    n, = OOB_COUNT.unpack_from(data, 1)
+    buffers = []
+    for _ in range(n):
+        frame = _read_frame(f, True)
+        if frame is None:
+            raise IOError("%d of %d out-of-band buffers missing" % (n - len(buffers), n))
+        buffers.append(frame[2])
+        frame_size += frame[3]
+    return is_marshal, is_sorted, OOBData(data, buffers), frame_size
+
+
+class OOBData(object):
+    """ pickled data with its out-of-band buffers
+    """
+
+    def __init__(self, data, buffers):
+        self.data = memoryview(data)[1 + OOB_COUNT.size:]
+        self.buffers = buffers
+
+    def __len__(self):
+        return len(self.data) + sum(len(b) for b in self.buffers)
+
+    def loads(self):
+        return pickle.loads(self.data, buffers=self.buffers)
+
+
+def _from_buffer(buf):
+    return buf
+
+
+class _LargeBuffer(object):
+    """ bytes or bytearray to be pickled out of band, the pickler never lets them
+        reach reducer_override
+    """
+    __slots__ = ['obj']
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __reduce_ex__(self, protocol):
+        if type(self.obj) is bytes:
+            return bytes, (PickleBuffer(self.obj),)
+        return _from_buffer, (PickleBuffer(self.obj),)  # loaded as the bytearray buffer
+
+
+def _wrap_large_buffers(seq, threshold, depth):
+    """ seq with bytes and bytearray of at least threshold bytes wrapped in _LargeBuffer,
+        looking into nested tuples and lists down to depth, seq itself if none found
+    """
+    wrapped = None
+    for i, x in enumerate(seq):
+        t = type(x)
+        if t is bytes or t is bytearray:
+            if len(x) < threshold:
+                continue
+            x = _LargeBuffer(x)
+        elif depth and (t is tuple or t is list):
+            y = _wrap_large_buffers(x, threshold, depth - 1)
+            if y is x:
+                continue
+            x = y
+        else:
+            continue
+        if wrapped is None:
+            wrapped = list(seq)
+        wrapped[i] = x
+    if wrapped is None:
+        return seq
+    return tuple(wrapped) if type(seq) is tuple else wrapped
+
+
+def pickle_frames(items, codec):
+    """ (size before compression, [compressed data of each frame]) of pickled items,
+        buffers of at least conf.SHUFFLE_OOB_BUFFER_SIZE bytes written in frames of their own.
+    """
+    threshold = dpark.conf.SHUFFLE_OOB_BUFFER_SIZE
+    if not threshold or PickleBuffer is None:
+        data = pickle.dumps(items, -1)
+        return len(data), [codec.compress(data)]
+
+    buffers = []
+
+    def buffer_callback(buf):
+        if buf.raw().nbytes < threshold:
+            return True  # in band
+        buffers.append(buf)
+
+    f = six.BytesIO()
+    f.write(OOB_MAGIC + OOB_COUNT.pack(0))
+    pickle.Pickler(f, 5, buffer_callback=buffer_callback).dump(
+        _wrap_large_buffers(items, threshold, 2))  # items of (key, value or [values])
+    if not buffers:
+        data = f.getvalue()[1 + OOB_COUNT.size:]
+        return len(data), [codec.compress(data)]
+
+    data = f.getbuffer()
+    OOB_COUNT.pack_into(data, 1, len(buffers))
+    raws = [b.raw() for b in buffers]
+    size = len(data) - 1 - OOB_COUNT.size + sum(r.nbytes for r in raws)
+    return size, [codec.compress(data)] + [codec.compress(r) for r in raws]
+
+
+def load_items(buf, is_marshal):
+    if is_marshal:
+        return marshal.loads(buf)
+    if isinstance(buf, OOBData):
+        return buf.loads()
+    return pickle.loads(buf)
+
+
+INDEX_ENTRY = struct.Struct("<Q")
+
+
+def pack_index(offsets):
+    return struct.pack("<%dQ" % len(offsets), *offsets)
+
+
+def unpack_index_range(buf):
+    """(offset, length) of a bucket from its two consecutive index entries"""
+    if len(buf) != INDEX_ENTRY.size * 2:
+        raise IOError("fetch bad index length %d" % (len(buf),))
+    start, end = struct.unpack("<2Q", buf)
+    return start, end - start
+
+
+class RangeFile(object):
+    """ Read at most `length` bytes from a file object
+    """
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remain = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remain:
+            size = self.remain
+        if size == 0:
+            return b''
+        buf = self.f.read(size)
+        self.remain -= len(buf)
+        return buf
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+
+class MappedFile(object):
+    """ Read a range of a local file via mmap.
 
+        On python 3 read() returns memoryview of the mapped pages, no copy.
+    """
+
+    def __init__(self, path, offset=0, length=None):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if length is None:
+                length = size - offset
+            if offset + length > size:
+                raise IOError("range %d-%d out of %s (%d)" % (offset, offset + length, path, size))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if length else None
+        self.buf = memoryview(self.mm) if (six.PY3 and self.mm is not None) else self.mm
+        self.pos = offset
+        self.end = offset + length
+
+    def read(self, size=-1):
+        end = self.end if size < 0 else min(self.pos + size, self.end)
+        if end <= self.pos:
+            return b''
+        buf = self.buf[self.pos:end]
+        self.pos = end
+        return buf
+
+    def close(self):
+        if self.mm is None:
+            return
+        mm, self.mm, self.buf = self.mm, None, None
+        try:
+            mm.close()
+        except BufferError:
+            pass  # views still in use, unmapped by gc
+
+
+def skip_stream(f, n, url):
+    while n > 0:
+        skipped = len(f.read(min(n, 1 << 20)))
+        if not skipped:
+            f.close()
+            raise IOError("fetch %d bytes short of %s" % (n, url))
+        n -= skipped
+
+
+def open_range(url, offset, length):
+    if url.startswith('file://'):
+        f = open(url[len('file://'):], 'rb')
+        f.seek(offset)
+        return RangeFile(f, length)
+
+    req = urllib.request.Request(url)
+    req.add_header('Range', 'bytes=%d-%d' % (offset, offset + length - 1))
+    f = urllib.request.urlopen(req)
+    if f.code != 206:
+        # server ignores Range, skip to the offset
+        logger.debug("no range support for %s", url)
+        skip_stream(f, offset, url)
+    return RangeFile(f, length)
+
+
+def write_buf(stream, buf, is_marshal, codec=default_codec):
+    return write_frame(stream, codec.compress(buf), is_marshal, True, codec) + HEAD_SIZE
 
-def write_buf(stream, buf, is_marshal):
-    buf = compress(buf)
-    size = len(buf)
-    stream.write(pack_header(size, is_marshal, True))
-    stream.write(buf)
-    return size + 4
+
+def write_frames(stream, frames, is_marshal, codec=default_codec):
+    """ write compressed data of frames from pickle_frames, return the size written
+    """
+    return sum(write_frame(stream, data, is_marshal, True, codec) + HEAD_SIZE
+               for data in frames)
 
 
 class AutoBatchedSerializer(object):
@@ -72,8 +387,10 @@ class AutoBatchedSerializer(object):
 
     size_loaded = 0
 
-    def __init__(self, best_size=1 << 17):
+    def __init__(self, best_size=1 << 17, codec=default_codec):
         self.best_size = best_size
+        self.codec = codec
+        self.raw_size = 0  # bytes before compression, dumped or loaded
         self.max_num = 0
         self.max_size = 0
         self.use_marshal = True
@@ -82,22 +399,14 @@ class AutoBatchedSerializer(object):
 
     def load_stream(self, stream):
         while True:
-            head = stream.read(5)
-            if not head:
+            frame = read_frame(stream)
+            if frame is None:
                 return
-            length, is_marshal, is_sorted = unpack_header(head)
+            is_marshal, is_sorted, buf, _ = frame
             assert (is_sorted)
-            buf = stream.read(length)
-            if len(buf) < length:
-                raise IOError("length not match: expected %d, but got %d" % (length, len(buf)))
-
-            buf = decompress(buf)
             AutoBatchedSerializer.size_loaded += len(buf)
-            if is_marshal:
-                vs = marshal.loads(buf)
-            else:
-                vs = pickle.loads(buf)
-            for v in vs:
+            self.raw_size += len(buf)
+            for v in load_items(buf, is_marshal):
                 yield v
 
     def dump_stream(self, iterator, stream):
@@ -115,17 +424,20 @@ class AutoBatchedSerializer(object):
             batch_num = self._dump_batch(stream, vs, batch_num)
 
     def _dump_batch(self, stream, vs, batch_num):
+        buf = None
         if self.use_marshal:
             try:
                 buf = marshal.dumps(vs)
             except:
-                buf = pickle.dumps(vs, -1)
                 self.use_marshal = False
-        else:
-            buf = pickle.dumps(vs, -1)
 
-        mem_size = len(buf)
-        self.file_size += write_buf(stream, buf, self.use_marshal)
+        if buf is not None:
+            mem_size = len(buf)
+            self.file_size += write_buf(stream, buf, True, self.codec)
+        else:
+            mem_size, frames = pickle_frames(vs, self.codec)
+            self.file_size += write_frames(stream, frames, False, self.codec)
+        self.raw_size += mem_size
 
         if mem_size < self.best_size:
             batch_num *= 2
@@ -176,11 +488,28 @@ class GroupByAutoBatchedSerializer(AutoBatchedSerializer):
             batch_num = self._dump_batch(stream, k_vs, batch_num)
 
 
-def get_serializer(rddconf):
+def get_shuffle_codec(rddconf):
+    return get_codec(rddconf.codec or dpark.conf.SHUFFLE_CODEC)
+
+
+def get_serializer(rddconf, codec=None):
+    """ :param codec: Codec to dump with, by get_shuffle_codec if None
+    """
+    if codec is None:
+        codec = get_shuffle_codec(rddconf)
     if rddconf.iter_group and (rddconf.is_groupby or rddconf.is_cogroup):
-        return GroupByAutoBatchedSerializer()
+        return GroupByAutoBatchedSerializer(codec=codec)
     else:
-        return AutoBatchedSerializer()
+        return AutoBatchedSerializer(codec=codec)
+
+
+def get_spill_serializer(rddconf=None):
+    """ serializer of local spill files, by conf.SPILL_CODEC
+    """
+    codec = get_codec(dpark.conf.SPILL_CODEC)
+    if rddconf is None:
+        return AutoBatchedSerializer(codec=codec)
+    return get_serializer(rddconf, codec)
 
 
 def fetch_with_retry(f):
@@ -189,7 +518,8 @@ def fetch_with_retry(f):
 
     @wraps(f)
     def _(self):
-        self.num_batch_done = 0
+        # f resumes from offset_done, the frame being read when failed,
+        # and num_batch_done of it are skipped
         while True:
             try:
                 for items in islice(f(self), self.num_batch_done, None):
@@ -201,8 +531,8 @@ def fetch_with_retry(f):
                 break
             except Exception as e:
                 self.num_retry += 1
-                msg = "Fetch failed for url %s, tried %d/%d times. Exception: %s. " % (
-                self.url, self.num_retry, MAX_RETRY, e)
+                msg = "Fetch failed for block %s at offset %d of url %s, tried %d/%d times. Exception: %s. " % (
+                    self.block, self.offset_done, self.url, self.num_retry, MAX_RETRY, e)
                 fail_fast = False
                 emsg = str(e)
                 if any([emsg.find(s) >= 0 for s in ["404"]]):
@@ -212,7 +542,8 @@ def fetch_with_retry(f):
                 if fail_fast or self.num_retry >= MAX_RETRY:
                     logger.warning(msg)
                     from dpark.task import FetchFailed
-                    raise FetchFailed(self.uri, self.sid, self.mid, self.rid)
+                    raise FetchFailed(self.uri, self.sid, self.mid, self.rid,
+                                      reason='%s at offset %d' % (e, self.offset_done))
                 else:
                     sleep_time = RETRY_INTERVALS[self.num_retry - 1]
                     msg += "sleep %d secs" % (sleep_time,)
@@ -230,74 +561,132 @@ class RemoteFile(object):
         self.sid = shuffle_id
         self.mid = map_id
         self.rid = reduce_id
-        self.url = ShuffleWorkDir(shuffle_id, map_id, reduce_id).restore(uri)
+        self.consolidated = dpark.conf.SHUFFLE_CONSOLIDATE
+        if self.consolidated:
+            self.url = ShuffleWorkDir(shuffle_id, map_id, ShuffleWorkDir.DATA).restore(uri)
+            self.index_url = ShuffleWorkDir(shuffle_id, map_id, ShuffleWorkDir.INDEX).restore(uri)
+        else:
+            self.url = ShuffleWorkDir(shuffle_id, map_id, reduce_id).restore(uri)
         logger.debug("fetch %s", self.url)
 
         self.num_retry = 0
-        self.num_batch_done = 0
-
-    def open(self):
-        f = urllib.request.urlopen(self.url)
+        self.offset_done = 0  # start of the frame being read
+        self.num_batch_done = 0  # batches or items yielded from it
+        self.size = None  # expected size of the block, if known
+
+    @property
+    def block(self):
+        return self.sid, self.mid, self.rid
+
+    def open(self, skip=0):
+        """ (stream, size) of the block from skip bytes on
+        """
+        if self.uri.startswith('tcp://') and self.uri != env.shuffle_uri:
+            return block_client.open_block(self.uri, self.block, skip)
+
+        if self.consolidated:
+            return self._open_range(skip)
+
+        if self.url.startswith('file://'):
+            f = MappedFile(self.url[len('file://'):], skip)
+            return f, f.end - skip
+
+        req = urllib.request.Request(self.url)
+        if skip:
+            req.add_header('Range', 'bytes=%d-' % (skip,))
+        f = urllib.request.urlopen(req)
         if f.code == 404:
             f.close()
             raise IOError("not found")
         exp_size = int(f.headers['content-length'])
+        if skip and f.code != 206:
+            skip_stream(f, skip, self.url)
+            exp_size -= skip
         return f, exp_size
 
+    def _open_range(self, skip=0):
+        f = open_range(self.index_url, self.rid * INDEX_ENTRY.size, INDEX_ENTRY.size * 2)
+        try:
+            offset, length = unpack_index_range(f.read())
+        finally:
+            f.close()
+        offset, length = offset + skip, length - skip
+        if length <= 0:
+            return RangeFile(None, 0), 0
+        if self.url.startswith('file://'):
+            return MappedFile(self.url[len('file://'):], offset, length), length
+        return open_range(self.url, offset, length), length
+
     @fetch_with_retry
     def unsorted_batches(self):
         f = None
         # TEST_RETRY = True
         try:
-            f, exp_size = self.open()
-            total_size = 0
-
-            while True:
-                head = f.read(5)
-                if len(head) == 0:
-                    break
-                length, is_marshal, is_sorted = unpack_header(head)
-                assert (not is_sorted)
-                total_size += length + 5
-                d = f.read(length)
-                if length != len(d):
-                    raise IOError(
-                        "length not match: expected %d, but got %d" %
-                        (length, len(d)))
-                d = decompress(d)
-                if is_marshal:
-                    items = marshal.loads(d)
-                else:
-                    try:
-                        items = pickle.loads(d)
-                    except:
-                        time.sleep(1)
-                        items = pickle.loads(d)
-                yield items
-
-                # if TEST_RETRY and self.num_retry == 0:
-                #    raise Exception("test_retry")
-
-            if total_size != exp_size:
-                raise IOError(
-                    "fetch size not match: expected %d, but got %d" %
-                    (exp_size, total_size))
-
-            env.task_stats.bytes_fetch += exp_size
+            f, exp_size = self.open(self.offset_done)
+            for batch in self.load_batches(f, exp_size):
+                yield batch
         finally:
             if f:
                 f.close()
 
+    def frames(self, f, exp_size):
+        """ yield (is_marshal, is_sorted, decompressed data) of each frame in f,
+            which starts at offset_done of the block.
+        """
+        pos = start = self.offset_done
+        while True:
+            frame = read_frame(f)
+            if frame is None:
+                break
+            is_marshal, is_sorted, data, size = frame
+            if pos != self.offset_done:
+                # the last frame is done
+                self.offset_done, self.num_batch_done = pos, 0
+            pos += size
+            yield is_marshal, is_sorted, data
+
+        if pos - start != exp_size:
+            raise IOError(
+                "fetch size not match: expected %d, but got %d" %
+                (exp_size, pos - start))
+
+    def load_batches(self, f, exp_size):
+        """ yield (items, decompressed size) of each batch
+        """
+        raw_size = 0
+        for is_marshal, is_sorted, d in self.frames(f, exp_size):
+            assert (not is_sorted)
+            raw_size += len(d)
+            if is_marshal:
+                items = marshal.loads(d)
+            else:
+                try:
+                    items = load_items(d, is_marshal)
+                except:
+                    time.sleep(1)
+                    items = load_items(d, is_marshal)
+            yield items, len(d)
+
+            # if TEST_RETRY and self.num_retry == 0:
+            #    raise Exception("test_retry")
+
+        env.task_stats.bytes_fetch += exp_size
+        env.task_stats.bytes_fetch_raw += raw_size
+
     @fetch_with_retry
     def sorted_items(self):
         f = None
         try:
-            serializer = AutoBatchedSerializer()
+            raw_size = 0
             self.num_open += 1
-            f, exp_size = self.open()
-            for obj in serializer.load_stream(f):
-                yield obj
+            f, exp_size = self.open(self.offset_done)
+            for is_marshal, is_sorted, d in self.frames(f, exp_size):
+                assert (is_sorted)
+                raw_size += len(d)
+                for obj in load_items(d, is_marshal):
+                    yield obj
             env.task_stats.bytes_fetch += exp_size
+            env.task_stats.bytes_fetch_raw += raw_size
         finally:
             # rely on GC to close if generator not exhausted
             # so Fetcher must not be an attr of RDD
@@ -318,7 +707,12 @@ class ShuffleFetcher(object):
     @classmethod
     def get_remote_files(cls, shuffle_id, reduce_id):
         uris = cls._get_uris(shuffle_id)
-        return [RemoteFile(uri, shuffle_id, map_id, reduce_id) for map_id, uri in uris]
+        files = [RemoteFile(uri, shuffle_id, map_id, reduce_id) for map_id, uri in uris]
+        sizes = MapOutputTracker.get_sizes(shuffle_id, reduce_id)
+        if len(sizes) == len(files):
+            for f in files:
+                f.size = sizes[f.mid]
+        return files
 
     def fetch(self, shuffle_id, reduce_id, merge_func):
         raise NotImplementedError
@@ -333,12 +727,48 @@ class SimpleShuffleFetcher(ShuffleFetcher):
         logger.debug(
             "Fetching outputs for shuffle %d, reduce %d",
             shuffle_id, reduce_id)
-        for f in self.get_remote_files():
-            for items in f.unsorted_batches():
-                merge_func(items)
+        for f in self.get_remote_files(shuffle_id, reduce_id):
+            for items, _ in f.unsorted_batches():
+                merge_func(items, f.mid)
+
+
+class FetchBudget(object):
+    """ Limit the decompressed bytes fetched but not merged yet
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        if self.limit <= 0:
+            return
+        with self.cond:
+            # always let one batch in, even if it is larger than the limit
+            while self.used > 0 and self.used + size > self.limit:
+                self.cond.wait()
+            self.used += size
+
+    def release(self, size):
+        if self.limit <= 0:
+            return
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+    def reset(self):
+        with self.cond:
+            self.used = 0
+            self.cond.notify_all()
 
 
 class ParallelShuffleFetcher(SimpleShuffleFetcher):
+    """ Fetch blocks in threads, the largest first.
+
+        Decoded batches wait in a queue for the merger, bounded by
+        conf.SHUFFLE_FETCH_BUDGET bytes, or by count if it is 0.
+    """
 
     def __init__(self, nthreads):
         self.nthreads = nthreads
@@ -349,53 +779,104 @@ class ParallelShuffleFetcher(SimpleShuffleFetcher):
             return
 
         self._started = True
-        self.requests = queue.Queue()
-        self.results = queue.Queue(self.nthreads)
+        self.budget = FetchBudget(dpark.conf.SHUFFLE_FETCH_BUDGET)
+        self.requests = queue.PriorityQueue()
+        self.results = queue.Queue(0 if self.budget.limit > 0 else self.nthreads)
+        self.seq = itertools.count()
         self.threads = [spawn(self._fetch_thread)
                         for i in range(self.nthreads)]
 
-    def _fetch_thread(self):
-        from dpark.task import FetchFailed
+    def _put_request(self, r, size):
+        # unknown size goes after the known ones, in order
+        self.requests.put((-(size or 0), next(self.seq), r))
 
+    def _fetch_thread(self):
         while True:
-            f = self.requests.get()
-            if f is None:
+            _, _, r = self.requests.get()
+            if r is None:
                 break
-            try:
-                for items in f.unsorted_batches():
-                    if not self._started:
-                        break
-                    self.results.put((items, f.mid))
-                if not self._started:
-                    break
+            files = r if isinstance(r, list) else [r]
+            done = self._fetch_batch(files) if len(files) > 1 else 0
+            if not all(self._fetch_file(f) for f in files[done:]):
+                break
+
+    def _put_result(self, items, map_id, size):
+        self.budget.acquire(size)
+        if not self._started:
+            return False
+        self.results.put((items, map_id, size))
+        return True
+
+    def _fetch_batch(self, files):
+        """ fetch all blocks from one host in one request,
+            return the number of files fully read, the others are left to _fetch_file.
+        """
+        uri = files[0].uri
+        done = 0
+        try:
+            for _, stream, length in block_client.fetch(uri, [f.block for f in files]):
+                f = files[done]
+                for items, size in f.load_batches(stream, length):
+                    if not self._put_result(items, f.mid, size):
+                        return done
+                    f.num_batch_done += 1
                 self.results.put(1)
-            except FetchFailed as e:
-                if not self._started:
-                    break
+                done += 1
+        except Exception as e:
+            logger.warning("batched fetch from %s failed after %d/%d blocks: %s, fetch one by one",
+                           uri, done, len(files), e)
+        return done
+
+    def _fetch_file(self, f):
+        from dpark.task import FetchFailed
+
+        try:
+            for items, size in f.unsorted_batches():
+                if not self._put_result(items, f.mid, size):
+                    return False
+            if not self._started:
+                return False
+            self.results.put(1)
+            return True
+        except FetchFailed as e:
+            if self._started:
                 self.results.put(e)
-                break
+            return False
 
     def fetch(self, shuffle_id, reduce_id, merge_func):
         self.start()
         files = self.get_remote_files(shuffle_id, reduce_id)
+        # blocks on the same shuffle server are fetched in one request
+        by_host = {}
         for f in files:
-            self.requests.put(f)
+            if f.uri.startswith('tcp://') and f.uri != env.shuffle_uri:
+                by_host.setdefault(f.uri, []).append(f)
+            else:
+                self._put_request(f, f.size)
+        for group in by_host.values():
+            self._put_request(group, sum(f.size or 0 for f in group))
 
         t = time.time()
+        secs_wait = 0
         from dpark.task import FetchFailed
         num_done = 0
         while num_done < len(files):
+            t1 = time.time()
             r = self.results.get()
+            secs_wait += time.time() - t1
             if r == 1:
                 num_done += 1
             elif isinstance(r, FetchFailed):
                 self.stop()
                 raise r
             else:
-                items, map_id = r
+                items, map_id, size = r
                 merge_func(items, map_id)
+                self.budget.release(size)
 
         env.task_stats.secs_fetch = time.time() - t
+        env.task_stats.secs_fetch_wait += secs_wait
+        env.task_stats.secs_fetch_merge += env.task_stats.secs_fetch - secs_wait
 
     def stop(self):
         if not self._started:
@@ -406,7 +887,8 @@ class ParallelShuffleFetcher(SimpleShuffleFetcher):
         while not self.requests.empty():
             self.requests.get_nowait()
         for i in range(self.nthreads):
-            self.requests.put(None)
+            self._put_request(None, -1)
+        self.budget.reset()
 
         N = 5
         for _ in range(N):
@@ -469,7 +951,7 @@ class SortedItemsOnDisk(object):
             if not isinstance(items, list):
                 items = list(items)
             items.sort(key=itemgetter(0))
-            serializer = get_serializer(rddconf)
+            serializer = get_spill_serializer(rddconf)
             serializer.dump_stream(items, f)
             self.size = f.tell()
             self.num_batch = serializer.num_batch
@@ -683,7 +1165,7 @@ class OrderedCoGroupDiskHashMerger(CoGroupDiskHashMerger):
     def _merge(self, items, map_id, dep_id, use_disk, meminfo, mem_limit):
         combined = self.combined
         if map_id < 0:
-            self.upstreams.append(dep_id)
+            self.direct_upstreams.append(dep_id)
             for k, v in items:
                 t = combined.get(k)
                 if t is None:
@@ -764,7 +1246,7 @@ class SortMerger(Merger):
 
     def _disk_merge_sorted(self, iters):
         t = time.time()
-        s = AutoBatchedSerializer()
+        s = get_spill_serializer()
         iters = iter(iters)
         while True:
             batch = list(islice(iters, 100))
@@ -776,7 +1258,7 @@ class SortMerger(Merger):
             self.paths.append(path)
             env.task_stats.num_fetch_rotate += 1
 
-        files = [s.load_stream(open(p)) for p in self.paths]
+        files = [s.load_stream(open(p, 'rb')) for p in self.paths]
         env.task_stats.secs_fetch = time.time() - t
         return self._merge_sorted(files)
 
@@ -806,6 +1288,216 @@ class IterCoGroupSortMerger(SortMerger):
         return cogroup_no_dup(list(map(iter, iters)))
 
 
+# shuffle block service
+#   request: 4 bytes length + marshaled list of (shuffle_id, map_id, reduce_id[, skip bytes])
+#   response: for each block, 1 byte status + 8 bytes length + data
+# connections are kept alive for following requests.
+
+BLOCK_OK = 0
+BLOCK_NOT_FOUND = 1
+REQUEST_HEAD = struct.Struct("!I")
+BLOCK_HEAD = struct.Struct("!BQ")
+
+
+def read_exact(f, size):
+    buf = f.read(size)
+    if len(buf) != size:
+        raise IOError("connection closed: expected %d, but got %d" % (size, len(buf)))
+    return buf
+
+
+def locate_block(root, shuffle_id, map_id, reduce_id):
+    """ return (path, offset, length) of a block under root, in either layout
+    """
+    base = os.path.join(root, str(shuffle_id), str(map_id))
+    index_path = os.path.join(base, ShuffleWorkDir.INDEX)
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            f.seek(reduce_id * INDEX_ENTRY.size)
+            offset, length = unpack_index_range(f.read(INDEX_ENTRY.size * 2))
+        return os.path.join(base, ShuffleWorkDir.DATA), offset, length
+
+    path = os.path.join(base, str(reduce_id))
+    return path, 0, os.path.getsize(path)
+
+
+def valid_block(block):
+    """ (shuffle_id, map_id, reduce_id[, skip]) of ints >= 0, so it can not reach
+        files out of the shuffle dir, or bytes out of the block
+    """
+    return (isinstance(block, (list, tuple)) and 3 <= len(block) <= 4
+            and all(isinstance(x, six.integer_types) and not isinstance(x, bool) and x >= 0
+                    for x in block))
+
+
+class ShuffleBlockHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            head = self.rfile.read(REQUEST_HEAD.size)
+            if len(head) < REQUEST_HEAD.size:
+                break
+            size, = REQUEST_HEAD.unpack(head)
+            blocks = marshal.loads(read_exact(self.rfile, size))
+            if not isinstance(blocks, (list, tuple)):
+                logger.warning("bad shuffle block request from %s", self.client_address)
+                break
+            for block in blocks:
+                if valid_block(block):
+                    self.send_block(*block)
+                else:
+                    logger.warning("bad shuffle block %r from %s", block, self.client_address)
+                    self.wfile.write(BLOCK_HEAD.pack(BLOCK_NOT_FOUND, 0))
+            self.wfile.flush()
+
+    def send_block(self, shuffle_id, map_id, reduce_id, skip=0):
+        try:
+            path, offset, length = locate_block(self.server.root, shuffle_id, map_id, reduce_id)
+            offset, length = offset + skip, max(length - skip, 0)
+            f = open(path, 'rb')
+        except (IOError, OSError) as e:
+            logger.warning("shuffle block %s/%s/%s not found: %s", shuffle_id, map_id, reduce_id, e)
+            self.wfile.write(BLOCK_HEAD.pack(BLOCK_NOT_FOUND, 0))
+            return
+
+        with f:
+            f.seek(offset)
+            self.wfile.write(BLOCK_HEAD.pack(BLOCK_OK, length))
+            rf = RangeFile(f, length)
+            shutil.copyfileobj(rf, self.wfile)
+            if rf.remain:
+                # can not keep the stream framed any more
+                raise IOError("shuffle block %s truncated" % (path,))
+
+
+class ShuffleServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root):
+        socketserver.ThreadingTCPServer.__init__(self, ('0.0.0.0', 0), ShuffleBlockHandler)
+        self.root = root
+
+
+def start_shuffle_server(path):
+    """ serve shuffle blocks under path, return uri of the server
+    """
+    server = ShuffleServer(path)
+    spawn(server.serve_forever)
+    return 'tcp://%s:%d/%s' % (socket.gethostname(), server.server_address[1],
+                               os.path.basename(path))
+
+
+class BlockFile(object):
+
+    def __init__(self, stream, blocks):
+        self.stream = stream
+        self.blocks = blocks
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        if self.stream.remain:
+            self.blocks.close()  # drop the connection
+        else:
+            next(self.blocks, None)  # reuse the connection
+
+
+class ShuffleBlockClient(object):
+    """ keep-alive connections to shuffle servers, shared by fetch threads
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = {}
+
+    def _get_conn(self, addr):
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked, connections belong to parent
+                self.pid = os.getpid()
+                self.idle = {}
+            conns = self.idle.get(addr)
+            if conns:
+                return conns.pop()
+        return socket.create_connection(addr)
+
+    def _put_conn(self, addr, conn):
+        with self.lock:
+            if self.pid == os.getpid():
+                self.idle.setdefault(addr, []).append(conn)
+                return
+        conn.close()
+
+    def fetch(self, uri, blocks):
+        """ yield (block, stream, length) for each of blocks, in order.
+            each stream must be read before the next one.
+        """
+        host, port = urllib.parse.urlparse(uri).netloc.split(':')
+        addr = (host, int(port))
+        conn = self._get_conn(addr)
+        f = None
+        ok = False
+        try:
+            req = marshal.dumps(list(blocks))
+            conn.sendall(REQUEST_HEAD.pack(len(req)) + req)
+            f = conn.makefile('rb')
+            for block in blocks:
+                status, length = BLOCK_HEAD.unpack(read_exact(f, BLOCK_HEAD.size))
+                if status != BLOCK_OK:
+                    raise IOError("404 block %s not found on %s" % (block, uri))
+                stream = RangeFile(f, length)
+                yield block, stream, length
+                while stream.read(1 << 16):
+                    pass
+            ok = True
+        finally:
+            if f is not None:
+                f.close()
+            if ok:
+                self._put_conn(addr, conn)
+            else:
+                conn.close()
+
+    def open_block(self, uri, block, skip=0):
+        """ (stream, length) of block from skip bytes on
+        """
+        blocks = self.fetch(uri, [tuple(block) + (skip,) if skip else block])
+        _, stream, length = next(blocks)
+        return BlockFile(stream, blocks), length
+
+
+block_client = ShuffleBlockClient()
+
+
+SIZE_LOG_BASE = 1.1
+
+
+def compress_size(size):
+    """ size of a shuffle block as one byte, at most 10% larger when decompressed
+    """
+    if size <= 0:
+        return 0
+    if size == 1:
+        return 1
+    return min(255, int(math.ceil(math.log(size) / math.log(SIZE_LOG_BASE))))
+
+
+def decompress_size(b):
+    return int(SIZE_LOG_BASE ** b) if b else 0
+
+
+_decompressed_sizes = [decompress_size(b) for b in range(256)]
+
+
+def decompress_sizes(data):
+    """ sizes from bytes of compress_size()
+    """
+    return [_decompressed_sizes[b] for b in bytearray(data)]
+
+
 class MapOutputTracker(object):
 
     @classmethod
@@ -820,6 +1512,43 @@ class MapOutputTracker(object):
     @classmethod
     def get_locs(cls, shuffle_id):
         key = cls.get_key(shuffle_id)
+        return cls._get(key)
+
+    @classmethod
+    def get_sizes_key(cls, shuffle_id, reduce_id):
+        return 'shuffle_sizes:{}:{}'.format(shuffle_id, reduce_id)
+
+    @classmethod
+    def set_sizes(cls, shuffle_id, sizes):
+        """ sizes: [bytearray of compress_size() of each map] of each reduce,
+            kept by reference, not copied
+        """
+        for reduce_id, col in enumerate(sizes):
+            env.trackerServer.set(cls.get_sizes_key(shuffle_id, reduce_id), col)
+
+    @classmethod
+    def get_sizes(cls, shuffle_id, reduce_id):
+        """ [size of reduce_id in each map], [] if unknown
+        """
+        col = cls._get(cls.get_sizes_key(shuffle_id, reduce_id))
+        return decompress_sizes(col[0]) if col else []
+
+    @classmethod
+    def get_hot_keys_key(cls, shuffle_id):
+        return 'shuffle_hot:{}'.format(shuffle_id)
+
+    @classmethod
+    def set_hot_keys(cls, shuffle_id, keys):
+        env.trackerServer.set(cls.get_hot_keys_key(shuffle_id), keys)
+
+    @classmethod
+    def get_hot_keys(cls, shuffle_id):
+        """ keys sampled hot or salted by any map task, [] if none
+        """
+        return cls._get(cls.get_hot_keys_key(shuffle_id))
+
+    @classmethod
+    def _get(cls, key):
         if env.trackerServer:
             return env.trackerServer.get(key)
         else:
@@ -827,6 +1556,9 @@ class MapOutputTracker(object):
 
 
 class ShuffleWorkDir(object):
+    # output_id of consolidated map output
+    DATA = 'data'
+    INDEX = 'index'
 
     def __init__(self, shuffle_id, input_id, output_id):
         self.subpath = os.path.join(str(shuffle_id), str(input_id), str(output_id))
@@ -842,7 +1574,7 @@ class ShuffleWorkDir(object):
         return env.workdir.export(tmppath, self.subpath)
 
     def restore(self, uri):
-        if uri == env.server_uri:
+        if uri in (env.server_uri, env.shuffle_uri):
             # urllib can open local file
             url = 'file://' + self.get()
         else:
@@ -2,20 +2,33 @@ from __future__ import absolute_import
 import marshal
 import time
 import six
-from six.moves import range, cPickle
+from six.moves import range
 import os
 import os.path
+import shutil
+import itertools
+import uuid
+from collections import OrderedDict
+from operator import itemgetter
 
 import dpark.conf
 from dpark.env import env
-from dpark.utils import compress, DparkUserFatalError
+from dpark.broadcast import Broadcast
+from dpark.utils import DparkUserFatalError
+from dpark.utils.hotcounter import HotCounter
 from dpark.utils.memory import ERROR_TASK_OOM
 from dpark.utils.log import get_logger
 from dpark.serialize import marshalable, load_func, dump_func, dumps, loads
-from dpark.shuffle import get_serializer, Merger, pack_header, ShuffleWorkDir
+from dpark.shuffle import (
+    get_serializer, get_shuffle_codec, Merger, MappedFile, pack_index, write_frame, ShuffleWorkDir,
+    pickle_frames
+)
 
 logger = get_logger(__name__)
 
+BYPASS_BATCH_SIZE = 1024  # uncombined records per batch of a reduce
+BINARY_CACHE_SIZE = 16  # loaded task binaries kept in a process, not shared by processes
+
 
 class TTID(object):
     """"Task Try ID
@@ -70,6 +83,7 @@ class DAGTask(object):
         self.stage_id = stage_id
         self.taskset_id = taskset_id
         self.partition = partition
+        self.job_id = None  # set by DAGScheduler.runJob
         self.num_try = 0
         self.reason_next = TaskReason.first
         self.tries = {}
@@ -123,80 +137,178 @@ class DAGTask(object):
         raise NotImplementedError
 
 
-class ResultTask(DAGTask):
-    def __init__(self, stage_id, taskset_id, partition, rdd, func, locs, outputId):
-        DAGTask.__init__(self, stage_id, taskset_id, partition)
+class TaskBinary(object):
+    """ rdd and functions shared by all tasks of a stage, pickled once for them,
+        sent by broadcast if larger than conf.TASK_BINARY_BROADCAST_SIZE,
+        and loaded once per process.
+
+        The cache is per process, so it helps local and process mode and coalesced
+        tasks. Executors run each task in a new process, which loads it again.
+    """
+    _loaded = OrderedDict()  # id -> (rdd, func, aggregator)
+
+    def __init__(self, rdd, func=None, aggregator=None):
+        self.id = str(uuid.uuid4())
         self.rdd = rdd
         self.func = func
+        self.aggregator = aggregator
+        data = (dumps(rdd),
+                dump_func(func) if func is not None else None,
+                dumps(aggregator))
+        self.size = sum(len(d) for d in data if d)
+        if self.size > dpark.conf.TASK_BINARY_BROADCAST_SIZE:
+            data = Broadcast(data)
+        self._state = self.id, data
+
+    def __getstate__(self):
+        return self._state
+
+    def __setstate__(self, state):
+        self._state = state
+        self.id, data = state
+        loaded = self._loaded.pop(self.id, None)
+        if loaded is None:
+            if isinstance(data, Broadcast):
+                data = data.value
+            rdd, func, aggregator = data
+            loaded = loads(rdd), func and load_func(func), loads(aggregator)
+            while len(self._loaded) >= BINARY_CACHE_SIZE:
+                self._loaded.popitem(last=False)
+        self._loaded[self.id] = loaded
+        self.rdd, self.func, self.aggregator = loaded
+
+    def clear(self):
+        """ release the broadcast, after all tasks of the stage finished
+        """
+        if isinstance(self._state[1], Broadcast):
+            self._state[1].clear()
+
+
+class ResultTask(DAGTask):
+    def __init__(self, stage_id, taskset_id, partition, binary, locs, outputId, coalesced=()):
+        """
+        :param binary: TaskBinary of the rdd and func of the stage
+        :param coalesced: [(partition, outputId), ...], tiny partitions run in this task after the first one
+        """
+        DAGTask.__init__(self, stage_id, taskset_id, partition)
+        self.binary = binary
+        rdd = binary.rdd
         self.split = rdd.splits[partition]
         self.locs = locs
         self.outputId = outputId
+        self.coalesced = list(coalesced)
+        self.coalesced_splits = [rdd.splits[p] for p, _ in self.coalesced]
+
+    @property
+    def rdd(self):
+        return self.binary.rdd
+
+    @property
+    def func(self):
+        return self.binary.func
 
     def _run(self, task_id):
         logger.debug("run task %s: %s", task_id, self)
         t0 = time.time()
         res = self.func(self.rdd.iterator(self.split))
+        if self.coalesced:
+            res = [res] + [self.func(self.rdd.iterator(split)) for split in self.coalesced_splits]
         env.task_stats.secs_all = time.time() - t0
         return res
 
+    def outputs(self, result):
+        """ [(outputId, result), ...] of all partitions in the task
+        """
+        if not self.coalesced:
+            return [(self.outputId, result)]
+        return list(zip([self.outputId] + [o for _, o in self.coalesced], result))
+
     def preferredLocations(self):
         return self.locs
 
     def __repr__(self):
         partition = getattr(self, 'partition', None)
-        rdd = getattr(self, 'rdd', None)
-        return "<ResultTask(%s) of %s" % (partition, rdd)
+        binary = getattr(self, 'binary', None)
+        return "<ResultTask(%s) of %s" % (partition, binary and binary.rdd)
 
     def __getstate__(self):
         d = dict(self.__dict__)
-        del d['func']
-        del d['rdd']
         del d['split']
-        return d, dumps(self.rdd), dump_func(self.func), dumps(self.split)
+        del d['coalesced_splits']
+        return d, dumps((self.split, self.coalesced_splits))
 
     def __setstate__(self, state):
-        d, rdd, func, split = state
+        d, splits = state
         self.__dict__.update(d)
-        self.rdd = loads(rdd)
-        self.func = load_func(func)
-        self.split = loads(split)
+        self.split, self.coalesced_splits = loads(splits)
 
 
 class ShuffleMapTask(DAGTask):
-    def __init__(self, stage_id, taskset_id, partition, rdd, dep, locs):
+    def __init__(self, stage_id, taskset_id, partition, binary, dep, locs, coalesced=()):
+        """
+        :param binary: TaskBinary of the rdd and the aggregator of dep
+        :param coalesced: [partition, ...], tiny partitions run in this task after the first one
+        """
         DAGTask.__init__(self, stage_id, taskset_id, partition)
-        self.rdd = rdd
+        self.binary = binary
+        rdd = binary.rdd
         self.shuffleId = dep.shuffleId
-        self.aggregator = dep.aggregator
         self.partitioner = dep.partitioner
         self.rddconf = dep.rddconf
+        self.salt = dep.salt
         self.split = rdd.splits[partition]
         self.locs = locs
+        self.coalesced = list(coalesced)
+        self.coalesced_splits = [rdd.splits[p] for p in self.coalesced]
+
+    @property
+    def rdd(self):
+        return self.binary.rdd
+
+    @property
+    def aggregator(self):
+        return self.binary.aggregator
 
     def __repr__(self):
         shuffleId = getattr(self, 'shuffleId', None)
         partition = getattr(self, 'partition', None)
-        rdd = getattr(self, 'rdd', None)
-        return '<ShuffleTask(%s, %s) of %s>' % (shuffleId, partition, rdd)
+        binary = getattr(self, 'binary', None)
+        return '<ShuffleTask(%s, %s) of %s>' % (shuffleId, partition, binary and binary.rdd)
 
     def __getstate__(self):
         d = dict(self.__dict__)
-        del d['rdd']
         del d['split']
-        return d, dumps(self.rdd), dumps(self.split)
+        del d['coalesced_splits']
+        return d, dumps((self.split, self.coalesced_splits))
 
     def __setstate__(self, state):
-        d, rdd, split = state
+        d, splits = state
         self.__dict__.update(d)
-        self.rdd = loads(rdd)
-        self.split = loads(split)
+        self.split, self.coalesced_splits = loads(splits)
 
     def preferredLocations(self):
         return self.locs
 
+    def outputs(self, result):
+        """ [(partition, (uri, sizes, hot_keys)), ...] of all partitions in the task
+        """
+        if not self.coalesced:
+            return [(self.partition, result)]
+        return list(zip([self.partition] + self.coalesced, result))
+
     def _run(self, task_id):
-        mem_limit = env.meminfo.mem_limit_soft
         t0 = time.time()
+        res = self._run_split(self.partition, self.split)
+        if self.coalesced:
+            res = [res] + [self._run_split(p, split)
+                           for p, split in zip(self.coalesced, self.coalesced_splits)]
+        env.task_stats.secs_all = time.time() - t0
+        return res
+
+    def _run_split(self, partition, split):
+        """ dump map output of the split, return (uri, sizes of each reduce, hot keys)
+        """
+        mem_limit = env.meminfo.mem_limit_soft
         logger.debug("run task with shuffle_flag %r" % (self.rddconf,))
         rdd = self.rdd
         meminfo = env.meminfo
@@ -204,13 +316,24 @@ class ShuffleMapTask(DAGTask):
         get_partition = self.partitioner.getPartition
         merge_value = self.aggregator.mergeValue
         create_combiner = self.aggregator.createCombiner
-        dumper_cls = SortMergeBucketDumper if self.rddconf.sort_merge else BucketDumper
-        dumper = dumper_cls(self.shuffleId, self.partition, n, self.rddconf)
-        buckets = [{} for _ in range(n)]
+        if self.rddconf.sort_merge:
+            dumper = SortBufferDumper(self.shuffleId, partition, n, self.rddconf, self.aggregator)
+            sort_buffer = dumper.buffer
+            buckets = [{}]
+        else:
+            dumper = BucketDumper(self.shuffleId, partition, n, self.rddconf)
+            sort_buffer = None
+            buckets = [{} for _ in range(n)]
         env.meminfo.ratio = min(float(n) / (n + 1), env.meminfo.ratio)
+        sampler = HotKeySampler(self.salt) if dpark.conf.SKEW_HOT_KEY_SHARE > 0 else None
+        sample_interval = max(dpark.conf.SKEW_SAMPLE_INTERVAL, 1)
+        salted = sampler.salted if sampler else {}
+        # sorted output is combined when spilled
+        combine_check = dpark.conf.MAP_COMBINE_CHECK if sort_buffer is None else 0
+        batches = None  # [[(k, combiner), ...] of each reduce] after combining is bypassed
 
         last_i = 0
-        for i, item in enumerate(rdd.iterator(self.split)):
+        for i, item in enumerate(rdd.iterator(split)):
             try:
                 try:
                     k, v = item
@@ -218,12 +341,29 @@ class ShuffleMapTask(DAGTask):
                     msg = "item of {} should be (k, v) pair, got: {}, exception: {}".format(rdd.scope.key, item, e)
                     raise DparkUserFatalError(msg)
 
-                bucket = buckets[get_partition(k)]
-                r = bucket.get(k, None)
-                if r is not None:
-                    bucket[k] = merge_value(r, v)
+                if sampler is not None and i % sample_interval == 0:
+                    sampler.add(k)
+                p = get_partition(k)
+                if salted and k in salted:
+                    p = (p + sampler.next_salt(k)) % n
+                if sort_buffer is not None:
+                    sort_buffer.append((p, k, v))
+                elif batches is not None:
+                    batch = batches[p]
+                    batch.append((k, create_combiner(v)))
+                    if len(batch) >= BYPASS_BATCH_SIZE:
+                        dumper.append(p, batch)
+                        batches[p] = []
                 else:
-                    bucket[k] = create_combiner(v)
+                    bucket = buckets[p]
+                    r = bucket.get(k, None)
+                    if r is not None:
+                        bucket[k] = merge_value(r, v)
+                    else:
+                        bucket[k] = create_combiner(v)
+
+                    if i + 1 == combine_check and self._bypass_combine(buckets, i + 1 - last_i):
+                        batches = [[] for _ in range(n)]
 
                 if dpark.conf.MULTI_SEGMENT_DUMP and meminfo.rss > mem_limit:
                     _log = logger.info if dpark.conf.LOG_ROTATE else logger.debug
@@ -233,8 +373,13 @@ class ShuffleMapTask(DAGTask):
                          int(meminfo.rss) >> 20,
                          mem_limit >> 20,
                          int(meminfo.mem) >> 20)
+                    if batches is not None:
+                        for p, batch in enumerate(batches):
+                            if batch:
+                                dumper.append(p, batch)
+                                batches[p] = []
                     dumper.dump(buckets, False)
-                    [buckets[j].clear() for j in range(n)]
+                    [bucket.clear() for bucket in buckets]
                     env.meminfo.after_rotate()
                     mem_limit = env.meminfo.mem_limit_soft
                     last_i = i
@@ -243,16 +388,68 @@ class ShuffleMapTask(DAGTask):
                 raise
 
         t1 = time.time()
+        if batches is not None:
+            for p, batch in enumerate(batches):
+                if batch:
+                    dumper.append(p, batch)
         dumper.dump(buckets, True)
         dumper.commit(self.aggregator)
         del buckets
         env.task_stats.bytes_dump += dumper.get_size()
+        env.task_stats.bytes_dump_raw += dumper.raw_size
         env.task_stats.num_dump_rotate += 1
-        t = time.time()
-        env.task_stats.secs_dump += t - t1
-        env.task_stats.secs_all = t - t0
+        env.task_stats.secs_dump += time.time() - t1
+
+        return env.shuffle_uri, dumper.sizes, sampler.hot_keys() if sampler else []
+
+    def _bypass_combine(self, buckets, num_records):
+        num_keys = sum(len(b) for b in buckets)
+        if num_keys <= num_records * dpark.conf.MAP_COMBINE_BYPASS_RATIO:
+            return False
+        logger.info("%d distinct keys in %d records of %s, bypass map side combine",
+                    num_keys, num_records, self)
+        return True
 
-        return env.server_uri
+
+class HotKeySampler(object):
+    """ Count sampled keys of a map task, and spread the keys hot so far
+        over `salt` partitions if salt > 1.
+    """
+    CHECK_INTERVAL = 1024  # samples
+
+    def __init__(self, salt):
+        self.salt = salt
+        self.share = dpark.conf.SKEW_HOT_KEY_SHARE
+        self.counter = HotCounter()
+        self.num_samples = 0
+        self.salted = {}  # key -> next salt
+
+    def add(self, key):
+        self.counter.add(key)
+        self.num_samples += 1
+        if self.salt > 1 and self.num_samples % self.CHECK_INTERVAL == 0:
+            for k, _ in self._hot():
+                if k not in self.salted:
+                    logger.debug("salt hot key %r over %d partitions", k, self.salt)
+                    self.salted[k] = 0
+
+    def next_salt(self, key):
+        s = self.salted[key]
+        self.salted[key] = (s + 1) % self.salt
+        return s
+
+    def _hot(self):
+        limit = self.share * self.num_samples
+        return [(k, c) for k, c in self.counter.top(10) if c > limit]
+
+    def hot_keys(self):
+        """ [(key, share of samples)], including all salted keys
+        """
+        hot = dict(self._hot())
+        for k in self.salted:
+            hot.setdefault(k, 0)
+        n = float(max(self.num_samples, 1))
+        return [(k, c / n) for k, c in hot.items()]
 
 
 class BucketDumperBase(object):
@@ -265,32 +462,88 @@ class BucketDumperBase(object):
         self.paths = [ShuffleWorkDir(self.shuffle_id, self.map_id, i) for i in range(num_reduce)]
 
         self.tmp_paths = [[] for _ in range(n)]  # last one is used for export
+        self.batches = [[] for _ in range(n)]  # prepared uncombined batches to dump
         # stats
         self.sizes = [0 for _ in range(n)]
+        self.raw_size = 0  # before compression
         self.num_dump = 0
+        self.codec = get_shuffle_codec(rddconf)
+
+        # consolidated output: one data file and the offsets of each reduce in it
+        self.consolidate = dpark.conf.SHUFFLE_CONSOLIDATE
+        self.data_path = None
+        self.offsets = None
 
     def get_size(self):
         return sum(self.sizes)
 
     def dump(self, buckets, is_final):
         t = time.time()
-        for i, bucket_dict in enumerate(buckets):
-            if not bucket_dict:
-                continue
-            items = six.iteritems(bucket_dict)
-            data, exp_size = self._prepare(items)
-            tmppath = self._get_tmp(i, is_final, exp_size)
-            logger.debug("dump %s", tmppath)
-            size = self._dump_bucket(data, tmppath)
-            self.sizes[i] += size
+        if self.consolidate and is_final and self.num_dump == 0:
+            # never rotated, write all buckets directly into one file
+            self._dump_consolidated(buckets)
+        else:
+            for i, bucket_dict in enumerate(buckets):
+                frames = self._take_frames(i, bucket_dict)
+                if not frames:
+                    continue
+                tmppath = self._get_tmp(i, is_final, sum(size or 0 for _, size in frames))
+                logger.debug("dump %s", tmppath)
+                size = self._dump_bucket([data for data, _ in frames], tmppath)
+                self.sizes[i] += size
 
         self.num_dump += 1
         t = time.time() - t
         env.task_stats.secs_dump += t
         env.task_stats.num_dump_rotate += 1
 
+    def append(self, reduce_id, items):
+        """ prepare a batch of uncombined items, dumped with the next buckets
+        """
+        self.batches[reduce_id].append(self._prepare(items))
+
+    def _take_frames(self, reduce_id, bucket_dict):
+        """ [(data, exp_size), ...] to dump for the reduce: batches appended, then the bucket
+        """
+        frames = self.batches[reduce_id]
+        self.batches[reduce_id] = []
+        if bucket_dict:
+            frames.append(self._prepare(six.iteritems(bucket_dict)))
+        return frames
+
+    def _dump_consolidated(self, buckets):
+        prepared = [self._take_frames(i, bucket_dict) for i, bucket_dict in enumerate(buckets)]
+        total_size = sum(size or 0 for frames in prepared for _, size in frames)
+
+        self.data_path = self._alloc_data_tmp(total_size)
+        logger.debug("dump %s", self.data_path)
+        self.offsets = [0]
+        with open(self.data_path, 'wb') as f:
+            for i, frames in enumerate(prepared):
+                for data, _ in frames:
+                    self.sizes[i] += self._write_bucket(data, f)
+                self.offsets.append(f.tell())
+
+    def _concat_tmps(self):
+        total_size = sum(os.path.getsize(tmppaths[-1])
+                         for tmppaths in self.tmp_paths if tmppaths)
+        self.data_path = self._alloc_data_tmp(total_size)
+        self.offsets = [0]
+        with open(self.data_path, 'wb') as f:
+            for tmppaths in self.tmp_paths:
+                if tmppaths:
+                    with open(tmppaths[-1], 'rb') as src:
+                        shutil.copyfileobj(src, f)
+                    for p in tmppaths:
+                        os.remove(p)
+                self.offsets.append(f.tell())
+
     def commit(self, aggregator):
         self._pre_commit(aggregator)
+        if self.consolidate:
+            self._commit_consolidated()
+            return
+
         for i in range(self.num_reduce):
             tmppaths = self.tmp_paths[i]
             if tmppaths:
@@ -298,14 +551,36 @@ class BucketDumperBase(object):
             else:
                 self._dump_empty_bucket(i)
 
+    def _commit_consolidated(self):
+        if self.offsets is None:
+            self._concat_tmps()
+
+        index_path = ShuffleWorkDir.alloc_tmp(datasize=len(self.offsets) * 8)
+        with open(index_path, 'wb') as f:
+            f.write(pack_index(self.offsets))
+
+        # export data first, index is the mark of a complete output
+        ShuffleWorkDir(self.shuffle_id, self.map_id, ShuffleWorkDir.DATA).export(self.data_path)
+        ShuffleWorkDir(self.shuffle_id, self.map_id, ShuffleWorkDir.INDEX).export(index_path)
+
+    def _alloc_data_tmp(self, size):
+        return ShuffleWorkDir.alloc_tmp(mem_first=False)
+
     def _dump_empty_bucket(self, i):
         tmppath = self.paths[i].alloc_tmp()
-        self._dump_bucket(self._prepare([])[0], tmppath)
+        self._dump_bucket([self._prepare([])[0]], tmppath)
         self.paths[i].export(tmppath)
 
     def _get_tmp(self, reduce_id, is_final, size):
         pass
 
+    def _dump_bucket(self, frames, path):
+        with open(path, 'wb') as f:
+            return sum(self._write_bucket(data, f) for data in frames)
+
+    def _write_bucket(self, data, f):
+        raise NotImplementedError
+
 
 class BucketDumper(BucketDumperBase):
 
@@ -326,68 +601,166 @@ class BucketDumper(BucketDumperBase):
 
         return tmp_path
 
+    def _alloc_data_tmp(self, size):
+        if self.num_dump == 0:
+            return ShuffleWorkDir.alloc_tmp(datasize=size)
+        return ShuffleWorkDir.alloc_tmp(mem_first=False)
+
     def _pre_commit(self, aggregator):
         pass
 
     def _prepare(self, items):
         items = list(items)
+        d = None
         try:
             if marshalable(items):
-                is_marshal, d = True, marshal.dumps(items)
-            else:
-                is_marshal, d = False, cPickle.dumps(items, -1)
+                d = marshal.dumps(items)
         except ValueError:
-            is_marshal, d = False, cPickle.dumps(items, -1)
-        data = compress(d)
-        size = len(data)
-        return (is_marshal, data), size
+            pass
+        if d is not None:
+            self.raw_size += len(d)
+            frames = [self.codec.compress(d)]
+        else:
+            raw_size, frames = pickle_frames(items, self.codec)
+            self.raw_size += raw_size
+        size = sum(len(data) for data in frames)
+        return (d is not None, frames), size
 
-    def _dump_bucket(self, data, path):
-        is_marshal, data = data
+    def _dump_bucket(self, frames, path):
         if self.num_dump == 0 and os.path.exists(path):
             logger.warning("remove old dump %s", path)
             os.remove(path)
         with open(path, 'ab') as f:
-            f.write(pack_header(len(data), is_marshal, False))
-            f.write(data)
-        return len(data)
+            return sum(self._write_bucket(data, f) for data in frames)
 
+    def _write_bucket(self, data, f):
+        is_marshal, frames = data
+        return sum(write_frame(f, data, is_marshal, False, self.codec) for data in frames)
 
-class SortMergeBucketDumper(BucketDumperBase):
 
-    def _pre_commit(self, aggregator):
-        for i in range(self.num_reduce):
-            tmp_paths = self.tmp_paths[i]
-            if tmp_paths:
-                if len(tmp_paths) == 1:
-                    self.paths[i].export(tmp_paths[0])
-                else:
-                    inputs = [get_serializer(self.rddconf).load_stream(open(p))
-                              for p in tmp_paths]
-                    rddconf = self.rddconf.dup(op=dpark.conf.OP_GROUPBY)
-                    merger = Merger.get(rddconf, aggregator=aggregator, api_callsite=self.__class__.__name__)
-                    merger.merge(inputs)
-                    final_tmp = self._get_tmp(i, True, 0)
-                    with open(final_tmp, 'wb') as f:
-                        get_serializer(self.rddconf).dump_stream(merger, f)
-            else:
-                self._dump_empty_bucket(i)
+class SortBufferDumper(object):
+    """ map output of sort merge mode
 
-    def _get_tmp(self, i, is_final, size):
-        # each dump write to a new tmp file for each reduce
-        p = ShuffleWorkDir.alloc_tmp(mem_first=False)
-        self.tmp_paths[i].append(p)
-        return p
+        (reduce_id, key, value) of all reduces are appended into one buffer,
+        sorted by (reduce_id, key) and combined when spilled into a run file,
+        with the offset of each reduce in it. Runs are k-way merged at commit.
+    """
 
-    def _prepare(self, items):
-        return items, None
+    def __init__(self, shuffle_id, map_id, num_reduce, rddconf, aggregator):
+        self.shuffle_id = shuffle_id
+        self.map_id = map_id
+        self.num_reduce = num_reduce
+        self.rddconf = rddconf
+        self.aggregator = aggregator
+        self.codec = get_shuffle_codec(rddconf)
+        self.buffer = []  # [(reduce_id, key, value)], cleared in place when spilled
+        self.runs = []  # [(path, offsets)]
 
-    def _dump_bucket(self, items, path):
-        serializer = get_serializer(self.rddconf)
+        # stats
+        self.sizes = [0] * num_reduce
+        self.raw_size = 0  # before compression
+        self.num_dump = 0
+
+    def get_size(self):
+        return sum(self.sizes)
+
+    def dump(self, buckets, is_final):
+        """ spill the buffer into a new run, buckets are not used
+        """
+        t = time.time()
+        buf = self.buffer
+        buf.sort(key=itemgetter(0, 1))
+        if is_final and not self.runs:
+            path = ShuffleWorkDir.alloc_tmp(datasize=len(buf) * 64)
+        else:
+            path = ShuffleWorkDir.alloc_tmp(mem_first=False)
+        logger.debug("dump %s", path)
+        parts = ((i, self._combine_sorted((k, v) for _, k, v in items))
+                 for i, items in itertools.groupby(buf, itemgetter(0)))
+        self.runs.append((path, self._write_run(path, parts)))
+        del buf[:]
+
+        self.num_dump += 1
+        env.task_stats.secs_dump += time.time() - t
+        env.task_stats.num_dump_rotate += 1
+
+    def _combine_sorted(self, items):
+        create = self.aggregator.createCombiner
+        merge = self.aggregator.mergeValue
+        i = None
+        for i, (k, v) in enumerate(items):
+            if i == 0:
+                last_key, c = k, create(v)
+            elif k != last_key:
+                yield last_key, c
+                last_key, c = k, create(v)
+            else:
+                c = merge(c, v)
+        if i is not None:
+            yield last_key, c
+
+    def _write_run(self, path, parts):
+        """ write (reduce_id, sorted items) in order of reduce_id,
+            return offsets of each reduce and the end
+        """
+        offsets = [0]
         with open(path, 'wb') as f:
-            serializer.dump_stream(sorted(items), f)
-            size = f.tell()
-        return size
+            for i, items in parts:
+                while len(offsets) <= i:
+                    offsets.append(f.tell())
+                serializer = get_serializer(self.rddconf, self.codec)
+                serializer.dump_stream(items, f)
+                self.raw_size += serializer.raw_size
+            while len(offsets) <= self.num_reduce:
+                offsets.append(f.tell())
+        return offsets
+
+    def _merge_runs(self):
+        runs = self.runs
+        rddconf = self.rddconf.dup(op=dpark.conf.OP_GROUPBY)
+
+        def merged():
+            for i in range(self.num_reduce):
+                inputs = [get_serializer(self.rddconf).load_stream(
+                    MappedFile(path, offsets[i], offsets[i + 1] - offsets[i]))
+                    for path, offsets in runs if offsets[i + 1] > offsets[i]]
+                if inputs:
+                    merger = Merger.get(rddconf, aggregator=self.aggregator,
+                                        api_callsite=self.__class__.__name__)
+                    merger.merge(inputs)
+                    yield i, merger
+
+        self.raw_size = 0  # count the final output only
+        path = ShuffleWorkDir.alloc_tmp(mem_first=False)
+        offsets = self._write_run(path, merged())
+        for p, _ in runs:
+            os.remove(p)
+        return path, offsets
+
+    def commit(self, aggregator):
+        if len(self.runs) > 1:
+            path, offsets = self._merge_runs()
+        else:
+            path, offsets = self.runs[0]
+        self.sizes = [offsets[i + 1] - offsets[i] for i in range(self.num_reduce)]
+
+        if dpark.conf.SHUFFLE_CONSOLIDATE:
+            index_path = ShuffleWorkDir.alloc_tmp(datasize=len(offsets) * 8)
+            with open(index_path, 'wb') as f:
+                f.write(pack_index(offsets))
+            # export data first, index is the mark of a complete output
+            ShuffleWorkDir(self.shuffle_id, self.map_id, ShuffleWorkDir.DATA).export(path)
+            ShuffleWorkDir(self.shuffle_id, self.map_id, ShuffleWorkDir.INDEX).export(index_path)
+            return
+
+        with open(path, 'rb') as src:
+            for i in range(self.num_reduce):
+                out = ShuffleWorkDir(self.shuffle_id, self.map_id, i)
+                tmppath = out.alloc_tmp(datasize=self.sizes[i])
+                with open(tmppath, 'wb') as f:
+                    f.write(src.read(self.sizes[i]))
+                out.export(tmppath)
+        os.remove(path)
 
 
 class TaskState:
@@ -428,24 +801,29 @@ class TaskReason:
     run_timeout = "run_timeout"
     stage_timeout = "stage_timout"
     fail = "fail"
+    speculation = "speculation"
 
 
 class FetchFailed(Exception):
 
-    def __init__(self, serverUri, shuffleId, mapId, reduceId):
+    def __init__(self, serverUri, shuffleId, mapId, reduceId, reason=None):
         self.serverUri = serverUri
         self.shuffleId = shuffleId
         self.mapId = mapId
         self.reduceId = reduceId
+        self.reason = reason
 
     def __str__(self):
-        return '<FetchFailed(%s, %d, %d, %d)>' % (
+        s = '<FetchFailed(%s, %d, %d, %d)' % (
             self.serverUri, self.shuffleId, self.mapId, self.reduceId
         )
+        if self.reason:
+            s += ': %s' % (self.reason,)
+        return s + '>'
 
     def __reduce__(self):
         return FetchFailed, (self.serverUri, self.shuffleId,
-                             self.mapId, self.reduceId)
+                             self.mapId, self.reduceId, self.reason)
 
 
 class OtherFailure(Exception):
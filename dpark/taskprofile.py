@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+import os
+import json
+import time
+import math
+
+from dpark.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+
+class TaskProfiles(object):
+    """ memory and time percentiles of tasks, by api_callsite of the rdd of their stage.
+
+        Kept in a json file, so the next run of a script can size memory of its
+        tasks before they run, instead of from rdd.mem and doubling on each OOM.
+        Updates are written once by save(), when the scheduler stops.
+    """
+
+    def __init__(self, path, headroom=0.2, min_tasks=5, max_entries=2000):
+        self.path = os.path.expanduser(path) if path else None
+        self.headroom = headroom
+        self.min_tasks = min_tasks
+        self.max_entries = max_entries
+        self.profiles = self._load()
+        self.updated = set()  # keys to save
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning('fail to load task profiles from %s: %s', self.path, e)
+            return {}
+
+    def save(self):
+        """ write profiles updated since the last save, merged with the ones
+            written by other drivers since we loaded them
+        """
+        if not self.path or not self.updated:
+            return
+        try:
+            profiles = self._load()
+            for key in self.updated:
+                profiles[key] = self.profiles[key]
+            if len(profiles) > self.max_entries:
+                keys = sorted(profiles, key=lambda k: profiles[k].get('time', 0))
+                for k in keys[:len(profiles) - self.max_entries]:
+                    del profiles[k]
+            self.profiles = profiles
+            self.updated.clear()
+
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            tmp = '%s.%d' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(profiles, f)
+            os.rename(tmp, self.path)
+        except Exception as e:
+            logger.warning('fail to save task profiles to %s: %s', self.path, e)
+
+    def get(self, key):
+        return self.profiles.get(key)
+
+    def suggest_mem(self, key, mem, max_mem, keep_mem=False):
+        """ memory (MB) to request for tasks of key, mem if no history for it.
+
+            Over-requests are shrunk to the max rss plus headroom, once there are
+            min_tasks tasks and none of them got OOM, unless keep_mem (set by user).
+            Tasks that get OOM after that are doubled by TaskSet, and are raised to
+            twice the OOM limit in the next run.
+        """
+        p = self.profiles.get(key)
+        if not p:
+            return mem
+        if p['tasks'] < self.min_tasks and not p['oom_mem']:
+            return mem
+
+        # the max rss seen is not enough if tasks were killed by OOM before
+        suggested = max(p['mem'][-1] * (1 + self.headroom), p['oom_mem'] * 2)
+        suggested = int(min(max(math.ceil(suggested), 1), max_mem))
+        if p['oom_mem'] or keep_mem:
+            return max(suggested, mem)
+        return suggested
+
+    def update(self, key, taskset):
+        """ record a finished taskset
+        """
+        if not key or taskset.failed or not len(taskset.mem_digest):
+            return
+
+        def quantiles(digest):
+            if not len(digest):
+                return []
+            return [round(digest.quantile(q), 3) for q in (0.5, 0.9, 1)]
+
+        self.profiles[key] = {
+            'mem': quantiles(taskset.mem_digest),  # MB, p50/p90/max of rss
+            'duration': quantiles(taskset.time_digest),  # seconds
+            'tasks': len(taskset.tasks),
+            'oom_mem': taskset.oom_mem,  # max memory limit of tries killed by OOM
+            'time': time.time(),
+        }
+        self.updated.add(key)
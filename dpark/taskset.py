@@ -2,8 +2,8 @@ from __future__ import absolute_import, print_function
 import math
 import time
 import socket
-from operator import itemgetter
 
+import dpark.conf
 from dpark.utils.tdigest import TDigest
 from dpark.utils.log import (
     get_logger, make_progress_bar
@@ -24,11 +24,20 @@ def readable(size):
     return '%.1f%s' % (size, units[unit])
 
 
-LOCALITY_WAIT = 0
 WAIT_FOR_RUNNING = 30
 MAX_TASK_FAILURES = 4
 MAX_TASK_MEMORY = 20 << 10  # 20GB
 
+# locality levels of delay scheduling
+LOCALITY_HOST = 0
+LOCALITY_RACK = 1
+LOCALITY_ANY = 2
+LOCALITY_NAMES = ['host', 'rack', 'any']
+
+
+def rack_of(host):
+    return dpark.conf.RACKS.get(host)
+
 
 class TaskCounter(object):
 
@@ -89,25 +98,38 @@ class TaskSet(object):
 
         self.lastPreferredLaunchTime = time.time()
 
+        # pending lists are stacks of task indexes, popped from the end.
+        # launched or finished entries are dropped lazily when met.
         self.pendingTasksForHost = {}
+        self.pendingTasksForRack = {}
         self.pendingTasksWithNoPrefs = []
-        self.allPendingTasks = []
+        self.pendingTasksForShape = {}  # (cpus, mem, gpus) -> all pending tasks of it
 
         self.reasons = set()
         self.failed = False
         self.causeOfFailure = ''
         self.last_check = 0
 
-        for i in range(len(tasks)):
+        for i in reversed(range(len(tasks))):
             self._addPendingTask(i)
-        self.host_cache = {}
+        self.host_names = {}  # host of offers -> names it may be preferred by
+        if self.pendingTasksForHost:
+            self.locality_level = LOCALITY_HOST
+        else:
+            self.locality_level = LOCALITY_ANY
+        self.locality_counts = [0] * len(LOCALITY_NAMES)  # launched tasks with preferences
         self.task_host_manager = task_host_manager if task_host_manager is not None \
             else TaskHostManager()
         self.id_retry_host = {}
         self.task_local_set = set()
         self.mem_digest = TDigest()
+        self.time_digest = TDigest()  # seconds of finished tries
+        self.speculated = {}  # task index -> the try a backup was started for
+        self.num_speculation_won = 0
+        self.time_wasted = 0  # seconds of killed tries
         self.max_stage_time = 0
         self.mem90 = 0  # TODO: move to stage
+        self.oom_mem = 0  # max memory limit of tries killed by OOM
 
     @property
     def taskEverageTime(self):
@@ -115,6 +137,12 @@ class TaskSet(object):
             return 10
         return max(self.total_time_used / self.counter.finished, 5)
 
+    @property
+    def localityWait(self):
+        """ seconds to wait at a locality level before trying the next one
+        """
+        return min(dpark.conf.LOCALITY_WAIT, self.taskEverageTime * dpark.conf.LOCALITY_WAIT_RATIO)
+
     def _addPendingTask(self, i):
         loc = self.tasks[i].preferredLocations()
         if not loc:
@@ -122,49 +150,112 @@ class TaskSet(object):
         else:
             for host in loc:
                 self.pendingTasksForHost.setdefault(host, []).append(i)
-        self.allPendingTasks.append(i)
-
-    def _getPendingTasksForHostWithCache(self, host):
-        tasks = self.host_cache.get(host)
-        if tasks:
-            return tasks
-        else:
-            tasks = self._getPendingTasksForHost(host)
-            self.host_cache[host] = tasks
-            return tasks
-
-    def _getPendingTasksForHost(self, host):
-        try:
-            h, hs, ips = socket.gethostbyname_ex(host)
-        except Exception:
-            h, hs, ips = host, [], []
-        tasks = sum((self.pendingTasksForHost.get(h, [])
-                     for h in [h] + hs + ips), [])
-        st = {}
-        for t in tasks:
-            st[t] = st.get(t, 0) + 1
-        ts = sorted(list(st.items()), key=itemgetter(1), reverse=True)
-        return [t for t, _ in ts]
+            for rack in set(map(rack_of, loc)):
+                if rack is not None:
+                    self.pendingTasksForRack.setdefault(rack, []).append(i)
+        t = self.tasks[i]
+        self.pendingTasksForShape.setdefault((t.cpus, t.mem, t.gpus), []).append(i)
+
+    def _allowedLocality(self, now):
+        """ the least local level allowed now, the wait of the current level starts at
+            the last launch of a task at a level no less local.
+        """
+        wait = self.localityWait
+        while self.locality_level < LOCALITY_ANY:
+            if self.locality_level == LOCALITY_RACK and not self.pendingTasksForRack:
+                self.locality_level += 1
+            elif now - self.lastPreferredLaunchTime >= wait:
+                self.locality_level += 1
+                self.lastPreferredLaunchTime += wait
+            else:
+                break
+        return self.locality_level
+
+    def _getHostNames(self, host):
+        names = self.host_names.get(host)
+        if names is None:
+            try:
+                h, hs, ips = socket.gethostbyname_ex(host)
+            except Exception:
+                h, hs, ips = host, [], []
+            names = [host]
+            for name in [h] + hs + ips:
+                if name not in names:
+                    names.append(name)
+            self.host_names[host] = names
+        return names
 
     def _findTaskFromList(self, l, host, cpus, mem, gpus):
-        for i in l:
+        unfit = set()  # (cpus, mem, gpus) of tasks larger than the offer
+        k = len(l)
+        while k > 0:
+            k -= 1
+            i = l[k]
             if self.launched[i] or self.finished[i]:
+                del l[k]
                 continue
             if host in self.running_hosts[i]:
                 continue
             t = self.tasks[i]
+            shape = (t.cpus, t.mem, t.gpus)
+            if shape in unfit:
+                continue
+            if not (t.cpus <= cpus + 1e-4 and t.mem <= mem and t.gpus <= gpus):
+                unfit.add(shape)
+                continue
             if self.task_host_manager.task_failed_on_host(t.id, host):
                 continue
-            if t.cpus <= cpus + 1e-4 and t.mem <= mem and t.gpus <= gpus:
-                return i
+            return i
+
+    def _findLocalTask(self, host, cpus, mem, gpus):
+        for name in self._getHostNames(host):
+            l = self.pendingTasksForHost.get(name)
+            if l:
+                i = self._findTaskFromList(l, host, cpus, mem, gpus)
+                if i is not None:
+                    return i
+
+    def _findRemoteTask(self, host_offers, cpus, mems, gpus):
+        """ (task index, offer index, offer) of a pending task for any of host_offers
+        """
+        for shape, l in list(self.pendingTasksForShape.items()):
+            c, m, g = shape
+            fit_offers = dict((host, (i, o)) for host, (i, o) in host_offers.items()
+                              if c <= cpus[i] + 1e-4 and m <= mems[i] and g <= gpus[i])
+            k = len(l) if fit_offers else 0
+            while k > 0:
+                k -= 1
+                idx = l[k]
+                if self.launched[idx] or self.finished[idx]:
+                    del l[k]
+                    continue
+                t = self.tasks[idx]
+                if (t.cpus, t.mem, t.gpus) != shape:  # memory enlarged while pending
+                    del l[k]
+                    self.pendingTasksForShape.setdefault((t.cpus, t.mem, t.gpus), []).append(idx)
+                    continue
+                i, o = self.task_host_manager.offer_choice(t.id, fit_offers, self.running_hosts[idx])
+                if i is not None:
+                    return idx, i, o
+            if not l:
+                del self.pendingTasksForShape[shape]
+        return None, None, None
 
     def taskOffer(self, host_offers, cpus, mems, gpus):
+        now = time.time()
+        level = self._allowedLocality(now)
         prefer_list = []
         for host in host_offers:
             i, o = host_offers[host]
-            local_task = self._findTaskFromList(
-                self._getPendingTasksForHostWithCache(host), host,
-                cpus[i], mems[i], gpus[i])
+            local_task = self._findLocalTask(host, cpus[i], mems[i], gpus[i])
+            if local_task is None:
+                local_task = self._findTaskFromList(
+                    self.pendingTasksWithNoPrefs, host, cpus[i], mems[i], gpus[i])
+            if local_task is None and level >= LOCALITY_RACK:
+                rack = rack_of(host)
+                if rack in self.pendingTasksForRack:
+                    local_task = self._findTaskFromList(
+                        self.pendingTasksForRack[rack], host, cpus[i], mems[i], gpus[i])
             if local_task is not None:
                 result_tuple = self._try_update_task_offer(local_task, i, o, cpus, mems, gpus)
                 if result_tuple is None:
@@ -172,17 +263,41 @@ class TaskSet(object):
                 prefer_list.append(result_tuple)
         if prefer_list:
             return prefer_list
-        for idx in range(len(self.tasks)):
-            if not self.launched[idx] and not self.finished[idx]:
-                i, o = self.task_host_manager.offer_choice(self.tasks[idx].id, host_offers,
-                                                           self.running_hosts[idx])
-                if i is None:
-                    continue
-                result_tuple = self._try_update_task_offer(idx, i, o, cpus, mems, gpus)
-                if result_tuple:
-                    return [result_tuple]
+        if level < LOCALITY_ANY:
+            return []
+        idx, i, o = self._findRemoteTask(host_offers, cpus, mems, gpus)
+        if idx is not None:
+            result_tuple = self._try_update_task_offer(idx, i, o, cpus, mems, gpus)
+            if result_tuple:
+                return [result_tuple]
         return []
 
+    def _launchedAt(self, task_idx, hostname):
+        """ count the locality level a task with preferences is launched at
+        """
+        locs = self.tasks[task_idx].preferredLocations()
+        if not locs:
+            return
+        if hostname in locs:
+            level = LOCALITY_HOST
+        elif rack_of(hostname) is not None and rack_of(hostname) in set(map(rack_of, locs)):
+            level = LOCALITY_RACK
+        else:
+            level = LOCALITY_ANY
+        self.locality_counts[level] += 1
+        if level <= self.locality_level:
+            self.locality_level = level
+            self.lastPreferredLaunchTime = time.time()
+
+    def locality_summary(self):
+        """ share of launched tasks at each locality level, like ' host:90% rack:6% any:4%'
+        """
+        n = sum(self.locality_counts)
+        if not n:
+            return ''
+        return ''.join(' %s:%d%%' % (name, c * 100 // n)
+                       for name, c in zip(LOCALITY_NAMES, self.locality_counts))
+
     def _try_update_task_offer(self, task_idx, i, o, cpus, mem, gpus):
         t = self.tasks[task_idx]
         if t.cpus <= cpus[i] + 1e-4 and t.mem <= mem[i] and t.gpus <= gpus[i]:
@@ -199,6 +314,7 @@ class TaskSet(object):
             host_set = set(self.tasks[task_idx].preferredLocations())
             if o.hostname in host_set:
                 self.task_local_set.add(t.id)
+            self._launchedAt(task_idx, o.hostname)
             return i, o, t
         return None
 
@@ -228,6 +344,7 @@ class TaskSet(object):
         elif status == TaskState.finished:
             if stats:
                 self.mem_digest.add(stats.bytes_max_rss / (1024. ** 2))
+            self.time_digest.add(time.time() - self._try_start_time(task, num_try))
             if task.tries[num_try].reason in (TaskReason.run_timeout, TaskReason.stage_timeout):
                 logger.warning("task timeout works: try %s finshed. History: %s",
                                num_try, ". ".join(map(str, task.tries.values())))
@@ -236,6 +353,22 @@ class TaskSet(object):
         else:  # failed, killed, lost, error
             self._task_lost(task_id, num_try, status, reason, message, exception=result)
 
+    @staticmethod
+    def _try_start_time(task, num_try):
+        status = task.tries[num_try].status
+        for st, t in status:
+            if st == TaskState.running:
+                return t
+        return status[0][1]
+
+    def speculation_summary(self):
+        """ like ', speculated=3 (won 2, wasted 12.0s)'
+        """
+        if not self.speculated:
+            return ''
+        return ', speculated=%d (won %d, wasted %.1fs)' % (
+            len(self.speculated), self.num_speculation_won, self.time_wasted)
+
     def progress(self, ending=''):
         n = self.counter.n
         ratio = self.counter.finished * 1. / n
@@ -247,21 +380,22 @@ class TaskSet(object):
             m, s = divmod(int(eta), 60)
             h, m = divmod(m, 60)
 
-            tmpl = 'taskset:%4s {{GREEN}}%s{{RESET}}%5.1f%% (% {width}s/% {width}s) ETA:% 2d:%02d:%02d AVG:%.1fs\x1b[K%s'
+            tmpl = 'job:%s taskset:%4s {{GREEN}}%s{{RESET}}%5.1f%% (% {width}s/% {width}s) ETA:% 2d:%02d:%02d AVG:%.1fs%s\x1b[K%s'
             fmt = tmpl.format(width=int(math.log10(self.counter.n)) + 1)
 
             msg = fmt % (
-                self.id, bar, ratio * 100, self.counter.finished, n, h, m, s,
-                avg, ending
+                self.tasks[0].job_id, self.id, bar, ratio * 100, self.counter.finished, n, h, m, s,
+                avg, self.locality_summary(), ending
             )
             msg = msg.ljust(80)
             logger.info(msg)
         else:
 
-            tmpl = 'taskset:%4s {{GREEN}}%s{{RESET}}%5.1f%% (% {width}s/% {width}s) ETA:--:--:-- AVG:N/A\x1b[K%s'
+            tmpl = 'job:%s taskset:%4s {{GREEN}}%s{{RESET}}%5.1f%% (% {width}s/% {width}s) ETA:--:--:-- AVG:N/A%s\x1b[K%s'
             fmt = tmpl.format(width=int(math.log10(self.counter.n)) + 1)
 
-            msg = fmt % (self.id, bar, ratio * 100, self.counter.finished, n, ending)
+            msg = fmt % (self.tasks[0].job_id, self.id, bar, ratio * 100, self.counter.finished, n,
+                         self.locality_summary(), ending)
             msg = msg.ljust(80)
             logger.info(msg)
 
@@ -286,19 +420,25 @@ class TaskSet(object):
         self.task_host_manager.task_succeed(task.id, hostname,
                                             TaskEndReason.success)
 
+        now = time.time()
         for t in range(task.num_try):
             if t + 1 != num_try:
+                if task.tries[t + 1].status[-1][0] in (TaskState.staging, TaskState.running):
+                    self.time_wasted += now - task.tries[t + 1].status[0][1]
                 self.sched.killTask(task.id, t + 1)
+        if i in self.speculated and self.speculated[i] != num_try:
+            self.num_speculation_won += 1
 
         if self.counter.finished == self.counter.n:
             ts = [t.time_used for t in self.tasks]
             num_try = [t.num_try for t in self.tasks]
             elasped = time.time() - self.start_time
             logger.info('taskset %s finished in %.1fs: min=%.1fs, '
-                        'avg=%.1fs, max=%.1fs, maxtry=%d, speedup=%.1f, local=%.1f%%',
+                        'avg=%.1fs, max=%.1fs, maxtry=%d, speedup=%.1f, local=%.1f%%%s%s',
                         self.id, elasped, min(ts), sum(ts) / len(ts), max(ts),
                         max(num_try), self.total_time_used / elasped,
-                        len(self.task_local_set) * 100. / len(self.tasks)
+                        len(self.task_local_set) * 100. / len(self.tasks),
+                        self.locality_summary(), self.speculation_summary()
                         )
             self.sched.tasksetFinished(self)
 
@@ -332,6 +472,7 @@ class TaskSet(object):
 
         if TaskEndReason.maybe_oom(reason):
             self.counter.fail_oom += 1
+            self.oom_mem = max(self.oom_mem, task.mem)
             task.mem = min(task.mem * 2, MAX_TASK_MEMORY)
             logger.info("task %s oom, enlarge memory limit to %d, origin %d", task.id, task.mem, task.rdd.mem)
 
@@ -371,6 +512,7 @@ class TaskSet(object):
 
         self.task_host_manager.task_failed(task.id, hostname, reason)
         self.launched[index] = False
+        self._addPendingTask(index)
         if self.counter.launched == self.counter.n:
             self.sched.requestMoreResources()
         self.running_hosts[index] = []
@@ -404,11 +546,14 @@ class TaskSet(object):
                 self.counter.fail_staging_timeout += 1
                 task.reason_next = TaskReason.stage_timeout
                 self.launched[i] = False
+                self._addPendingTask(i)
                 self.counter.launched -= 1
                 num_resubmit += 1
                 if num_resubmit > 3:
                     break
 
+        self._speculate(now)
+
         # running for too long
         num_resubmit = 0
         if self.counter.finished > self.counter.n * 0.8:
@@ -428,6 +573,7 @@ class TaskSet(object):
                         task.stage_time = 0
                         task.start_time = 0
                         self.launched[idx] = False
+                        self._addPendingTask(idx)
                         self.counter.launched -= 1
                         task.reason_next = TaskReason.run_timeout
                     else:
@@ -441,6 +587,25 @@ class TaskSet(object):
                     break
         return self.counter.launched < n
 
+    def _speculate(self, now):
+        """ start backup tries of tasks running much longer than finished ones
+        """
+        if (not dpark.conf.SPECULATION or not self.counter.finished
+                or self.counter.finished < self.counter.n * dpark.conf.SPECULATION_FINISHED_FRACTION):
+            return
+        threshold = max(self.time_digest.quantile(dpark.conf.SPECULATION_QUANTILE)
+                        * dpark.conf.SPECULATION_MULTIPLIER, dpark.conf.SPECULATION_MIN_TIME)
+        for i, task in enumerate(self.tasks):
+            if (self.launched[i] and not self.finished[i] and i not in self.speculated
+                    and task.status == TaskState.running and now - task.start_time > threshold):
+                logger.info('speculate task %s on another host, running %.1fs > %.1fs, try %d',
+                            task.id, now - task.start_time, threshold, task.num_try)
+                self.speculated[i] = task.num_try
+                task.reason_next = TaskReason.speculation
+                self.launched[i] = False
+                self._addPendingTask(i)
+                self.counter.launched -= 1
+
     def _abort(self, message):
         logger.error('abort the taskset: %s', message)
         tasks = ' '.join(str(i) for i in range(len(self.finished))
@@ -449,4 +614,4 @@ class TaskSet(object):
         self.failed = True
         self.causeOfFailure = message
         self.sched.tasksetFinished(self)
-        self.sched.abort()
+        self.sched.abort(self)
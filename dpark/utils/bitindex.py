@@ -1,4 +1,5 @@
 from __future__ import absolute_import
+import binascii
 import marshal
 import math
 from dpark.portable_hash import portable_hash
@@ -11,6 +12,17 @@ BYTE_SHIFT = 3
 BYTE_SIZE = 1 << BYTE_SHIFT
 BYTE_MASK = BYTE_SIZE - 1
 
+def or_bytes(a, b):
+    """ bytewise a | b of two bytearrays of the same length, as a new bytearray
+    """
+    if hasattr(int, 'from_bytes'):
+        bits = int.from_bytes(a, 'little') | int.from_bytes(b, 'little')
+        return bytearray(bits.to_bytes(len(a), 'little'))
+    # hexlify is big endian, but the order does not matter for or
+    bits = int(binascii.hexlify(bytes(a)) or '0', 16) | int(binascii.hexlify(bytes(b)) or '0', 16)
+    return bytearray(binascii.unhexlify('%0*x' % (len(a) * 2, bits)))
+
+
 _table = [(), (0,), (1,), (0, 1), (2,), (0, 2), (1, 2), (0, 1, 2), (3,),
           (0, 3), (1, 3), (0, 1, 3), (2, 3), (0, 2, 3), (1, 2, 3), (0, 1, 2, 3)]
 
@@ -165,5 +177,15 @@ class Bloomfilter(object):
     def match(self, objs):
         return list(self._match(objs))
 
+    def update(self, other):
+        """ add all items of other, which has the same m and k
+        """
+        assert (self.m, self.k) == (other.m, other.k)
+        a, b = self.bitindex, other.bitindex
+        n = max(len(a.array), len(b.array))
+        if n:
+            a.array = or_bytes(a.array.ljust(n, b'\0'), b.array.ljust(n, b'\0'))
+        a.size = max(a.size, b.size)
+
     def __contains__(self, obj):
         return next(self._match([obj]))
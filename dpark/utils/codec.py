@@ -0,0 +1,117 @@
+""" compression codecs of shuffle frames
+
+    A codec is named like 'lz4' or with a level like 'zlib:9', and recorded
+    in frame headers by its id, so readers do not depend on how the writer
+    was configured.
+"""
+from __future__ import absolute_import
+import zlib
+
+from dpark import utils
+from dpark.utils.log import get_logger
+
+logger = get_logger(__name__)
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+CODEC_SNAPPY = 3
+CODEC_ZSTD = 4
+
+
+class Codec(object):
+
+    def __init__(self, name, id, compress, decompress):
+        self.name = name
+        self.id = id
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return '<Codec %s>' % (self.name,)
+
+
+def _identity(buf):
+    return buf
+
+
+def _zlib(level=1):
+    return Codec('zlib', CODEC_ZLIB, lambda buf: zlib.compress(buf, level), zlib.decompress)
+
+
+def _lz4(level=None):
+    from dpark.utils.lz4wrapper import compress, decompress
+    if level is None:
+        return Codec('lz4', CODEC_LZ4, compress, decompress)
+    return Codec('lz4', CODEC_LZ4, lambda buf: compress(buf, level=level), decompress)
+
+
+def _snappy(level=None):
+    from snappy import compress, decompress
+    return Codec('snappy', CODEC_SNAPPY, compress, decompress)
+
+
+def _zstd(level=3):
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=level)
+    decompressor = zstandard.ZstdDecompressor()
+    return Codec('zstd', CODEC_ZSTD, compressor.compress, decompressor.decompress)
+
+
+_FACTORIES = {
+    'none': lambda level=None: Codec('none', CODEC_NONE, _identity, _identity),
+    'zlib': _zlib,
+    'lz4': _lz4,
+    'snappy': _snappy,
+    'zstd': _zstd,
+}
+_NAMES = {
+    CODEC_NONE: 'none',
+    CODEC_ZLIB: 'zlib',
+    CODEC_LZ4: 'lz4',
+    CODEC_SNAPPY: 'snappy',
+    CODEC_ZSTD: 'zstd',
+}
+
+_codecs = {}  # name -> Codec or None if not available
+_unavailable = set()
+
+
+def _load(name):
+    if name not in _codecs:
+        codec_name, _, level = name.partition(':')
+        factory = _FACTORIES.get(codec_name)
+        if factory is None:
+            raise ValueError("unknown codec %r, choose from %s" % (name, sorted(_FACTORIES)))
+        try:
+            _codecs[name] = factory(int(level)) if level else factory()
+        except ImportError:
+            _codecs[name] = None
+    return _codecs[name]
+
+
+default_codec = _load(utils.COMPRESS)
+
+
+def get_codec(name):
+    """ codec to write with, the default one if name is None or not available here
+    """
+    if name is None:
+        return default_codec
+    codec = _load(name)
+    if codec is None:
+        if name not in _unavailable:
+            logger.warning("codec %s not available, use %s", name, default_codec.name)
+            _unavailable.add(name)
+        return default_codec
+    return codec
+
+
+def get_codec_by_id(id):
+    """ codec to read frames written with id
+    """
+    name = _NAMES.get(id)
+    codec = _load(name) if name else None
+    if codec is None:
+        raise IOError("codec %s of shuffle frame not available" % (name or id,))
+    return codec
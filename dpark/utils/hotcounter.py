@@ -43,6 +43,8 @@ class HotCounter(object):
             self.total[k] = self.total.get(k, 0) + c
 
     def top(self, limit):
+        if self.updates:
+            self._merge()
         return sorted(list(self.total.items()), key=operator.itemgetter(1), reverse=True)[:limit]
 
 
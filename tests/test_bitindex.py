@@ -85,3 +85,13 @@ class TestBitIndex(unittest.TestCase):
         self.assertTrue(keys[0] in b)
         self.assertTrue(all(b.match(keys)))
         self.assertTrue(len([_f for _f in b.match(range(80000, 100000)) if _f]) < 100000 * 0.01)
+
+    def test_bloomfilter_update(self):
+        m, k = Bloomfilter.calculate_parameters(1000, 0.01)
+        a, b = Bloomfilter(m, k), Bloomfilter(m, k)
+        a.add(range(0, 1000, 2))
+        b.add(range(1, 100, 2))
+        a.update(b)
+        self.assertTrue(all(a.match(range(0, 1000, 2))))
+        self.assertTrue(all(a.match(range(1, 100, 2))))
+        self.assertEqual(a.bitindex.size, max(len(a.bitindex), len(b.bitindex)))
@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+import os
+import json
+import time
+import signal
+import threading
+import unittest
+import logging
+import multiprocessing
+
+import psutil
+from addict import Dict
+from pymesos import encode_data
+
+import dpark.conf
+from dpark.context import DparkContext
+from dpark.executor import MyExecutor, ForkedWorker
+from dpark.serialize import dumps, find_modules
+from dpark.task import TaskState, TaskEndReason
+from dpark.utils import compress, spawn
+
+logging.getLogger('dpark').setLevel(logging.ERROR)
+
+
+class MockTask(object):
+
+    def __init__(self, id, action):
+        self.id = id
+        self.action = action
+
+    def run(self, ttid):
+        if self.action == 'raise':
+            raise Exception('task failed')
+        elif self.action == 'kill':
+            os.kill(os.getpid(), signal.SIGKILL)
+        elif self.action == 'sleep':
+            time.sleep(60)
+        return self.id
+
+
+class MockDriver(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.updates = []
+
+    def sendStatusUpdate(self, status):
+        with self.lock:
+            self.updates.append(status)
+
+    def wait(self, tid, timeout=20):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                for status in self.updates:
+                    if status.task_id.value == tid and status.state != TaskState.running:
+                        return status
+            time.sleep(0.1)
+
+
+class TestExecutor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sc = DparkContext('local')
+        cls.sc.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sc.stop()
+
+    def setUp(self):
+        self.fork_server = dpark.conf.EXECUTOR_FORK_SERVER
+        dpark.conf.EXECUTOR_FORK_SERVER = True
+        self.driver = MockDriver()
+        self.executor = MyExecutor()
+        spawn(self.executor.replier, self.driver)
+        spawn(self.executor.check_alive, self.driver)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        dpark.conf.EXECUTOR_FORK_SERVER = self.fork_server
+
+    def launch(self, tid, action):
+        task = Dict()
+        task.task_id.value = tid
+        task.data = encode_data(compress(dumps((MockTask(tid, action), '1.1_%s.1' % tid))))
+        self.executor.launchTask(self.driver, task)
+        return self.executor.tasks.get(tid, (None, None))[1]
+
+    def test_success(self):
+        proc = self.launch('0', 'ok')
+        self.assertIsInstance(proc, ForkedWorker)
+        self.assertEqual(self.driver.wait('0').state, TaskState.finished)
+        self.assertEqual(proc.join(5), 0)
+
+    def test_preload(self):
+        preload = dpark.conf.EXECUTOR_FORK_SERVER_PRELOAD
+        dpark.conf.EXECUTOR_FORK_SERVER_PRELOAD = True
+        try:
+            self.assertIsInstance(self.launch('0', 'ok'), ForkedWorker)
+            self.assertEqual(self.driver.wait('0').state, TaskState.finished)
+        finally:
+            dpark.conf.EXECUTOR_FORK_SERVER_PRELOAD = preload
+
+    def test_exception(self):
+        self.assertIsInstance(self.launch('0', 'raise'), ForkedWorker)
+        status = self.driver.wait('0')
+        self.assertEqual(status.state, TaskState.failed)
+        self.assertTrue(status.message.startswith('FAILED_EXCEPTION_Exception:'))
+
+    def test_killed(self):
+        self.assertIsInstance(self.launch('0', 'kill'), ForkedWorker)
+        status = self.driver.wait('0')
+        self.assertEqual(status.state, TaskState.failed)
+        self.assertTrue(status.message.startswith(TaskEndReason.recv_sig_kill + ':'))
+
+    def test_fork_server_died(self):
+        proc = self.launch('0', 'sleep')
+        self.assertIsInstance(proc, ForkedWorker)
+        self.assertIsNone(proc.join(0.1))
+        os.kill(self.executor.fork_server.proc.pid, signal.SIGKILL)
+
+        status = self.driver.wait('0')
+        self.assertEqual(status.state, TaskState.failed)
+        self.assertEqual(status.message,
+                         '%s:%s' % (TaskEndReason.other_failure, 'fork server exited'))
+        self.assertEqual(proc.join(), -signal.SIGKILL)
+        try:
+            self.assertEqual(psutil.Process(proc.pid).status(), psutil.STATUS_ZOMBIE)
+        except psutil.NoSuchProcess:
+            pass
+
+        # later tasks are forked by executor itself
+        proc = self.launch('1', 'ok')
+        self.assertIsInstance(proc, multiprocessing.Process)
+        self.assertEqual(self.driver.wait('1').state, TaskState.finished)
+        self.assertIsNone(self.executor.fork_server)
+
+    def test_find_modules(self):
+        data = dumps((MockTask('0', 'ok'), '1.1_0.1'))
+        self.assertIn(__name__, find_modules(data))
+        self.assertIn('json', find_modules(dumps(lambda x: json.dumps(x))))
+
+if __name__ == '__main__':
+    unittest.main()
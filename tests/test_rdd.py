@@ -26,6 +26,7 @@ from dpark.utils.beansdb import is_valid_key, restore_value
 from dpark.accumulator import *
 from tempfile import mkdtemp
 from dpark.serialize import loads, dumps
+from dpark.shuffle import MapOutputTracker
 from dpark.utils.nested_groupby import GroupByNestedIter, list_values, list_value
 
 dpark_master = os.environ.get("TEST_DPARK_MASTER", "local")
@@ -212,6 +213,94 @@ class TestRDDNoShuffle(TestRDD):
         loads(dumps(rdd))
         self.assertEqual(rdd.collect(), [x + 1000 for x in d])
 
+    def test_task_binary(self):
+        from dpark.task import TaskBinary
+        table = dict((i, str(i)) for i in range(10000))  # a fat closure
+        rdd = self.sc.makeRDD(list(range(100)), 4).map(lambda x: (x % 3, table[x]))
+        limit = dpark.conf.TASK_BINARY_BROADCAST_SIZE
+        dpark.conf.TASK_BINARY_BROADCAST_SIZE = 0
+        try:
+            self.sc.start()
+            binary = TaskBinary(rdd, len)
+            self.assertTrue(binary.size > 0)
+            b1, b2 = loads(dumps(binary)), loads(dumps(binary))
+            self.assertIs(b1.rdd, b2.rdd)  # loaded once
+            self.assertEqual(list(b1.rdd.iterator(rdd.splits[1]))[0], (25 % 3, '25'))
+            self.assertEqual(b1.func([1, 2]), 2)
+            binary.clear()
+
+            counts = rdd.groupByKey(2).mapValue(len).collectAsMap()
+            self.assertEqual(counts, {0: 34, 1: 33, 2: 33})
+        finally:
+            dpark.conf.TASK_BINARY_BROADCAST_SIZE = limit
+
+    def test_out_of_band_shuffle(self):
+        threshold = dpark.conf.SHUFFLE_OOB_BUFFER_SIZE
+        dpark.conf.SHUFFLE_OOB_BUFFER_SIZE = 100
+        try:
+            rdd = self.sc.makeRDD(list(range(20)), 4).map(lambda x: (x % 3, bytearray(200) + b'%d' % x))
+            self.assertEqual(sorted(rdd.partitionByKey(2).collect()), sorted(rdd.collect()))
+            groups = rdd.groupByKey(2).mapValue(len).collectAsMap()
+            self.assertEqual(groups, {0: 7, 1: 7, 2: 6})
+        finally:
+            dpark.conf.SHUFFLE_OOB_BUFFER_SIZE = threshold
+
+    def test_sched_delay(self):
+        rdd = self.sc.makeRDD(list(range(100)), 4).map(lambda x: (x % 5, x)).groupByKey(2)
+        self.assertEqual(len(rdd.collect()), 5)
+        stages = self.sc.scheduler.get_profs()[-1]['run']['stages']
+        self.assertEqual(len(stages), 2)
+        for stage in stages:
+            sched = stage['counters']['sched']
+            self.assertGreater(sched['events'], 0)
+            self.assertLessEqual(sched['max_delay'], sched['delay'])
+
+    def test_reuse_map_outputs(self):
+        import gc
+        sched = self.sc.scheduler
+        # log records captured by the test runner would keep the stages alive
+        logging.disable(logging.INFO)
+        try:
+            rdd = self.sc.makeRDD(list(range(100)), 4).map(lambda x: (x % 5, x)).reduceByKey(lambda x, y: x + y, 2)
+            self.assertEqual(rdd.count(), 5)
+            stages = sched.get_profs()[-1]['run']['stages']
+            self.assertEqual([s['info']['skipped'] for s in stages], [False, False])
+            gc.collect()
+
+            self.assertEqual(sorted(rdd.collect()), [(k, sum(range(k, 100, 5))) for k in range(5)])
+            stages = sched.get_profs()[-1]['run']['stages']
+            self.assertEqual(sorted(s['info']['skipped'] for s in stages), [False, True])
+            skipped = [s for s in stages if s['info']['skipped']][0]
+            self.assertEqual(skipped['counters']['task']['finished'], 4)
+
+            shuffle_id = rdd.shuffleId
+            self.assertIn(shuffle_id, sched.mapOutputs)
+            del rdd
+            gc.collect()
+            self.assertNotIn(shuffle_id, sched.mapOutputs)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_concurrent_jobs(self):
+        import threading
+        shared = self.sc.makeRDD(list(range(1000)), 4).map(lambda x: (x % 10, x)).groupByKey(4)
+        sums = shared.mapValue(sum)
+        counts = shared.mapValue(len)
+        results = {}
+
+        def run(name, rdd):
+            results[name] = sorted(rdd.collect())
+
+        threads = [threading.Thread(target=run, args=(name, rdd))
+                   for name, rdd in [('sums', sums), ('counts', counts)]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results['sums'], [(k, sum(range(k, 1000, 10))) for k in range(10)])
+        self.assertEqual(results['counts'], [(k, 100) for k in range(10)])
+        self.assertEqual(self.sc.scheduler.jobs, {})
+
     def test_enumerations(self):
         N = 100
         p = 10
@@ -350,6 +439,228 @@ class TestRDDShuffle(TestRDD):
         self.assertEqual(nums.mapValue(lambda x: x + 1).collect(),
                          [(1, 5), (2, 6), (3, 7), (3, 8)])
 
+    def test_shuffle_codec(self):
+        d = [(i % 10, i) for i in range(1000)]
+        nums = self.sc.makeRDD(d, 4)
+        expected = sorted(nums.reduceByKey(lambda x, y: x + y).collect())
+        for codec in ['none', 'zlib:9']:
+            rdd = nums.reduceByKey(lambda x, y: x + y, 3, rddconf=dpark.conf.rddconf(codec=codec))
+            self.assertEqual(sorted(rdd.collect()), expected)
+
+    def test_bypass_combine(self):
+        check = dpark.conf.MAP_COMBINE_CHECK
+        dpark.conf.MAP_COMBINE_CHECK = 100
+        try:
+            # unique keys first, then repeated ones after the check
+            d = list(range(3000)) + list(range(100)) * 3
+            nums = self.sc.makeRDD([(i, 1) for i in d], 2)
+            counts = nums.reduceByKey(lambda x, y: x + y, 3).collectAsMap()
+            self.assertEqual(counts, dict((i, 1 if i >= 100 else 4) for i in range(3000)))
+            groups = nums.groupByKey(3).mapValue(len).collectAsMap()
+            self.assertEqual(groups, counts)
+        finally:
+            dpark.conf.MAP_COMBINE_CHECK = check
+
+    def test_skewed_join(self):
+        # half of the left side is key 0, spread over several partitions
+        d = [(i if i % 2 else 0, i) for i in range(40000)]
+        left = self.sc.makeRDD(d, 2)
+        right = self.sc.makeRDD([(0, 'a'), (0, 'b'), (2, 'c'), (3, 'd')], 2)
+
+        threshold, salt = dpark.conf.BROADCAST_JOIN_THRESHOLD, dpark.conf.SKEW_JOIN_SALT
+        dpark.conf.BROADCAST_JOIN_THRESHOLD = 0
+        dpark.conf.SKEW_JOIN_SALT = 8
+        try:
+            joined = left.join(right, 8)
+            parts = joined.glom().map(lambda it: sum(1 for k, _ in it if k == 0)).collect()
+            self.assertGreater(sum(1 for c in parts if c), 1)
+            self.assertEqual(sum(parts), 40000)
+            self.assertEqual(sorted(joined.filter(lambda x: x[0] != 0).collect()),
+                             [(3, (3, 'd'))])
+
+            outer = left.leftOuterJoin(right, 8)
+            self.assertEqual(outer.count(), 40000 + 20000)
+            self.assertEqual(outer.filter(lambda x: x[1][1] is None).count(), 20000 - 1)
+        finally:
+            dpark.conf.BROADCAST_JOIN_THRESHOLD = threshold
+            dpark.conf.SKEW_JOIN_SALT = salt
+
+    def test_copartitioned_join(self):
+        def shuffles(rdd):
+            return sum(isinstance(dep, ShuffleDependency) for dep in rdd.dependencies)
+
+        def cogrouped(rdd):
+            while not isinstance(rdd, CoGroupedRDD):
+                rdd = rdd.dependencies[0].rdd
+            return rdd
+
+        threshold = dpark.conf.BROADCAST_JOIN_THRESHOLD
+        dpark.conf.BROADCAST_JOIN_THRESHOLD = 0
+        try:
+            kv = self.sc.makeRDD([(i % 10, i) for i in range(100)], 2).groupByKey(4)
+            part = kv.partitioner
+            self.assertEqual(kv.mapValue(len).partitioner, part)
+            self.assertEqual(kv.filter(lambda x: x[0]).partitioner, part)
+            self.assertEqual(kv.flatMapValue(lambda x: x).partitioner, part)
+            self.assertEqual(kv.mapPartitions(lambda it: it, preservesPartitioning=True).partitioner, part)
+            self.assertEqual(kv.mapPartitions(lambda it: it).partitioner, None)
+            self.assertEqual(kv.map(lambda x: x).partitioner, None)
+
+            other = self.sc.makeRDD([(i, -i) for i in range(5)], 3)
+            joined = other.join(kv.mapValue(len))
+            self.assertEqual(shuffles(cogrouped(joined)), 1)
+            self.assertEqual(joined.partitioner, part)
+            self.assertEqual(sorted(joined.collect()), [(i, (-i, 10)) for i in range(5)])
+
+            # joins of joined ones are not shuffled again
+            again = joined.join(kv.filter(lambda x: x[0] % 2))
+            self.assertEqual(shuffles(cogrouped(again)), 0)
+            self.assertEqual(sorted(again.mapValue(lambda x: x[0][0]).collect()),
+                             [(1, -1), (3, -3)])
+
+            # joins are not salted by default, they keep the partitioner
+            joined = other.join(other.mapValue(abs))
+            self.assertEqual(joined.partitioner, cogrouped(joined)._partitioner)
+            self.assertEqual(shuffles(cogrouped(joined.join(joined))), 0)
+
+            # salted join output is not partitioned by key
+            salt = dpark.conf.SKEW_JOIN_SALT
+            dpark.conf.SKEW_JOIN_SALT = 8
+            try:
+                self.assertEqual(other.join(other.mapValue(abs)).partitioner, None)
+            finally:
+                dpark.conf.SKEW_JOIN_SALT = salt
+
+            self.assertEqual(RangePartitioner([1, 5]), RangePartitioner([5, 1]))
+            self.assertNotEqual(RangePartitioner([1, 5]), RangePartitioner([1, 5], reverse=True))
+            self.assertNotEqual(HashPartitioner(4), HashPartitioner(5))
+        finally:
+            dpark.conf.BROADCAST_JOIN_THRESHOLD = threshold
+
+    def test_coalesce_partitions(self):
+        sched = self.sc.scheduler
+        submitted = []
+
+        def submitTasks(tasks):
+            submitted.append(len(tasks))
+            return type(sched).submitTasks(sched, tasks)
+
+        sched.submitTasks = submitTasks
+        try:
+            rdd = self.sc.makeRDD(list(range(1000)), 4).map(lambda x: (x % 50, x))
+            groups = rdd.groupByKey(20)
+            result = groups.collect()
+            # all 20 tiny reduce partitions run in one task, in order of partitions
+            self.assertEqual(submitted, [4, 1])
+            self.assertEqual(sorted((k, sorted(vs)) for k, vs in result),
+                             [(k, list(range(k, 1000, 50))) for k in range(50)])
+            parts = [groups.partitioner.getPartition(k) for k, _ in result]
+            self.assertEqual(parts, sorted(parts))
+
+            del submitted[:]
+            self.assertEqual(rdd.sort(numSplits=20).collect(),
+                             sorted(rdd.collect()))
+            self.assertEqual(submitted, [4, 4, 1, 4])  # sample, map, coalesced reduce, collect
+
+            # one copy of compressed sizes, shared by the tracker and reused map outputs
+            sizes = sched.mapOutputs[groups.shuffleId][1]
+            self.assertEqual(len(sizes), 20)
+            self.assertIs(env.trackerServer.get(MapOutputTracker.get_sizes_key(groups.shuffleId, 3))[0],
+                          sizes[3])
+            self.assertEqual(len(MapOutputTracker.get_sizes(groups.shuffleId, 3)), 4)
+
+            # map outputs are reused with their sizes, reduces are still coalesced
+            del submitted[:]
+            self.assertEqual(groups.count(), 50)
+            self.assertEqual(submitted, [1])
+
+            dpark.conf.COALESCE_REDUCE_PARTITIONS = False
+            del submitted[:]
+            self.assertEqual(groups.count(), 50)
+            self.assertEqual(submitted, [20])
+        finally:
+            dpark.conf.COALESCE_REDUCE_PARTITIONS = True
+            del sched.submitTasks
+
+    def test_bloom_filter_join(self):
+        big = self.sc.makeRDD([(i, i) for i in range(10000)], 4)
+        small = self.sc.makeRDD([(i, -i) for i in range(0, 10000, 100)], 2)
+
+        threshold = dpark.conf.BROADCAST_JOIN_THRESHOLD
+        dpark.conf.BROADCAST_JOIN_THRESHOLD = 0
+        try:
+            for name in ['join', 'leftOuterJoin', 'rightOuterJoin']:
+                for a, b in [(big, small), (small, big)]:
+                    exp = sorted(getattr(a, name)(b).collect())
+                    rdd = getattr(a, name)(b, bloomFilter=True)
+                    self.assertEqual(sorted(rdd.collect()), exp)
+
+            # the filter is built by two jobs when the join is computed, not by join()
+            jobs = self.sc.scheduler.runJobTimes
+            rdd = big.join(small, bloomFilter=True)
+            self.assertEqual(self.sc.scheduler.runJobTimes, jobs)
+            filtered = rdd.dependencies[0].rdd.dependencies[0].rdd
+            self.assertLess(filtered.count(), 10000 * 0.05)
+            self.assertEqual(self.sc.scheduler.runJobTimes, jobs + 3)
+            self.assertEqual(len(rdd.collect()), 100)
+            self.assertEqual(self.sc.scheduler.runJobTimes, jobs + 4)
+
+            # merged by chunks on executors, same as a filter built on the driver
+            chunk = BloomFilteredRDD.CHUNK_BYTES
+            BloomFilteredRDD.CHUNK_BYTES = 64
+            try:
+                filtered = BloomFilteredRDD(big, small)
+                filtered.count()
+            finally:
+                BloomFilteredRDD.CHUNK_BYTES = chunk
+            bf = filtered.bloomfilter.value
+            expected = Bloomfilter(bf.m, bf.k)
+            expected.add(range(0, 10000, 100))
+            self.assertEqual(bf.bitindex.array.rstrip(b'\0'), expected.bitindex.array.rstrip(b'\0'))
+        finally:
+            dpark.conf.BROADCAST_JOIN_THRESHOLD = threshold
+
+    def test_broadcast_join(self):
+        big = self.sc.makeRDD([(i % 100, i) for i in range(10000)], 4)
+        small = self.sc.makeRDD([(i, -i) for i in range(0, 200, 3)], 2)
+        self.assertEqual(small.union(small).estimate_size(), small.estimate_size() * 2)
+
+        def has_shuffle(rdd):
+            return any(isinstance(dep, ShuffleDependency) or has_shuffle(dep.rdd)
+                       for dep in rdd.dependencies)
+
+        threshold = dpark.conf.BROADCAST_JOIN_THRESHOLD
+        dpark.conf.BROADCAST_JOIN_THRESHOLD = small.estimate_size()
+        try:
+            joins = [big.join(small), big.leftOuterJoin(small),
+                     small.join(big), small.rightOuterJoin(big)]
+            for rdd in joins:
+                self.assertFalse(has_shuffle(rdd))
+            # the big side is not small enough to be broadcast
+            self.assertTrue(has_shuffle(big.rightOuterJoin(small)))
+            # the caller asks for a shuffle
+            self.assertTrue(has_shuffle(big.join(small, numSplits=3)))
+            self.assertTrue(has_shuffle(big.join(small, taskMemory=100)))
+            # size of the output of flatMap is not known
+            self.assertIsNone(small.flatMap(lambda kv: [kv] * 1000).estimate_size())
+            self.assertTrue(has_shuffle(big.join(small.flatMap(lambda kv: [kv]))))
+
+            # the small side is collected when the join is computed
+            jobs = self.sc.scheduler.runJobTimes
+            joins = [big.join(small), big.leftOuterJoin(small),
+                     small.join(big), small.rightOuterJoin(big)]
+            self.assertEqual(self.sc.scheduler.runJobTimes, jobs)
+            results = [sorted(rdd.collect()) for rdd in joins]
+            self.assertEqual(self.sc.scheduler.runJobTimes, jobs + 8)
+
+            dpark.conf.BROADCAST_JOIN_THRESHOLD = 0
+            joins = [big.join(small), big.leftOuterJoin(small),
+                     small.join(big), small.rightOuterJoin(big)]
+            self.assertTrue(all(has_shuffle(rdd) for rdd in joins))
+            self.assertEqual(results, [sorted(rdd.collect()) for rdd in joins])
+        finally:
+            dpark.conf.BROADCAST_JOIN_THRESHOLD = threshold
+
     def test_top_by_key(self):
         # group with top n per group
         ks = [1, 2, 2, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5, 5, 6, 6, 6, 6, 6, 6]
@@ -668,6 +979,34 @@ class TestRDDShuffleSortMerge(TestRDDShuffle):
         dpark.conf.DEFAULT_SHUFFLE_FLAGES = 0
         dpark.conf.default_rddconf.sort_merge = False
 
+    def test_sort_buffer_spills(self):
+        from dpark.task import SortBufferDumper
+        from dpark.dependency import Aggregator
+        from dpark.shuffle import (
+            ShuffleWorkDir, MappedFile, AutoBatchedSerializer, unpack_index_range
+        )
+
+        self.sc.start()
+        agg = Aggregator(lambda x: x, operator.add, operator.add)
+        shuffle_id = self.sc.newShuffleId()
+        dumper = SortBufferDumper(shuffle_id, 0, 3, dpark.conf.rddconf(), agg)
+        for j in range(3):
+            dumper.buffer.extend((k % 3, k, 1) for k in reversed(range(30)) if k % 3 != 1)
+            dumper.dump([{}], j == 2)
+        self.assertEqual(len(dumper.runs), 3)
+        dumper.commit(agg)
+
+        data = ShuffleWorkDir(shuffle_id, 0, ShuffleWorkDir.DATA).get()
+        with open(ShuffleWorkDir(shuffle_id, 0, ShuffleWorkDir.INDEX).get(), 'rb') as f:
+            index = f.read()
+        results = []
+        for i in range(3):
+            offset, length = unpack_index_range(index[i * 8:i * 8 + 16])
+            self.assertEqual(length, dumper.sizes[i])
+            results.append(list(AutoBatchedSerializer().load_stream(MappedFile(data, offset, length))))
+        self.assertEqual(results, [[(k, 3) for k in range(30) if k % 3 == i] if i != 1 else []
+                                   for i in range(3)])
+
 
 class TestRDDShuffleSortMergeIterGroup(TestRDDShuffle):
 
@@ -684,5 +1023,16 @@ class TestRDDShuffleSortMergeIterGroup(TestRDDShuffle):
         GroupByNestedIter.NO_CACHE = False
 
 
+class TestRDDShuffleNoConsolidate(TestRDDShuffle):
+
+    def setUp(self):
+        TestRDD.setUp(self)
+        dpark.conf.SHUFFLE_CONSOLIDATE = False
+
+    def tearDown(self):
+        TestRDD.tearDown(self)
+        dpark.conf.SHUFFLE_CONSOLIDATE = True
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=verbosity)
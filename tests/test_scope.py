@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import dpark.conf
 from dpark import DparkContext
 from dpark.utils.frame import Scope
 from pprint import pprint
@@ -41,7 +42,12 @@ def test_call_graph_join():
     dc = DparkContext()
     Scope.reset()
     rdd = dc.makeRDD([(1, 1), (1, 2)]).map(lambda x: x)
-    rdd = rdd.join(rdd)
+    threshold = dpark.conf.BROADCAST_JOIN_THRESHOLD
+    dpark.conf.BROADCAST_JOIN_THRESHOLD = 0  # a shuffle join
+    try:
+        rdd = rdd.join(rdd)
+    finally:
+        dpark.conf.BROADCAST_JOIN_THRESHOLD = threshold
     dc.scheduler.current_scope = Scope.get("")
     g = dc.scheduler.get_call_graph(rdd)
     pprint(g)
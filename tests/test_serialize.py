@@ -60,6 +60,70 @@ class TestSerialize(unittest.TestCase):
 
         self.assertEqual(func(), (x, y))
 
+    def testClosureCache(self):
+        from dpark.serialize import closure_cache_stats
+        n = 10
+        step = (1, 2)
+
+        def foo(x):
+            return x + n + sum(step)
+
+        hits = closure_cache_stats['hits']
+        first = dump_closure(foo)
+        self.assertIs(dump_closure(foo), first)
+        self.assertEqual(closure_cache_stats['hits'], hits + 1)
+
+        n = 20  # rebind a captured value
+        self.assertEqual(load_closure(dump_closure(foo))(0), 23)
+
+        values = [1]
+
+        def bar():
+            return values[0]
+
+        uncacheable = closure_cache_stats['uncacheable']
+        self.assertEqual(load_closure(dump_closure(bar))(), 1)
+        values[0] = 2  # mutated in place
+        self.assertEqual(load_closure(dump_closure(bar))(), 2)
+        self.assertEqual(closure_cache_stats['uncacheable'], uncacheable + 2)
+
+    def testClosureCacheRecursive(self):
+        import gc
+        import weakref
+        from dpark.serialize import _closure_cache, closure_cache_stats
+
+        def make(n):
+            def fact(x):
+                return x <= 1 and n or x * fact(x - 1)
+            return fact
+
+        f = make(1)
+        hits = closure_cache_stats['hits']
+        first = dump_closure(f)
+        self.assertIs(dump_closure(f), first)
+        self.assertEqual(closure_cache_stats['hits'], hits + 1)
+        self.assertIsNot(dump_closure(make(2)), first)
+
+        ref = weakref.ref(f)
+        self.assertIn(f, _closure_cache)
+        del f
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def testMarshalable(self):
+        from dpark.serialize import marshalable
+        for o in [None, b'', u'', 0, 0.0, True, complex(1, 1), (1, 1), [1, 1], set([1]),
+                  {1: None}, [(i, str(i)) for i in range(1000)],
+                  [((i, 'a'), [1.0, (2, None)]) for i in range(10)], {'a': [1, {'b': 2}]}]:
+            self.assertTrue(marshalable(o), o)
+        for o in [memoryview(b''), bytearray(b'a'), object(), [(1, bytearray(b'a'))],
+                  [(1, 'a')] * 10 + [(1, object())], [(1, [2, (3, bytearray())])],
+                  {1: object()}, [(1,) * 200 + (object(),)]]:
+            self.assertFalse(marshalable(o), o)
+        # same shapes, different decisions inside
+        self.assertTrue(marshalable([(1, [1, 2])]))
+        self.assertFalse(marshalable([(1, [1, bytearray()])]))
+
     def testRandomSample(self):
         from random import sample, Random
         _sample = loads(dumps(sample))
@@ -0,0 +1,296 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import pickle
+
+from six import BytesIO
+from dpark.shuffle import (
+    ShuffleWorkDir, ShuffleBlockClient, start_shuffle_server, pack_index,
+    FetchBudget, MappedFile, AutoBatchedSerializer, pack_header, unpack_header,
+    write_frame, read_frame, ChecksumError, pickle_frames, write_frames, load_items,
+    compress_size, decompress_size, decompress_sizes
+)
+import dpark.conf
+from dpark.utils.codec import default_codec, get_codec
+
+
+class TestShuffleServer(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # map 0: one file per reduce
+        os.makedirs(os.path.join(self.root, '1', '0'))
+        for rid, data in enumerate([b'a' * 10, b'']):
+            with open(os.path.join(self.root, '1', '0', str(rid)), 'wb') as f:
+                f.write(data)
+        # map 1: consolidated
+        os.makedirs(os.path.join(self.root, '1', '1'))
+        with open(os.path.join(self.root, '1', '1', ShuffleWorkDir.DATA), 'wb') as f:
+            f.write(b'xxxyyyyy')
+        with open(os.path.join(self.root, '1', '1', ShuffleWorkDir.INDEX), 'wb') as f:
+            f.write(pack_index([0, 3, 3, 8]))
+        self.uri = start_shuffle_server(self.root)
+        self.client = ShuffleBlockClient()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, True)
+
+    def fetch(self, blocks):
+        return [(block, stream.read(), length)
+                for block, stream, length in self.client.fetch(self.uri, blocks)]
+
+    def test_batched_fetch(self):
+        blocks = [(1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1), (1, 1, 2)]
+        res = self.fetch(blocks)
+        self.assertEqual([b for b, _, _ in res], blocks)
+        self.assertEqual([d for _, d, _ in res], [b'a' * 10, b'', b'xxx', b'', b'yyyyy'])
+        self.assertEqual([n for _, _, n in res], [10, 0, 3, 0, 5])
+
+        # connection is kept alive and reused
+        self.assertEqual(sum(len(c) for c in self.client.idle.values()), 1)
+        self.assertEqual(self.fetch([(1, 1, 2)])[0][1], b'yyyyy')
+        self.assertEqual(sum(len(c) for c in self.client.idle.values()), 1)
+
+    def test_open_block(self):
+        f, length = self.client.open_block(self.uri, (1, 1, 0))
+        self.assertEqual(length, 3)
+        self.assertEqual(f.read(), b'xxx')
+        f.close()
+        self.assertEqual(sum(len(c) for c in self.client.idle.values()), 1)
+
+        f, length = self.client.open_block(self.uri, (1, 1, 2), 2)
+        self.assertEqual((length, f.read()), (3, b'yyy'))
+        f.close()
+
+    def test_not_found(self):
+        with self.assertRaises(IOError):
+            self.fetch([(1, 0, 0), (2, 0, 0)])
+        self.assertEqual(self.fetch([(1, 0, 0)])[0][1], b'a' * 10)
+
+    def test_bad_blocks(self):
+        outside = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(outside, '0'))
+            with open(os.path.join(outside, '0', '0'), 'wb') as f:
+                f.write(b'secret')
+            up = os.path.relpath(outside, self.root)
+            for block in [(up, '0', '0'), (up, 0, 0), (1, '0', 0), (-1, 0, 0),
+                          (1, 1, 2, -3), (1, 1, 2.0), (1, 1, True), (1,), (1, 1, 1, 1, 1)]:
+                with self.assertRaises(IOError):
+                    self.fetch([block])
+            # the connection still serves good blocks
+            self.assertEqual(self.fetch([(1, 1, 2)])[0][1], b'yyyyy')
+        finally:
+            shutil.rmtree(outside, True)
+
+
+class TestMappedFile(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read_range(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'0123456789')
+        f = MappedFile(self.path, 2, 5)
+        self.assertEqual(bytes(f.read(3)), b'234')
+        self.assertEqual(bytes(f.read()), b'56')
+        self.assertEqual(f.read(), b'')
+        f.close()
+
+        f = MappedFile(self.path, 3, 0)
+        self.assertEqual(f.read(), b'')
+        f.close()
+
+        with self.assertRaises(IOError):
+            MappedFile(self.path, 8, 5)
+
+    def test_load_stream(self):
+        items = [(i, str(i)) for i in range(1000)]
+        with open(self.path, 'wb') as f:
+            AutoBatchedSerializer().dump_stream(items, f)
+
+        f = MappedFile(self.path)
+        self.assertEqual(list(AutoBatchedSerializer().load_stream(f)), items)
+        f.close()
+
+
+class TestFetchBudget(unittest.TestCase):
+
+    def test_back_pressure(self):
+        budget = FetchBudget(100)
+        budget.acquire(60)
+        budget.acquire(40)
+        acquired = []
+
+        def _():
+            budget.acquire(30)
+            acquired.append(30)
+
+        t = threading.Thread(target=_)
+        t.start()
+        time.sleep(0.1)
+        self.assertEqual(acquired, [])
+        budget.release(60)
+        t.join(1)
+        self.assertEqual(acquired, [30])
+        self.assertEqual(budget.used, 70)
+
+    def test_oversize(self):
+        budget = FetchBudget(10)
+        budget.acquire(100)  # one batch always gets in
+        self.assertEqual(budget.used, 100)
+        budget.release(100)
+        self.assertEqual(budget.used, 0)
+
+
+class TestFrame(unittest.TestCase):
+
+    def setUp(self):
+        self.checksum = dpark.conf.SHUFFLE_CHECKSUM
+
+    def tearDown(self):
+        dpark.conf.SHUFFLE_CHECKSUM = self.checksum
+
+    def test_checksum(self):
+        dpark.conf.SHUFFLE_CHECKSUM = True
+        f = BytesIO()
+        for data in [b'abc', b'defg']:
+            write_frame(f, default_codec.compress(data), True, False)
+        buf = f.getvalue()
+
+        f = BytesIO(buf)
+        frame = read_frame(f)
+        self.assertEqual(frame[:3], (True, False, b'abc'))
+        self.assertEqual(f.tell(), frame[3])
+        self.assertEqual(read_frame(f)[2], b'defg')
+        self.assertIsNone(read_frame(f))
+
+        bad = bytearray(buf)
+        bad[-1] ^= 0xff
+        f = BytesIO(bytes(bad))
+        read_frame(f)
+        with self.assertRaises(ChecksumError):
+            read_frame(f)
+
+    def test_no_checksum(self):
+        # the default, readable by executors of versions before checksums
+        dpark.conf.SHUFFLE_CHECKSUM = False
+        f = BytesIO()
+        write_frame(f, default_codec.compress(b'abc'), True, False)
+        self.assertFalse(unpack_header(f.getvalue()[:5])[4])
+        f.seek(0)
+        self.assertEqual(read_frame(f)[:3], (True, False, b'abc'))
+
+
+@unittest.skipIf(not hasattr(pickle, 'PickleBuffer'), 'pickle protocol 5 not available')
+class TestOutOfBand(unittest.TestCase):
+
+    def setUp(self):
+        self.threshold = dpark.conf.SHUFFLE_OOB_BUFFER_SIZE
+        dpark.conf.SHUFFLE_OOB_BUFFER_SIZE = 1024
+
+    def tearDown(self):
+        dpark.conf.SHUFFLE_OOB_BUFFER_SIZE = self.threshold
+
+    def test_round_trip(self):
+        items = [(1, b'x' * 4096), (2, bytearray(b'y' * 2048)), (3, b'small')]
+        for name in ['none', 'zlib', None]:
+            codec = default_codec if name is None else get_codec(name)
+            size, frames = pickle_frames(items, codec)
+            self.assertEqual(len(frames), 3)
+            f = BytesIO()
+            write_frames(f, frames, False, codec)
+            end = f.tell()
+            write_frame(f, codec.compress(pickle.dumps(items, -1)), False, True, codec)
+
+            f.seek(0)
+            is_marshal, _, data, frame_size = read_frame(f)
+            self.assertEqual(frame_size, end)
+            self.assertEqual(len(data), size)
+            loaded = load_items(data, is_marshal)
+            self.assertEqual(loaded, items)
+            self.assertIs(type(loaded[1][1]), bytearray)
+            self.assertEqual(load_items(read_frame(f)[2], False), items)
+            self.assertIsNone(read_frame(f))
+
+    def test_in_band(self):
+        items = [(i, b'x' * 100) for i in range(10)]
+        size, frames = pickle_frames(items, default_codec)
+        self.assertEqual(len(frames), 1)
+        f = BytesIO()
+        write_frames(f, frames, False)
+        f.seek(0)
+        self.assertEqual(load_items(read_frame(f)[2], False), items)
+
+    def test_serializer(self):
+        items = [(i, b'%d' % i * 1000) for i in range(100)]
+        f = BytesIO()
+        s = AutoBatchedSerializer()
+        s.use_marshal = False
+        s.dump_stream(items, f)
+        f.seek(0)
+        self.assertEqual(list(AutoBatchedSerializer().load_stream(f)), items)
+
+
+class TestCompressedSizes(unittest.TestCase):
+
+    def test_compress_size(self):
+        self.assertEqual(compress_size(0), 0)
+        self.assertEqual(decompress_size(0), 0)
+        self.assertEqual(decompress_size(compress_size(1)), 1)
+        for size in [2, 10, 1000, 12345, 1 << 20, 3 << 30]:
+            b = compress_size(size)
+            self.assertTrue(0 < b < 256)
+            self.assertTrue(size <= decompress_size(b) <= size * 1.1 + 1)
+        self.assertEqual(compress_size(1 << 60), 255)
+        sizes = [0, 1, 100, 1 << 20]
+        data = bytearray(compress_size(s) for s in sizes)
+        self.assertEqual(decompress_sizes(data), [decompress_size(b) for b in data])
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_header(self):
+        self.assertEqual(pack_header(3, True, True)[:1], b'M')
+        for name in ['none', 'zlib', 'zlib:9', 'lz4']:
+            codec = get_codec(name)
+            for is_marshal in (True, False):
+                for is_sorted in (True, False):
+                    for crc in (None, 1234):
+                        head = pack_header(10, is_marshal, is_sorted, codec, crc)
+                        length, m, s, c, has_crc = unpack_header(head[:5])
+                        self.assertEqual((length, m, s, c.id, has_crc),
+                                         (10, is_marshal, is_sorted, codec.id, crc is not None))
+
+        with self.assertRaises(IOError):
+            unpack_header(b'x\0\0\0\0')
+
+    def test_mixed_codecs(self):
+        items = [(i, str(i)) for i in range(100)]
+        f = BytesIO()
+        for name in [None, 'none', 'zlib:9']:
+            codec = default_codec if name is None else get_codec(name)
+            AutoBatchedSerializer(codec=codec).dump_stream(items, f)
+        f.seek(0)
+        s = AutoBatchedSerializer()
+        self.assertEqual(list(s.load_stream(f)), items * 3)
+        self.assertGreater(s.raw_size, 0)
+
+    def test_get_codec(self):
+        self.assertIs(get_codec(None), default_codec)
+        self.assertIs(get_codec('zlib:9'), get_codec('zlib:9'))
+        with self.assertRaises(ValueError):
+            get_codec('no_such_codec')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,17 @@
 from __future__ import absolute_import
+import os
 import sys
+import socket
+import shutil
+import tempfile
 import time
 import unittest
 import logging
 
+import dpark.conf
 from dpark.taskset import TaskSet
 from dpark.hostatus import HostStatus, TaskHostManager
+from dpark.taskprofile import TaskProfiles
 from dpark.task import TaskState, OtherFailure, TaskEndReason, DAGTask
 from six.moves import range
 from addict import Dict
@@ -30,11 +36,12 @@ class MockSchduler:
 
 class MockTask(DAGTask):
 
-    def __init__(self, id):
+    def __init__(self, id, locs=()):
         DAGTask.__init__(self, 1, 1, id)
+        self.locs = list(locs)
 
     def preferredLocations(self):
-        return []
+        return self.locs
 
 
 def create_offer(hostname):
@@ -93,6 +100,182 @@ class TestTaskSet(unittest.TestCase):
         assert taskset.counter.finished == 10
 
 
+    def test_delay_scheduling(self):
+        racks, locality_wait = dpark.conf.RACKS, dpark.conf.LOCALITY_WAIT
+        dpark.conf.RACKS = {'host1': 'rack1', 'host2': 'rack1', 'host3': 'rack2'}
+        dpark.conf.LOCALITY_WAIT = 100
+        try:
+            tasks = [MockTask(i, ['host1']) for i in range(4)]
+            taskset = TaskSet(MockSchduler(), tasks, 1, 10)
+            for h in ['host1', 'host2', 'host3']:
+                taskset.task_host_manager.register_host(h)
+            cpus, mems, gpus = [1, 1, 1], [10, 10, 10], [0, 0, 0]
+
+            def offer(*hosts):
+                host_offers = dict((h, (i, create_offer(h))) for i, h in enumerate(hosts))
+                return [(o.hostname, t.id) for _, o, t in
+                        taskset.taskOffer(host_offers, list(cpus), list(mems), list(gpus))]
+
+            self.assertEqual(offer('host3', 'host2'), [])  # wait for host1
+            self.assertEqual(offer('host1'), [('host1', '1_0')])
+
+            wait = taskset.localityWait
+            self.assertEqual(wait, 5)  # half of the default average task time
+            taskset.lastPreferredLaunchTime -= wait
+            self.assertEqual(offer('host3'), [])
+            self.assertEqual(offer('host2', 'host3'), [('host2', '1_1')])  # same rack
+
+            taskset.lastPreferredLaunchTime -= wait * 2
+            self.assertEqual(offer('host3'), [('host3', '1_2')])
+            self.assertEqual(taskset.locality_counts, [1, 1, 1])
+            self.assertEqual(taskset.locality_summary(), ' host:33% rack:33% any:33%')
+
+            # launching on a preferred host brings the level back
+            self.assertEqual(offer('host1'), [('host1', '1_3')])
+            self.assertEqual(taskset.locality_level, 0)
+        finally:
+            dpark.conf.RACKS, dpark.conf.LOCALITY_WAIT = racks, locality_wait
+
+
+    def test_pending_index(self):
+        resolved = []
+
+        def gethostbyname_ex(host):
+            resolved.append(host)
+            return host + '.example.com', [], ['10.0.0.1']
+
+        tasks = [MockTask(i, ['10.0.0.1']) for i in range(5)] + [MockTask(5)]
+        taskset = TaskSet(MockSchduler(), tasks, 1, 10)
+        taskset.task_host_manager.register_host('host1')
+        host_offers = {'host1': (0, create_offer('host1'))}
+        orig, socket.gethostbyname_ex = socket.gethostbyname_ex, gethostbyname_ex
+        try:
+            ts = sum([taskset.taskOffer(host_offers, [1], [10], [0]) for _ in range(5)], [])
+        finally:
+            socket.gethostbyname_ex = orig
+        self.assertEqual([t.id for _, _, t in ts], ['1_%d' % i for i in range(5)])
+        self.assertEqual(resolved, ['host1'])
+
+        # a task larger than the offer waits
+        taskset.tasks[5].mem = 20
+        self.assertEqual(taskset.taskOffer(host_offers, [1], [10], [0]), [])
+        self.assertEqual(taskset.pendingTasksForHost['10.0.0.1'], [])  # launched ones dropped
+        self.assertEqual(taskset.taskOffer(host_offers, [1], [20], [0])[0][2].id, '1_5')
+
+
+    def test_speculation(self):
+        speculation = dpark.conf.SPECULATION
+        try:
+            killed = []
+            sched = MockSchduler()
+            sched.killTask = lambda task_id, tried: killed.append((task_id, tried))
+            tasks = [MockTask(i) for i in range(4)]
+            taskset = TaskSet(sched, tasks, 1, 10)
+            for h in ['host1', 'host2']:
+                taskset.task_host_manager.register_host(h)
+            offer1 = {'host1': (0, create_offer('host1'))}
+            ts = sum([taskset.taskOffer(offer1, [4], [40], [0]) for _ in range(4)], [])
+            self.assertEqual(len(ts), 4)
+            for _, _, t in ts:
+                taskset.statusUpdate(t.id, 1, TaskState.running)
+            for _, _, t in ts[:3]:
+                taskset.statusUpdate(t.id, 1, TaskState.finished)
+
+            slow = ts[3][2]
+            now = time.time()
+            dpark.conf.SPECULATION = True
+            taskset._speculate(now)
+            self.assertEqual(taskset.speculated, {})
+            slow.start_time = now - 100
+            dpark.conf.SPECULATION = False  # the default
+            taskset._speculate(now)
+            self.assertEqual(taskset.speculated, {})
+            dpark.conf.SPECULATION = True
+            taskset._speculate(now)
+            self.assertEqual(taskset.speculated, {3: 1})
+
+            self.assertEqual(taskset.taskOffer(offer1, [4], [40], [0]), [])  # not where it runs
+            backup = taskset.taskOffer({'host2': (0, create_offer('host2'))}, [4], [40], [0])
+            self.assertEqual([(o.hostname, t.id, t.num_try) for _, o, t in backup],
+                             [('host2', slow.id, 2)])
+            taskset.statusUpdate(slow.id, 2, TaskState.running)
+            taskset.statusUpdate(slow.id, 2, TaskState.finished)
+            self.assertEqual(killed, [(slow.id, 1)])
+            self.assertEqual(taskset.counter.finished, 4)
+            self.assertEqual(taskset.num_speculation_won, 1)
+            self.assertGreater(taskset.time_wasted, 0)
+            self.assertTrue(taskset.speculation_summary().startswith(', speculated=1 (won 1'))
+        finally:
+            dpark.conf.SPECULATION = speculation
+
+
+class TestTaskProfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'profiles', 'task_profile.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_taskset(self, mem, rss, oom=()):
+        tasks = [MockTask(i) for i in range(len(rss))]
+        for t in tasks:
+            t.rdd = Dict(mem=mem)
+        taskset = TaskSet(MockSchduler(), tasks, 1, mem)
+        taskset.task_host_manager.register_host('localhost', purge_elapsed=0)
+        host_offers = {'localhost': (0, create_offer('localhost'))}
+        for i, r in enumerate(rss):
+            t = taskset.taskOffer(host_offers, [1], [1 << 20], [0])[0][2]
+            if i in oom:
+                taskset.statusUpdate(t.id, t.num_try, TaskState.failed, TaskEndReason.task_oom)
+                t = taskset.taskOffer(host_offers, [1], [1 << 20], [0])[0][2]
+            stats = Dict(bytes_max_rss=r << 20)
+            taskset.statusUpdate(t.id, t.num_try, TaskState.running)
+            taskset.statusUpdate(t.id, t.num_try, TaskState.finished, stats=stats)
+        assert taskset.counter.finished == len(rss)
+        return taskset
+
+    def test_profiles(self):
+        profiles = TaskProfiles(self.path, headroom=0.5, min_tasks=5)
+        assert profiles.suggest_mem('map:0@a.py:1', 1000, 20000) == 1000
+
+        # shrink an over-request, unless memory is set by user
+        profiles.update('map:0@a.py:1', self.run_taskset(1000, [100] * 9 + [200]))
+        p = profiles.get('map:0@a.py:1')
+        assert p['tasks'] == 10 and p['oom_mem'] == 0
+        assert p['mem'][0] == 100 and p['mem'][-1] == 200
+        assert len(p['duration']) == 3
+        assert profiles.suggest_mem('map:0@a.py:1', 1000, 20000) == 300
+        assert profiles.suggest_mem('map:0@a.py:1', 1000, 20000, keep_mem=True) == 1000
+        assert profiles.suggest_mem('map:0@a.py:1', 100, 20000) == 300
+
+        # too few tasks to trust
+        profiles.update('map:0@a.py:2', self.run_taskset(1000, [100] * 2))
+        assert profiles.suggest_mem('map:0@a.py:2', 1000, 20000) == 1000
+
+        # ramp up after OOM, even with few tasks
+        profiles.update('map:0@a.py:3', self.run_taskset(100, [150] * 2, oom=[0]))
+        assert profiles.get('map:0@a.py:3')['oom_mem'] == 100
+        assert profiles.suggest_mem('map:0@a.py:3', 100, 20000) == 225
+        assert profiles.suggest_mem('map:0@a.py:3', 100, 200) == 200
+        # not shrunk below what got OOM
+        assert profiles.suggest_mem('map:0@a.py:3', 1000, 20000) == 1000
+
+        # written once by save(), kept for the next run, merged with other drivers
+        assert not os.path.exists(self.path)
+        profiles.save()
+        other = TaskProfiles(self.path)
+        other.update('map:0@b.py:1', self.run_taskset(100, [10] * 5))
+        other.save()
+        reloaded = TaskProfiles(self.path)
+        assert set(reloaded.profiles) == {'map:0@a.py:1', 'map:0@a.py:2',
+                                          'map:0@a.py:3', 'map:0@b.py:1'}
+        assert reloaded.suggest_mem('map:0@a.py:1', 100, 20000) == 240
+
+        assert TaskProfiles(None).suggest_mem('map:0@a.py:1', 1000, 20000) == 1000
+
+
 class TestHostStatus(unittest.TestCase):
     def test_single_hostatus(self):
         ht = HostStatus('localhost', purge_elapsed=3)